@@ -9,4 +9,5 @@ from adorym.forward_model import *
 from adorym.regularizers import *
 from adorym.simulation import *
 from adorym.wrappers import *
-from adorym.visualization import *
\ No newline at end of file
+from adorym.visualization import *
+from adorym.conversion import *
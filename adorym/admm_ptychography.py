@@ -6,6 +6,7 @@ import warnings
 import time
 import inspect
 import pickle
+import collections
 
 import adorym
 import adorym.wrappers as w
@@ -55,6 +56,273 @@ class Schedule():
         return self.schedule_vals[ind]
 
 
+class VariableStore():
+    """
+    Storage of subproblem variables on one rank, shared by all subproblems that use the same temporary folder.
+
+    Variables exchanged between ranks (e.g., psi, g_u, lambda2, lambda3) are kept in one HDF5 file each. Handles
+    to these files stay open in a pool of at most max_open_files, and whole-variable writes go to the file
+    immediately, with an in-memory copy kept for later reads on this rank. Variables private to this rank (names
+    starting with one of private_prefixes, e.g., psi1 tiles) are only held in memory, and are spilled to a single
+    file of this rank when evicted. In-memory copies are evicted in least-recently-used order when their total
+    size exceeds ram_budget_mb.
+
+    Other ranks are guaranteed to see the changes made on this rank only after sync is called, which closes all
+    pooled handles and drops in-memory copies of shared variables. Call sync on all ranks followed by a barrier
+    wherever variables are handed over between ranks.
+
+    :param temp_folder: String. Folder of variable files.
+    :param ram_budget_mb: Float. Maximum total size of in-memory copies in MB.
+    :param max_open_files: Int. Maximum number of pooled file handles.
+    :param private_prefixes: Tuple of String. Name prefixes of variables that are written and read only by the
+                             rank owning them.
+    """
+    def __init__(self, temp_folder, ram_budget_mb=1024, max_open_files=64, private_prefixes=('psi1_',)):
+        self.temp_folder = temp_folder
+        self.ram_dict = collections.OrderedDict()
+        self.ram_size = 0
+        self.dirty_set = set()
+        self.handle_dict = collections.OrderedDict()
+        self.spill_file = None
+        self.configure(ram_budget_mb=ram_budget_mb, max_open_files=max_open_files, private_prefixes=private_prefixes)
+
+    def configure(self, ram_budget_mb=None, max_open_files=None, private_prefixes=None):
+        """
+        Change the settings of the store. Settings given as None are kept. In-memory copies and pooled handles
+        exceeding the new limits are evicted or closed.
+        """
+        if private_prefixes is not None:
+            # Variables changing between private and shared must not be left only in memory or in the spill file.
+            for name in list(self.ram_dict.keys()):
+                self.evict(name)
+            self.private_prefixes = tuple(private_prefixes)
+        if ram_budget_mb is not None:
+            self.ram_budget = ram_budget_mb * 1024 ** 2
+            while self.ram_size > self.ram_budget:
+                self.evict(next(iter(self.ram_dict)))
+        if max_open_files is not None:
+            self.max_open_files = max_open_files
+            while len(self.handle_dict) > self.max_open_files:
+                self.handle_dict.popitem(last=False)[1].close()
+
+    def is_private(self, name):
+        return name.startswith(self.private_prefixes)
+
+    def get_fname(self, name):
+        return os.path.join(self.temp_folder, name + '.h5')
+
+    def get_handle(self, name, mode='r'):
+        """
+        Get a pooled handle to the file of a shared variable. Mode is as in h5py.File; a handle opened for writing
+        also serves reads.
+        """
+        f = self.handle_dict.pop(name, None)
+        if f is not None and (mode == 'w' or (mode != 'r' and f.mode == 'r')):
+            f.close()
+            f = None
+        if f is None:
+            while len(self.handle_dict) >= self.max_open_files:
+                self.handle_dict.popitem(last=False)[1].close()
+            f = h5py.File(self.get_fname(name), mode)
+        self.handle_dict[name] = f
+        return f
+
+    def get_spill_file(self):
+        if self.spill_file is None:
+            self.spill_file = h5py.File(os.path.join(self.temp_folder, 'variables_rank_{:05d}.h5'.format(rank)), 'w')
+        return self.spill_file
+
+    def write_to_file(self, name, var):
+        if self.is_private(name):
+            f = self.get_spill_file()
+            path = name
+        else:
+            f = self.get_handle(name, 'a')
+            path = 'data'
+        if path in f and f[path].shape == var.shape and f[path].dtype == var.dtype:
+            f[path][...] = var
+        else:
+            if path in f:
+                del f[path]
+            f.create_dataset(path, data=var)
+        f.flush()
+
+    def read_from_file(self, name):
+        if self.is_private(name):
+            return self.get_spill_file()[name][...]
+        return self.get_handle(name, 'r')['data'][...]
+
+    def keep_in_ram(self, name, var, dirty=False):
+        self.drop(name)
+        if var.nbytes > self.ram_budget:
+            if dirty:
+                self.write_to_file(name, var)
+            return
+        self.ram_dict[name] = var
+        self.ram_size += var.nbytes
+        if dirty:
+            self.dirty_set.add(name)
+        while self.ram_size > self.ram_budget:
+            self.evict(next(iter(self.ram_dict)))
+
+    def evict(self, name):
+        """
+        Remove the in-memory copy of a variable, writing it to file first if it is not yet there.
+        """
+        if name in self.dirty_set:
+            self.write_to_file(name, self.ram_dict[name])
+        self.drop(name)
+
+    def drop(self, name):
+        var = self.ram_dict.pop(name, None)
+        if var is not None:
+            self.ram_size -= var.nbytes
+        self.dirty_set.discard(name)
+
+    def save(self, name, var):
+        var = np.array(var)
+        if not self.is_private(name):
+            self.write_to_file(name, var)
+        self.keep_in_ram(name, var, dirty=self.is_private(name))
+
+    def load(self, name):
+        if name in self.ram_dict:
+            self.ram_dict.move_to_end(name)
+            return self.ram_dict[name].copy()
+        var = self.read_from_file(name)
+        self.keep_in_ram(name, var)
+        return var.copy()
+
+    def get_dataset(self, name, mode='r'):
+        """
+        Get the HDF5 dataset of a variable for sliced access. The in-memory copy is no longer valid once the
+        dataset is written, so it is removed.
+        """
+        self.evict(name)
+        if self.is_private(name):
+            return self.get_spill_file()[name]
+        return self.get_handle(name, mode)['data']
+
+    def release_dataset(self, dset):
+        """
+        Flush writes made through a dataset, so that other ranks reading the same region see them. Pooled handles
+        stay open; other handles are closed.
+        """
+        f = dset.file
+        pooled_fname_ls = [ff.filename for ff in self.handle_dict.values()]
+        if self.spill_file is not None:
+            pooled_fname_ls.append(self.spill_file.filename)
+        if f.filename in pooled_fname_ls:
+            if f.mode != 'r':
+                f.flush()
+        else:
+            f.close()
+
+    def close_file(self, name):
+        """
+        Close the pooled handle of a variable, so that the file can be recreated or opened collectively.
+        """
+        self.evict(name)
+        f = self.handle_dict.pop(name, None)
+        if f is not None:
+            f.close()
+
+    def sync(self):
+        """
+        Close all pooled handles, and drop in-memory copies of shared variables, which other ranks may change.
+        """
+        for name in list(self.ram_dict.keys()):
+            if not self.is_private(name):
+                self.drop(name)
+        for f in self.handle_dict.values():
+            f.close()
+        self.handle_dict = collections.OrderedDict()
+
+    def close(self):
+        """
+        Close all files and remove the store from the stores of this rank, so that get_variable_store creates a
+        new one for the next run using the same folder.
+        """
+        self.sync()
+        self.ram_dict = collections.OrderedDict()
+        self.ram_size = 0
+        self.dirty_set = set()
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        key = os.path.abspath(self.temp_folder)
+        if _variable_store_dict.get(key) is self:
+            del _variable_store_dict[key]
+
+
+_variable_store_dict = {}
+
+
+def get_variable_store(temp_folder, **kwargs):
+    """
+    Get the VariableStore of a temporary folder on this rank, creating it with kwargs if it does not exist yet.
+    If it exists, kwargs are applied to it.
+    """
+    key = os.path.abspath(temp_folder)
+    if key not in _variable_store_dict.keys():
+        _variable_store_dict[key] = VariableStore(temp_folder, **kwargs)
+    elif len(kwargs) > 0:
+        _variable_store_dict[key].configure(**kwargs)
+    return _variable_store_dict[key]
+
+
+class AngleScheduler():
+    """
+    Angle-level hand-over of variables between pipelined subproblems.
+
+    Without it, a subproblem starts only after all ranks have finished the previous one. With it, the rank
+    producing a variable of an angle (e.g., psi from PHR) notifies the ranks consuming it as soon as the variable
+    is in its file, and a consumer waits only for the angles it owns. Ranks that finish early thus move on to the
+    next subproblem, instead of idling at a global barrier until the slowest rank is done.
+
+    Notifications are point-to-point messages tagged by stage and angle, and carry the epoch number, so that a
+    notification left unconsumed in an earlier epoch is never mistaken for a current one.
+
+    :param n_theta: Int. Number of rotation angles.
+    :param stage_ls: Tuple of String. Names of the variables handed over.
+    :param tag_offset: Int. Smallest MPI tag used. Tags up to tag_offset + len(stage_ls) * n_theta are reserved,
+                       and must stay within the tag upper bound of MPI.
+    """
+    def __init__(self, n_theta, stage_ls=('psi', 'w'), tag_offset=100):
+        self.n_theta = n_theta
+        self.stage_ls = tuple(stage_ls)
+        self.tag_offset = tag_offset
+        check_mpi_tag(self.get_tag(self.stage_ls[-1], n_theta - 1))
+        self.i_epoch = 0
+        self.received_set = set()
+
+    def get_tag(self, stage, i_theta):
+        return self.tag_offset + self.stage_ls.index(stage) * self.n_theta + i_theta
+
+    def new_epoch(self, i_epoch):
+        self.i_epoch = i_epoch
+        self.received_set = set()
+
+    def notify(self, stage, i_theta, dest_rank_ls):
+        """
+        Tell the ranks in dest_rank_ls that the variable of stage at angle i_theta is ready.
+        """
+        for dest_rank in dest_rank_ls:
+            if dest_rank != rank:
+                comm.send(self.i_epoch, dest=dest_rank, tag=self.get_tag(stage, i_theta))
+
+    def wait(self, stage, i_theta, src_rank):
+        """
+        Block until src_rank has notified that the variable of stage at angle i_theta is ready in this epoch.
+        """
+        if src_rank == rank or (stage, i_theta) in self.received_set:
+            return
+        i_epoch = -1
+        while i_epoch < self.i_epoch:
+            i_epoch = comm.recv(source=src_rank, tag=self.get_tag(stage, i_theta))
+        self.received_set.add((stage, i_theta))
+
+
 class Subproblem():
     def __init__(self, device, rho_schedule=None):
         self.device = device
@@ -66,6 +334,8 @@ class Subproblem():
         self.rho_schedule = rho_schedule
         self.optimizer = None
         self.initialize_array_vars = True
+        self.store = None
+        self.scheduler = None
 
     def initialize(self, *args, **kwargs):
         self.update_rho()
@@ -74,37 +344,35 @@ class Subproblem():
         self.prev_sp = prev_sp
         self.next_sp = next_sp
 
+    def get_variable_name(self, fname):
+        if len(fname) >= 3 and fname[-3:] == '.h5':
+            fname = fname[:-3]
+        return fname
+
     def save_variable(self, var, fname, to_numpy=True, format='hdf5', collective=False):
         if to_numpy:
             var = w.to_numpy(var)
         if format == 'hdf5':
-            if len(fname) < 3 or fname[-3:] != '.h5':
-                fname += '.h5'
+            name = self.get_variable_name(fname)
             if collective:
+                self.store.close_file(name)
+                try:
+                    f = h5py.File(self.store.get_fname(name), 'a', driver='mpio', comm=comm)
+                except:
+                    f = h5py.File(self.store.get_fname(name), 'a')
                 try:
-                    f = h5py.File(os.path.join(self.temp_folder, fname), 'a', driver='mpio', comm=comm)
+                    f.create_dataset('data', data=var)
                 except:
-                    f = h5py.File(os.path.join(self.temp_folder, fname), 'a')
+                    f['data'][...] = var
+                f.close()
             else:
-                f = h5py.File(os.path.join(self.temp_folder, fname), 'a')
-            try:
-                f.create_dataset('data', data=var)
-            except:
-                f['data'][...] = var
-            f.close()
+                self.store.save(name, var)
         elif format == 'npy':
             np.save(os.path.join(self.temp_folder, fname), var)
 
     def load_variable(self, fname, create_variable=True, format='hdf5'):
         if format == 'hdf5':
-            if len(fname) < 3 or fname[-3:] != '.h5':
-                fname += '.h5'
-            try:
-                f = h5py.File(os.path.join(self.temp_folder, fname), 'r', driver='mpio', comm=comm)
-            except:
-                f = h5py.File(os.path.join(self.temp_folder, fname.format(fname)), 'r')
-            var = f['data'][...]
-            f.close()
+            var = self.store.load(self.get_variable_name(fname))
         elif format == 'npy':
             if len(fname) < 4 or fname[-4:] != '.npy':
                 fname += '.npy'
@@ -115,15 +383,15 @@ class Subproblem():
 
     def create_mmap(self, fname, shape, dtype, mode='w', format='hdf5', collective=False):
         if format == 'hdf5':
-            if len(fname) < 3 or fname[-3:] != '.h5':
-                fname += '.h5'
+            name = self.get_variable_name(fname)
+            self.store.close_file(name)
             if collective:
                 try:
-                    f = h5py.File(os.path.join(self.temp_folder, fname), mode, driver='mpio', comm=comm)
+                    f = h5py.File(self.store.get_fname(name), mode, driver='mpio', comm=comm)
                 except:
-                    f = h5py.File(os.path.join(self.temp_folder, fname), mode)
+                    f = h5py.File(self.store.get_fname(name), mode)
             else:
-                f = h5py.File(os.path.join(self.temp_folder, fname), mode)
+                f = h5py.File(self.store.get_fname(name), mode)
             f.create_dataset('data', shape=shape, dtype=dtype)
             f.close()
         elif format == 'npy':
@@ -133,16 +401,16 @@ class Subproblem():
 
     def load_mmap(self, fname, mode='r', format='hdf5', collective=False):
         if format == 'hdf5':
-            if len(fname) < 3 or fname[-3:] != '.h5':
-                fname += '.h5'
+            name = self.get_variable_name(fname)
             if collective:
+                self.store.close_file(name)
                 try:
-                    f = h5py.File(os.path.join(self.temp_folder, fname), mode, driver='mpio', comm=comm)
+                    f = h5py.File(self.store.get_fname(name), mode, driver='mpio', comm=comm)
                 except:
-                    f = h5py.File(os.path.join(self.temp_folder, fname), mode)
+                    f = h5py.File(self.store.get_fname(name), mode)
+                var = f['data']
             else:
-                f = h5py.File(os.path.join(self.temp_folder, fname), mode)
-            var = f['data']
+                var = self.store.get_dataset(name, mode)
         elif format == 'npy':
             if len(fname) < 4 or fname[-4:] != '.npy':
                 fname += '.npy'
@@ -151,13 +419,30 @@ class Subproblem():
 
     def close_mmap(self, var, format='hdf5'):
         if format == 'hdf5':
-            var.file.close()
+            self.store.release_dataset(var)
         elif format == 'npy':
             del var
 
+    def sync_variables(self):
+        """
+        Make variables written by this rank visible to all ranks. This is a collective call.
+        """
+        self.store.sync()
+        comm.Barrier()
+
+    def publish_theta_variables(self, stage, i_theta, fname_ls, dest_rank_ls):
+        """
+        Make variables of one angle written by this rank visible to other ranks, and notify the ranks consuming
+        them through the scheduler. Used in place of sync_variables when subproblems are pipelined.
+        """
+        for fname in fname_ls:
+            self.store.close_file(self.get_variable_name(fname))
+        self.scheduler.notify(stage, i_theta, dest_rank_ls)
+
     def setup_temp_folder(self, output_folder):
         self.output_folder = output_folder
         self.temp_folder = os.path.join(output_folder, 'tmp')
+        self.store = get_variable_store(self.temp_folder)
         if rank == 0:
             if not os.path.exists(self.temp_folder):
                 os.makedirs(self.temp_folder)
@@ -233,6 +518,8 @@ class PhaseRetrievalSubproblem(Subproblem):
         self.randomize_probe_pos = randomize_probe_pos
         self.debug = debug
         self.probe_update_interval = probe_update_interval
+        # Number of inner iterations of the last call of solve.
+        self.n_iterations = None
         self.initialize_probe_ls = True
         self.is_checked_probe_latest = True
         self.raw_data_type = raw_data_type
@@ -240,7 +527,7 @@ class PhaseRetrievalSubproblem(Subproblem):
         self.probe_mag_scaler = probe_mag_scaler
 
     def initialize(self, probe_exit, probe_incident, prj, theta_ls=None, probe_pos=None, n_pos_ls=None, probe_pos_ls=None,
-                   output_folder='.'):
+                   output_folder='.', tile_storage_index=None):
         """
         Initialize solver.
 
@@ -258,6 +545,8 @@ class PhaseRetrievalSubproblem(Subproblem):
         :param n_pos_ls: None or List of numbers of probe positions for each angle.
         :param probe_pos_ls: List of probe position lists for all angles. If probe positions are common for all
                              angles, put None.
+        :param tile_storage_index: Array of Int or None. Storage index of each tile if the data were re-chunked.
+                                   See util.read_tiles.
         """
         print_flush('  PHR: Initializing...', 0, rank, **self.stdout_options)
         super(PhaseRetrievalSubproblem, self).initialize()
@@ -307,6 +596,7 @@ class PhaseRetrievalSubproblem(Subproblem):
         self.probe_size = probe_exit[0].shape[1:]
         self.n_probe_modes = probe_exit[0].shape[0]
         self.prj = prj
+        self.tile_storage_index = tile_storage_index
         if self.initialize_array_vars:
             self.optimizer.create_param_arrays(self.psi_theta_ls.shape, device=None)
         self.optimizer.set_index_in_grad_return(0)
@@ -356,6 +646,23 @@ class PhaseRetrievalSubproblem(Subproblem):
             rank_group_ls = np.reshape(theta_rank_ls, [-1]).tolist()
         return theta_rank_ls, rank_group_ls
 
+    def will_update_exiting_probes(self, n_iterations=None, n_calls_ahead=0):
+        """
+        Check whether exiting probes will be updated in a future call of solve, which needs x rotated to all angles.
+
+        :param n_iterations: Int. Number of inner iterations per call. Defaults to that of the last call.
+        :param n_calls_ahead: Int. Number of calls of solve before the checked one. 0 checks the next call.
+        """
+        if self.common_probe:
+            return False
+        if n_iterations is None:
+            n_iterations = self.n_iterations if self.n_iterations is not None else 1
+        i_iter_st = self.total_iter + n_calls_ahead * n_iterations
+        for i_iter in range(i_iter_st, i_iter_st + n_iterations):
+            if i_iter % self.probe_update_interval == self.probe_update_interval - 1 and i_iter > 0:
+                return True
+        return False
+
     def locate_theta_data(self, i_theta):
         """
         Find which rank has data of a certain theta, and the index of that theta in the rank's local list.
@@ -485,7 +792,7 @@ class PhaseRetrievalSubproblem(Subproblem):
 
     def get_data(self, this_i_theta, this_ind_batch, theta_downsample=None, ds_level=1):
         if theta_downsample is None: theta_downsample = 1
-        this_prj_batch = self.prj[this_i_theta * theta_downsample, this_ind_batch]
+        this_prj_batch = read_tiles(self.prj, this_i_theta * theta_downsample, this_ind_batch, self.tile_storage_index)
         this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
         if ds_level > 1:
             this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
@@ -621,6 +928,10 @@ class PhaseRetrievalSubproblem(Subproblem):
         """
         Precalculate multislice exiting waves [g(u)] and save for later use in this subproblem and the BKP subproblem.
 
+        Exiting wave tiles of an angle are gathered to the group leader with a non-blocking Gatherv on float32
+        buffers, and assembled into a preallocated full frame. Non-leader ranks do not wait for the leader to save
+        the frame, and move on to the next angle.
+
         :param bp_sp: Instance of BackpropSubproblem class.
         :param ri_variable: String. Can be 'u' or 'r_x'. Set the variable to get refractive indices from -
                             either u or r(x).
@@ -633,6 +944,15 @@ class PhaseRetrievalSubproblem(Subproblem):
             szw = bp_sp.safe_zone_width
             tile_shape = bp_sp.tile_shape
             tile_shape_padded = np.array(tile_shape) + 2 * szw
+            tile_size = tile_shape[0] * tile_shape[1] * 2
+            if my_local_rank == 0:
+                ex_tile_buf = np.zeros([n_ranks_per_angle, *tile_shape, 2], dtype='float32')
+                ex_full = np.zeros([self.whole_object_size[0], self.whole_object_size[1], 2], dtype='float32')
+                recv_buf = [ex_tile_buf, [tile_size] * n_ranks_per_angle,
+                            [i * tile_size for i in range(n_ranks_per_angle)], MPI.FLOAT]
+            else:
+                recv_buf = None
+            req = None
             for i, i_theta in enumerate(my_theta_ind_ls):
                 print_flush('  PHR: I-theta {} started.'.format(i_theta), 0, rank, 
                             **self.stdout_options)
@@ -649,28 +969,32 @@ class PhaseRetrievalSubproblem(Subproblem):
                 ex = w.stack([er, ei], axis=-1)[0]
                 ex = ex[szw:szw + tile_shape[0], szw:szw + tile_shape[1]]
 
-                # Save intermediate wavefield tiles for later use.
+                # Save intermediate wavefield tiles for later use. They are kept in memory by the variable store
+                # as long as its RAM budget allows.
                 psi1 = w.stack([w.stack(psir, axis=-1), w.stack(psii, axis=-1)], axis=-1)[0]
                 psi1 = psi1[szw:szw + tile_shape[0], szw:szw + tile_shape[1], :, :]
                 self.save_variable(psi1, 'psi1_{:05d}_{:04d}'.format(my_local_rank, i_theta))
 
-                # Group leader rank gathers exiting wave tiles in that angle.
-                if my_local_rank == 0:
-                    ex_ls = [ex]
-                    for i_tile in range(1, bp_sp.ranks_per_angle):
-                        ex_ls.append(comm.recv(source=i_tile + my_group * n_ranks_per_angle))
-                else:
-                    comm.send(ex, dest=rank // bp_sp.ranks_per_angle)
+                # Group leader rank gathers exiting wave tiles in that angle. The send buffer of the previous angle
+                # is released only after its gather completes.
+                if req is not None:
+                    req.Wait()
+                ex_send_buf = np.ascontiguousarray(w.to_numpy(ex), dtype='float32')
+                req = bp_sp.local_comm.Igatherv(ex_send_buf, recv_buf, root=0)
 
                 # Group leader rank assembles exiting wave tiles.
                 if my_local_rank == 0:
-                    ex_full = w.zeros([self.whole_object_size[0], self.whole_object_size[1], 2])
-                    for i_tile, ex in enumerate(ex_ls):
+                    req.Wait()
+                    req = None
+                    for i_tile in range(n_ranks_per_angle):
                         line_st, px_st = bp_sp.get_tile_position(i_tile)
                         line_end = min([self.whole_object_size[0], line_st + tile_shape[0]])
                         px_end = min([self.whole_object_size[1], px_st + tile_shape[1]])
-                        ex_full[line_st:line_end, px_st:px_end, :] = ex[:line_end - line_st, :px_end - px_st, :]
-                    self.save_variable(ex_full, 'g_{}_{:04d}'.format(ri_variable, i_theta))
+                        ex_full[line_st:line_end, px_st:px_end, :] = \
+                            ex_tile_buf[i_tile, :line_end - line_st, :px_end - px_st, :]
+                    self.save_variable(ex_full, 'g_{}_{:04d}'.format(ri_variable, i_theta), to_numpy=False)
+            if req is not None:
+                req.Wait()
         print_flush('  Done.', 0, rank, **self.stdout_options)
 
     def solve(self, n_iterations=5):
@@ -678,6 +1002,7 @@ class PhaseRetrievalSubproblem(Subproblem):
 
         :param n_iterations: Int. Number of inner iterations.
         """
+        self.n_iterations = n_iterations
         self.last_iter_part1_loss = 0
         self.last_iter_part2_loss = 0
         grad_psi = w.zeros_like(self.psi_theta_ls[0], requires_grad=False, device=self.device)
@@ -690,7 +1015,7 @@ class PhaseRetrievalSubproblem(Subproblem):
         else:
             bp_sp = self.next_sp.next_sp
         self.update_g_u(bp_sp)
-        comm.Barrier()
+        self.sync_variables()
 
         common_probe_pos = True if self.probe_pos_ls is None else False
         if common_probe_pos:
@@ -832,8 +1157,18 @@ class PhaseRetrievalSubproblem(Subproblem):
         # self.last_iter_part2_loss /= n_theta
         # Dump psi to HDD.
         for i, i_theta in enumerate(self.theta_ind_ls_local):
-            self.save_variable(self.psi_theta_ls[i], 'psi_{:04d}'.format(i_theta))
-        comm.Barrier()
+            if self.scheduler is None:
+                self.save_variable(self.psi_theta_ls[i], 'psi_{:04d}'.format(i_theta))
+            elif self.locate_theta_data(i_theta)[0] == rank:
+                # Ranks of an angle group hold the same psi. Without the barrier of sync_variables, only the leader
+                # writes it, so that consumers notified by the leader never see a file being written by another rank.
+                self.save_variable(self.psi_theta_ls[i], 'psi_{:04d}'.format(i_theta))
+                self.publish_theta_variables('psi', i_theta, ['psi_{:04d}'.format(i_theta)],
+                                             self.next_sp.get_ranks_of_theta(i_theta))
+        if self.scheduler is None:
+            self.sync_variables()
+        else:
+            self.store.sync()
 
     def get_patches(self, psi, this_pos_batch_int):
         """
@@ -1112,25 +1447,27 @@ class AlignmentSubproblem(Subproblem):
         assert isinstance(self.prev_sp, PhaseRetrievalSubproblem)
         self._psi_theta_ls_local = []
         for i_local, i_theta in enumerate(self.theta_ind_ls_local):
+            if self.scheduler is not None:
+                self.scheduler.wait('psi', i_theta, self.prev_sp.locate_theta_data(i_theta)[0])
             psi = self.load_variable('psi_{:04d}'.format(i_theta), create_variable=False)
             self._psi_theta_ls_local.append(psi)
+        if len(self._psi_theta_ls_local) > 0:
+            self._psi_theta_ls_local = w.create_variable(np.stack(self._psi_theta_ls_local), requires_grad=False,
+                                                         device=self.device)
 
     def forward(self, psi_ls, shift_ls):
         """
-        Operator t.
+        Operator t. All images are shifted with one batched FFT.
 
         :param w_ls: Tensor in [n_batch, y, x, 2].
         :param shift_ls: List of (y, x) shifts matching the length of w_ls. In shape [n_batch, 2].
         :return: Shifted w.
         """
-        w_ls = []
-        for i, psi in enumerate(psi_ls):
-            shift = shift_ls[i]
-            psi_r, psi_i = w.split_channel(psi)
-            w_r, w_i = realign_image_fourier(psi_r, psi_i, -shift, axes=(0, 1), device=self.device)
-            w_ = w.stack([w_r, w_i], axis=-1)
-            w_ls.append(w_)
-        w_ls = w.stack(w_ls)
+        if isinstance(shift_ls, (list, tuple)):
+            shift_ls = w.stack(shift_ls)
+        psi_r, psi_i = w.split_channel(psi_ls)
+        w_r, w_i = realign_image_fourier_batch(psi_r, psi_i, -shift_ls, device=self.device)
+        w_ls = w.stack([w_r, w_i], axis=-1)
         return w_ls
 
     def get_loss(self, w_ls, u_ls, psi_ls, lambda1_ls, lambda2_ls):
@@ -1171,13 +1508,15 @@ class AlignmentSubproblem(Subproblem):
 
         assert isinstance(self.prev_sp, PhaseRetrievalSubproblem)
         self.prev_sp.update_g_u(self.next_sp, ri_variable='r_x')
+        self.sync_variables()
         self.update_psi_data()
-        for i, i_theta in enumerate(list(range(rank, self.n_theta, n_ranks))):
-            g_r_x = self.load_variable('g_r_x_{:04d}'.format(i_theta))
-            psi = self._psi_theta_ls_local[i]
-            # Register with phase correlation
-            shifts = phase_correlation(psi, g_r_x, upsample_factor=10)
-            self.shift_params[i_theta, :] = shifts
+        self.shift_params = w.zeros([self.n_theta, 2], device=self.device)
+        if len(self.theta_ind_ls_local) > 0:
+            g_r_x_ls = w.stack([self.load_variable('g_r_x_{:04d}'.format(i_theta))
+                                for i_theta in self.theta_ind_ls_local])
+            psi_ls = self._psi_theta_ls_local
+            # Register all local angles with batched phase correlation
+            self.shift_params[self.theta_ind_ls_local] = phase_correlation_batch(psi_ls, g_r_x_ls, upsample_factor=10)
         self.shift_params = comm.allreduce(self.shift_params)
 
     def solve(self, n_iterations=3):
@@ -1192,31 +1531,29 @@ class AlignmentSubproblem(Subproblem):
         # Solve for alignment parameters
         self.solve_alignment_params()
 
-        # Solve for w
-        for i_iteration in range(n_iterations):
-            for i, i_theta in enumerate(self.theta_ind_ls_local):
-                print_flush('  ALN: Iter {}, theta {} started.'.format(i_iteration, i),
-                            0, rank, **self.stdout_options)
-                g_u_ls = self.load_variable('g_u_{:04d}'.format(i_theta))[None]
-                psi_ls = self._psi_theta_ls_local[i][None]
-                lambda1_ls = self.lambda1_theta_ls_local[i][None]
-                lambda2_ls = self.load_variable('lambda2_{:04d}'.format(i_theta))[None]
-                shift_ls = self.shift_params[i_theta][None]
+        # Solve for w. All local angles are stacked and updated together.
+        if len(self.theta_ind_ls_local) > 0:
+            g_u_ls = w.stack([self.load_variable('g_u_{:04d}'.format(i_theta)) for i_theta in self.theta_ind_ls_local])
+            lambda2_ls = w.stack([self.load_variable('lambda2_{:04d}'.format(i_theta))
+                                  for i_theta in self.theta_ind_ls_local])
+            psi_ls = self._psi_theta_ls_local
+            shift_ls = self.shift_params[self.theta_ind_ls_local]
+            for i_iteration in range(n_iterations):
+                print_flush('  ALN: Iter {} started.'.format(i_iteration), 0, rank, **self.stdout_options)
 
                 # Step 1: Get w by shifting psi (solves part 1 of the subproblem loss)
                 w_ls = self.forward(psi_ls, shift_ls)
 
                 # Step 2: Update part 2 of the subproblem loss
-                loss_func_args = {'w_ls': w_ls, 'g_u_ls': g_u_ls, 'psi_ls': psi_ls, 'lambda1_ls': lambda1_ls,
-                                  'lambda2_ls': lambda2_ls}
+                loss_func_args = {'w_ls': w_ls, 'g_u_ls': g_u_ls, 'psi_ls': psi_ls,
+                                  'lambda1_ls': self.lambda1_theta_ls_local, 'lambda2_ls': lambda2_ls}
                 self.optimizer.forward_model.update_loss_args(loss_func_args)
 
                 grad, this_part2_loss = self.get_grad(**loss_func_args)
                 self.optimizer.forward_model.current_loss = this_part2_loss
                 w_ls = self.optimizer.apply_gradient(w_ls, w.cast(grad, 'float32'), i_batch=self.total_iter,
-                                                     params_slicer=[slice(i_theta, i_theta + 1)],
-                                                     **self.optimizer.options_dict)
-                self.w_theta_ls_local[i] = w_ls[0]
+                                                     params_slicer=(slice(None),), **self.optimizer.options_dict)
+                self.w_theta_ls_local = w_ls
                 if i_iteration == n_iterations - 1:
                     # self.last_iter_part1_loss = self.last_iter_part1_loss + this_part1_loss
                     self.last_iter_part2_loss = self.last_iter_part2_loss + this_part2_loss
@@ -1228,9 +1565,22 @@ class AlignmentSubproblem(Subproblem):
         for i, i_theta in enumerate(self.theta_ind_ls_local):
             self.save_variable(w.to_numpy(self.w_theta_ls_local[i]), 'w_{:04d}'.format(i_theta))
             self.save_variable(w.to_numpy(self.lambda1_theta_ls_local[i]), 'lambda1_{:04d}'.format(i_theta))
+            if self.scheduler is not None:
+                self.publish_theta_variables('w', i_theta, ['w_{:04d}'.format(i_theta)],
+                                             self.next_sp.get_ranks_of_theta(i_theta))
+        if self.scheduler is None:
+            self.sync_variables()
+        else:
+            self.store.sync()
+
+    def get_ranks_of_theta(self, i_theta):
+        """
+        Get the ranks that solve the subproblem at angle i_theta.
+        """
+        return [i_theta % n_ranks]
 
     def update_dual(self):
-        local_shifts = [self.shift_params[i_theta] for i_theta in self.theta_ind_ls_local]
+        local_shifts = self.shift_params[self.theta_ind_ls_local]
         r = (self._psi_theta_ls_local - self.forward(self.w_theta_ls_local, local_shifts))
         self.lambda1_theta_ls_local = self.lambda1_theta_ls_local + self.rho * r
         rr, ri = w.split_channel(r)
@@ -1239,6 +1589,7 @@ class AlignmentSubproblem(Subproblem):
         # Dump lambda1 data
         for i, i_theta in enumerate(self.theta_ind_ls_local):
             self.save_variable(w.to_numpy(self.lambda1_theta_ls_local[i]), 'lambda1_{:04d}'.format(i_theta))
+        self.sync_variables()
 
         self.update_rho()
 
@@ -1277,6 +1628,7 @@ class BackpropSubproblem(Subproblem):
                            int(np.ceil(self.whole_object_size[1] / n_tiles_x))]
         self.tile_shape_padded = [i + 2 * self.safe_zone_width for i in self.tile_shape]
         self.debug = debug
+        self._r_x_ls_local_prefetched = None
 
     def initialize(self, theta_ls=None, output_folder=None):
         """
@@ -1324,6 +1676,7 @@ class BackpropSubproblem(Subproblem):
             self.optimizer.create_param_arrays([self.n_theta_local, *self.tile_shape, self.whole_object_size[2], 2],
                                            device=None)
         self.optimizer.set_index_in_grad_return(0)
+        self.sync_variables()
 
     def locate_theta_data(self, i_theta):
         """
@@ -1368,21 +1721,63 @@ class BackpropSubproblem(Subproblem):
         """
         self._psi_theta_ls_local = []
         for i_local, i_theta in enumerate(self.theta_ind_ls_local):
+            if self.scheduler is not None:
+                self.scheduler.wait('psi', i_theta, self.prev_sp.locate_theta_data(i_theta)[0])
             psi = self.load_variable('psi_{:04d}'.format(i_theta), create_variable=False)
             self._psi_theta_ls_local.append(psi)
 
-    def update_x_data(self, dump_rotated_x=False, use_mpi=True):
+    def get_ranks_of_theta(self, i_theta):
+        """
+        Get the ranks that solve the subproblem at angle i_theta, i.e., all ranks of the group of that angle.
+        """
+        t_rank, _ = self.locate_theta_data(i_theta)
+        return list(range(t_rank, t_rank + self.ranks_per_angle))
+
+    def prefetch_x_data(self):
+        """
+        Compute r(x) for the next call of solve. This is meant to be called right after the TMO subproblem is
+        solved, so that the collective exchange of x is done before BKP starts working on angles handed over
+        by the previous subproblem one by one. r(x) used by the other subproblems in the meantime is kept. Nothing
+        is done if x rotated to all angles needs to be dumped for PHR, which expects the dump at its usual place.
+        This is a collective call.
+        """
+        # The prefetched r(x) is used by BKP after the next PHR call, and its dump would be read by the call after.
+        if self.get_phr_subproblem().will_update_exiting_probes(n_calls_ahead=1):
+            return
+        r_x_ls_local = getattr(self, '_r_x_ls_local', [])
+        self.update_x_data(rotate_locally=True)
+        self._r_x_ls_local_prefetched = self._r_x_ls_local
+        self._r_x_ls_local = r_x_ls_local
+
+    def get_phr_subproblem(self):
+        if isinstance(self.prev_sp, PhaseRetrievalSubproblem):
+            return self.prev_sp
+        else:
+            return self.prev_sp.prev_sp
+
+    def update_x_data(self, dump_rotated_x=False, use_mpi=True, rotate_locally=False):
         """
         Update r(x) tile from distributedly stored x in the TMO subproblem.
+
+        :param dump_rotated_x: Whether to save x rotated to all angles in files, which are read by the PHR
+                               subproblem when updating exiting probes.
+        :param use_mpi: Whether to send r(x) tiles among ranks using MPI. If False, tiles are read from the dumped
+                        x files. Ignored if rotate_locally is True.
+        :param rotate_locally: If True, each rank gathers the rows of x covering its tile, and rotates them only for
+                               its own angles and tile region. x is rotated to all angles only if dump_rotated_x is
+                               True.
         """
         assert isinstance(self.next_sp, TomographySubproblem)
         tile_y, tile_x = self.get_tile_position(self.local_rank)
 
-        if not use_mpi:
+        if rotate_locally:
+            use_mpi = False
+        elif not use_mpi:
             dump_rotated_x = True
 
         self._r_x_ls_local = []
-        for i_theta, theta in enumerate(self.theta_ls):
+        theta_ls_full_rotation = self.theta_ls if (dump_rotated_x or use_mpi) else []
+        for i_theta, theta in enumerate(theta_ls_full_rotation):
             coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*self.whole_object_size, len(self.theta_ls)),
                                           self.theta_ls[i_theta], reverse=False)
             self.next_sp.x.rotate_array(coord_ls, overwrite_arr=False, override_backend='autograd', override_device='cpu')
@@ -1420,13 +1815,76 @@ class BackpropSubproblem(Subproblem):
                 if rank >= t_rank and rank < t_rank + self.ranks_per_angle:
                     self._r_x_ls_local.append(x[0])
 
-        if not use_mpi:
+        if rotate_locally:
+            self._r_x_ls_local = self.rotate_x_tiles_locally()
+        elif not use_mpi:
             for i_theta in self.theta_ind_ls_local:
                 x_mmap = self.load_mmap('x_{:04d}'.format(i_theta), collective=False)
                 x = self.prepare_u_tile(x_mmap, self.local_rank, on_ram=True)
                 self.close_mmap(x_mmap)
                 self._r_x_ls_local.append(x)
 
+    def get_tile_range(self, i_tile):
+        """
+        Get the range of lines and pixels of a tile padded with the safe zone, clipped by the object boundary.
+
+        :return: (line_st, line_end, px_st, px_end).
+        """
+        tile_y, tile_x = self.get_tile_position(i_tile)
+        line_st = max([0, tile_y - self.safe_zone_width])
+        line_end = min([self.whole_object_size[0], tile_y + self.tile_shape[0] + self.safe_zone_width])
+        px_st = max([0, tile_x - self.safe_zone_width])
+        px_end = min([self.whole_object_size[1], tile_x + self.tile_shape[1] + self.safe_zone_width])
+        return line_st, line_end, px_st, px_end
+
+    def gather_x_rows(self):
+        """
+        Gather the lines of x in the TMO subproblem that cover the tile of the current rank from the ranks holding
+        them. This is a collective call.
+
+        :return: Array of lines line_st:line_end of x, or None if the current rank has no tile.
+        """
+        slice_range_local = self.next_sp.slice_range_local
+        send_ls = []
+        for i_rank in range(n_ranks):
+            rows = None
+            if i_rank // self.ranks_per_angle < self.n_groups and slice_range_local is not None:
+                line_st, line_end = self.get_tile_range(i_rank % self.ranks_per_angle)[:2]
+                line_st = max([line_st, slice_range_local[0]])
+                line_end = min([line_end, slice_range_local[1]])
+                if line_end > line_st:
+                    rows = self.next_sp.x.arr[line_st - slice_range_local[0]:line_end - slice_range_local[0]]
+            send_ls.append(rows)
+        recv_ls = comm.alltoall(send_ls)
+        if self.group_ind == -1:
+            return None
+        # Slabs of x are ordered by rank.
+        return np.concatenate([rows for rows in recv_ls if rows is not None], axis=0)
+
+    def rotate_x_tiles_locally(self):
+        """
+        Get r(x) tiles of the angles of the current rank by rotating only the lines and pixels covered by its tile.
+        This is a collective call.
+
+        :return: List of padded r(x) tiles.
+        """
+        x_rows = self.gather_x_rows()
+        r_x_ls = []
+        if x_rows is None:
+            return r_x_ls
+        tile_y, tile_x = self.get_tile_position(self.local_rank)
+        px_st, px_end = self.get_tile_range(self.local_rank)[2:]
+        for i_theta in self.theta_ind_ls_local:
+            coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*self.whole_object_size, len(self.theta_ls)),
+                                          self.theta_ls[i_theta], reverse=False)
+            x = apply_rotation_to_region(x_rows, coord_ls, [px_st, px_end])
+            x = w.create_constant(x, device=None)
+            x, _ = pad_object_edge(x, self.whole_object_size,
+                                   np.array([[tile_y - self.safe_zone_width, tile_x - self.safe_zone_width]]),
+                                   self.tile_shape_padded)
+            r_x_ls.append(x)
+        return r_x_ls
+
     def get_my_batch(self):
         """
         Get group index and the list of theta indices to be processed for the current rank.
@@ -1599,10 +2057,7 @@ class BackpropSubproblem(Subproblem):
         :return: processed u tile.
         """
         tile_y, tile_x = self.get_tile_position(my_local_rank)
-        line_st = max([0, tile_y - self.safe_zone_width])
-        line_end = min([self.whole_object_size[0], tile_y + self.tile_shape[0] + self.safe_zone_width])
-        px_st = max([0, tile_x - self.safe_zone_width])
-        px_end = min([self.whole_object_size[1], tile_x + self.tile_shape[1] + self.safe_zone_width])
+        line_st, line_end, px_st, px_end = self.get_tile_range(my_local_rank)
         u = u_mmap[line_st:line_end, px_st:px_end, :, :]
         d = None if on_ram else self.device
         u = w.create_constant(u, device=d)
@@ -1620,10 +2075,7 @@ class BackpropSubproblem(Subproblem):
         :return: processed u tile.
         """
         tile_y, tile_x = self.get_tile_position(my_local_rank)
-        line_st = max([0, tile_y - self.safe_zone_width])
-        line_end = min([self.whole_object_size[0], tile_y + self.tile_shape[0] + self.safe_zone_width])
-        px_st = max([0, tile_x - self.safe_zone_width])
-        px_end = min([self.whole_object_size[1], tile_x + self.tile_shape[1] + self.safe_zone_width])
+        line_st, line_end, px_st, px_end = self.get_tile_range(my_local_rank)
         u = arr[line_st:line_end, px_st:px_end, :]
         u = w.create_variable(u, requires_grad=False, device=self.device)
         u, _ = pad_object_edge(u[:, :, None, :], self.whole_object_size,
@@ -1633,18 +2085,20 @@ class BackpropSubproblem(Subproblem):
         return u
 
     def solve(self, n_iterations=3):
+        # Dump x at various angles only if they are needed for updating exiting probes in the next PHR iterations.
+        phr_sp = self.get_phr_subproblem()
+        assert isinstance(phr_sp, PhaseRetrievalSubproblem)
+        if self._r_x_ls_local_prefetched is not None:
+            self._r_x_ls_local = self._r_x_ls_local_prefetched
+            self._r_x_ls_local_prefetched = None
+        else:
+            print_flush('  BKP: Updating x data...', 0, rank, *self.stdout_options)
+            flag_dump_x = phr_sp.will_update_exiting_probes()
+            self.update_x_data(dump_rotated_x=flag_dump_x, rotate_locally=True)
+
         print_flush('  BKP: Updating psi data...', 0, rank, *self.stdout_options)
         if isinstance(self.prev_sp, PhaseRetrievalSubproblem):
             self.update_psi_data()
-            phr_sp = self.prev_sp
-        else:
-            phr_sp = self.prev_sp.prev_sp
-
-        # Dump x at various angles right before exiting probes are updated in PHR
-        print_flush('  BKP: Updating x data...', 0, rank, *self.stdout_options)
-        assert isinstance(phr_sp, PhaseRetrievalSubproblem)
-        flag_dump_x = (phr_sp.total_iter % phr_sp.probe_update_interval == (phr_sp.probe_update_interval - 1))
-        self.update_x_data(dump_rotated_x=flag_dump_x, use_mpi=False)
 
         self.last_iter_part1_loss = 0
         self.last_iter_part2_loss = 0
@@ -1662,6 +2116,8 @@ class BackpropSubproblem(Subproblem):
                 lambda3_ls = self.prepare_u_tile(lambda3_mmap, self.local_rank)[None]
                 theta = self.theta_ls[i_theta]
                 if isinstance(self.prev_sp, AlignmentSubproblem):
+                    if self.scheduler is not None:
+                        self.scheduler.wait('w', i_theta, self.prev_sp.get_ranks_of_theta(i_theta)[0])
                     w_ls = self.load_variable('w_{:04d}'.format(i_theta))[None]
                     loss_func_args = {'u_ls': u_ls, 'w_ls': w_ls, 'r_x': r_x, 'lambda2_ls': lambda2_ls,
                                       'lambda3_ls': lambda3_ls}
@@ -1711,6 +2167,7 @@ class BackpropSubproblem(Subproblem):
                 except:
                     del w_ls
             self.update_iter_and_epoch_count(n_iterations)
+        self.sync_variables()
         # self.last_iter_part1_loss = self.last_iter_part1_loss / n_theta
         # self.last_iter_part2_loss = self.last_iter_part2_loss / n_theta
 
@@ -1746,18 +2203,22 @@ class BackpropSubproblem(Subproblem):
             rr, ri = w.split_channel(this_r)
             self.rsquare = self.rsquare + w.mean(rr ** 2 + ri ** 2)
         self.rsquare = self.rsquare / self.n_theta
+        self.sync_variables()
         self.update_rho()
 
 
 class TomographySubproblem(Subproblem):
     def __init__(self, whole_object_size, rho=1., optimizer=None, device=None, n_all2all_split='auto',
-                 debug=False, filter='hamming', rho_schedule=None, stdout_options={}):
+                 debug=False, filter='hamming', n_angles_per_batch=1, rho_schedule=None, stdout_options={}):
         """
         Tomography subproblem solver.
 
         :param whole_object_size: 3D shape of the object to be reconstructed.
         :param device: Device object.
         :param rho: Weight of Lagrangian term.
+        :param n_angles_per_batch: Int. Number of angles whose residuals are combined in each update of x. If more
+                                   than 1, each batch is rotated forward and back with one sparse rotation matrix,
+                                   and filtered with one call of the tomography filter.
         """
         super(TomographySubproblem, self).__init__(device, rho_schedule)
         self.whole_object_size = whole_object_size
@@ -1773,6 +2234,7 @@ class TomographySubproblem(Subproblem):
         self.stdout_options = stdout_options
         self.filter = filter
         self.debug = debug
+        self.n_angles_per_batch = n_angles_per_batch
 
     def initialize(self, theta_ls=None, output_folder='.'):
         """
@@ -1802,6 +2264,7 @@ class TomographySubproblem(Subproblem):
             self.optimizer.create_container([*self.whole_object_size, 2], use_checkpoint=False, device_obj=None)
         self.optimizer.distribution_mode = 'distributed_object'
         self.optimizer.set_index_in_grad_return(0)
+        self.sync_variables()
 
     def forward(self, x, theta, reverse=False):
         # return w.rotate(x, theta, axis=0, device=None)
@@ -1853,10 +2316,117 @@ class TomographySubproblem(Subproblem):
                                    'lambda3_{}_{}'.format(self.i_epoch, self.this_i_theta))
         return grad, this_loss
 
+    def get_rotation_matrix(self, i_theta_ls):
+        """
+        Get the sparse rotation matrix of a batch of angles. See util.get_rotation_matrix.
+        """
+        coord_ls = [read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*self.whole_object_size, self.n_theta),
+                                       self.theta_ls[i_theta], reverse=False) for i_theta in i_theta_ls]
+        return get_rotation_matrix(coord_ls, self.whole_object_size[1:3])
+
+    def forward_batch(self, x, rot_mat, reverse=False):
+        """
+        Operator r for a batch of angles.
+
+        :param x: Tensor in [y, x, z, 2]. If reverse is True, a stack of such tensors for all angles of the batch.
+        :param rot_mat: Sparse rotation matrix returned by get_rotation_matrix.
+        :param reverse: If True, apply the transpose of the rotations and sum over angles.
+        :return: Tensor in [n_angles, y, x, z, 2], or in [y, x, z, 2] if reverse is True.
+        """
+        x = w.to_numpy(x)
+        s = x.shape
+        if not reverse:
+            x = np.reshape(np.transpose(x, [1, 2, 0, 3]), [s[1] * s[2], -1])
+            x = np.reshape(rot_mat @ x, [-1, s[1], s[2], s[0], s[3]])
+            x = np.transpose(x, [0, 3, 1, 2, 4])
+        else:
+            x = np.reshape(np.transpose(x, [0, 2, 3, 1, 4]), [s[0] * s[2] * s[3], -1])
+            x = np.reshape(rot_mat.T @ x, [s[2], s[3], s[1], s[4]])
+            x = np.transpose(x, [2, 0, 1, 3])
+        return w.create_variable(x.astype('float32'), requires_grad=False, device=None)
+
+    def get_grad_batch(self, x, u_ls, lambda3_ls, rot_mat):
+        """
+        Get the gradient of the loss summed over a batch of angles.
+
+        :param u_ls: Tensor in [n_angles, y, x, z, 2].
+        :param lambda3_ls: Tensor in [n_angles, y, x, z, 2].
+        """
+        grad = u_ls - self.forward_batch(x, rot_mat) + lambda3_ls / self.rho
+        grad_delta, grad_beta = w.split_channel(grad)
+        this_loss = w.sum(grad_delta ** 2 + grad_beta ** 2) * self.rho
+        if self.filter is not None:
+            grad = w.tomography_filter(grad, axis=2, filter_type=self.filter)
+        grad = self.forward_batch(grad, rot_mat, reverse=True)
+        grad = -self.rho * grad
+
+        # Discard beta if gradient is abnormally large.
+        grid_delta, grid_beta = w.split_channel(grad)
+        if w.max(w.abs(grid_beta)) > 1e1 or w.isnan(w.max(w.abs(grid_beta), return_number=False)):
+            warnings.warn('TMO beta anomalies detected at epoch {} (rank {}).'.format(self.i_epoch, rank))
+            grid_beta[...] = 0
+        grad = w.stack([grid_delta, grid_beta], axis=-1)
+        return grad, this_loss
+
+    def load_slab_batch(self, fname_pattern, i_theta_ls):
+        """
+        Read the local slab of a variable of a batch of angles.
+
+        :return: Tensor in [n_angles, y, x, z, 2].
+        """
+        slab_ls = []
+        for i_theta in i_theta_ls:
+            mmap = self.load_mmap(fname_pattern.format(i_theta))
+            slab_ls.append(mmap[self.slice_range_local[0]:self.slice_range_local[1]])
+            self.close_mmap(mmap)
+        return w.create_variable(np.stack(slab_ls), requires_grad=False, device=None)
+
+    def solve_batch(self, n_iterations=3):
+        theta_ind_ls = np.arange(self.n_theta).astype(int)
+        for i_iteration in range(n_iterations):
+            np.random.shuffle(theta_ind_ls)
+            for i_batch in range(0, self.n_theta, self.n_angles_per_batch):
+                i_theta_ls = theta_ind_ls[i_batch:i_batch + self.n_angles_per_batch]
+                print_flush('  TMO: Iter {}, batch {} started.'.format(i_iteration, i_batch // self.n_angles_per_batch),
+                            0, rank, **self.stdout_options)
+                u_ls = self.load_slab_batch('u_{:04d}', i_theta_ls)
+                lambda3_ls = self.load_slab_batch('lambda3_{:04d}', i_theta_ls)
+                rot_mat = self.get_rotation_matrix(i_theta_ls)
+                x = w.create_variable(self.x.arr, requires_grad=False, device=None)
+                grad, this_loss = self.get_grad_batch(x, u_ls, lambda3_ls, rot_mat)
+                self.optimizer.forward_model.current_loss = this_loss
+                x = self.optimizer.apply_gradient(x, w.cast(grad, 'float32'), i_batch=self.total_iter,
+                                                  **self.optimizer.options_dict)
+                self.x.arr = w.to_numpy(x)
+                del u_ls, lambda3_ls, x
+                if i_iteration == n_iterations - 1:
+                    self.last_iter_part1_loss = self.last_iter_part1_loss + this_loss
+            self.update_iter_and_epoch_count(n_iterations)
+
+    def update_dual_batch(self):
+        theta_ind_ls = np.arange(self.n_theta).astype(int)
+        x = w.create_variable(self.x.arr, requires_grad=False, device=None)
+        for i_batch in range(0, self.n_theta, self.n_angles_per_batch):
+            i_theta_ls = theta_ind_ls[i_batch:i_batch + self.n_angles_per_batch]
+            u_ls = self.load_slab_batch('u_{:04d}', i_theta_ls)
+            this_r = u_ls - self.forward_batch(x, self.get_rotation_matrix(i_theta_ls))
+            rr, ri = w.split_channel(this_r)
+            self.rsquare = self.rsquare + w.sum(w.mean(w.reshape(rr ** 2 + ri ** 2, [len(i_theta_ls), -1]), axis=1))
+            # Read and write lambda3 in the same pass.
+            for i, i_theta in enumerate(i_theta_ls):
+                lambda3_mmap = self.load_mmap('lambda3_{:04d}'.format(i_theta), mode='r+')
+                lambda3 = lambda3_mmap[self.slice_range_local[0]:self.slice_range_local[1]]
+                lambda3 = lambda3 + w.to_numpy(self.rho * this_r[i])
+                lambda3_mmap[self.slice_range_local[0]:self.slice_range_local[1]] = lambda3
+                self.close_mmap(lambda3_mmap)
+            del u_ls, this_r
+
     def solve(self, n_iterations=3):
         self.last_iter_part1_loss = 0
         theta_ind_ls = np.arange(self.n_theta).astype(int)
-        if self.slice_range_local is not None:
+        if self.slice_range_local is not None and self.n_angles_per_batch > 1:
+            self.solve_batch(n_iterations)
+        elif self.slice_range_local is not None:
             for i_iteration in range(n_iterations):
                 np.random.shuffle(theta_ind_ls)
                 for i, i_theta in enumerate(theta_ind_ls):
@@ -1898,10 +2468,14 @@ class TomographySubproblem(Subproblem):
                         self.last_iter_part1_loss = self.last_iter_part1_loss + this_loss
                 self.update_iter_and_epoch_count(n_iterations)
             # self.last_iter_part1_loss = self.last_iter_part1_loss / n_theta
+        self.sync_variables()
 
     def update_dual(self):
         self.rsquare = 0
-        if self.slice_range_local is not None:
+        if self.slice_range_local is not None and self.n_angles_per_batch > 1:
+            self.update_dual_batch()
+            self.rsquare = self.rsquare / self.n_theta
+        elif self.slice_range_local is not None:
             for i_theta, theta in enumerate(self.theta_ls):
                 u_mmap = self.load_mmap('u_{:04d}'.format(i_theta))
                 u = u_mmap[self.slice_range_local[0]:self.slice_range_local[1]]
@@ -1919,6 +2493,7 @@ class TomographySubproblem(Subproblem):
                 self.close_mmap(lambda3_mmap)
                 del u, lambda3
             self.rsquare = self.rsquare / self.n_theta
+        self.sync_variables()
         self.update_rho()
 
 
@@ -2018,6 +2593,10 @@ def reconstruct_ptychography(
         # of rotation operations if minibatch_size < n_tiles_per_angle, but object can be updated once only after
         # all tiles on an angle are processed. Also this will save the object-sized gradient array in GPU memory
         # or RAM depending on current device setting.
+        variable_ram_budget_mb=1024, # RAM of each rank for keeping ADMM variables in memory. See VariableStore.
+        max_open_variable_files=64, # Maximum number of variable files each rank keeps open.
+        pipeline_subproblems=False, # If True, PHR, ALN and BKP hand over variables angle by angle instead of
+        # waiting for each other at global barriers. See AngleScheduler.
         # _________________________
         # |Other optimizer options|_____________________________________________
         optimize_probe=False, probe_learning_rate=1e-5, optimizer_probe=None,
@@ -2053,6 +2632,8 @@ def reconstruct_ptychography(
     rank = comm.Get_rank()
     t_zero = time.time()
     global_settings.backend = backend
+    # Number of threads used by the FFT of Autograd backend.
+    w.configure_fft(core_parallelization, n_ranks=n_ranks)
     device_obj = None if cpu_only else gpu_index
     device_obj = w.get_device(device_obj)
     w.set_device(device_obj)
@@ -2127,6 +2708,14 @@ def reconstruct_ptychography(
     else:
         probe_pos = np.array(probe_pos).astype(float)
 
+    # Storage order of tiles if the data were re-chunked with tools/rechunk_adorym_data.py.
+    tile_storage_index = None
+    if 'metadata/spot_permutation' in f:
+        if not common_probe_pos or len(f['metadata/spot_permutation']) != len(probe_pos):
+            raise ValueError('Tiles in {} are re-chunked, which requires common probe positions matching '
+                             'metadata/spot_permutation.'.format(fname))
+        tile_storage_index = np.argsort(f['metadata/spot_permutation'][...])
+
     # Energy.
     if energy_ev is None:
         energy_ev = float(f['metadata/energy_ev'][...])
@@ -2327,6 +2916,9 @@ def reconstruct_ptychography(
         assert isinstance(sp_bkp, BackpropSubproblem)
         assert isinstance(sp_tmo, TomographySubproblem)
 
+        get_variable_store(os.path.join(output_folder, 'tmp'), ram_budget_mb=variable_ram_budget_mb,
+                           max_open_files=max_open_variable_files)
+
         i_starting_epoch = 0
         if use_checkpoint:
             sp_phr.load_checkpoint(output_folder)
@@ -2338,18 +2930,28 @@ def reconstruct_ptychography(
 
         sp_phr.raw_data_type = raw_data_type
         sp_phr.initialize(probe_exit=[probe_real_exit, probe_imag_exit], probe_incident=[probe_real, probe_imag],
-                          prj=prj, theta_ls=theta_ls, probe_pos=probe_pos, output_folder=output_folder)
+                          prj=prj, theta_ls=theta_ls, probe_pos=probe_pos, output_folder=output_folder,
+                          tile_storage_index=tile_storage_index)
         if sp_aln is not None:
             sp_aln.initialize(theta_ls=theta_ls, output_folder=output_folder)
         sp_bkp.initialize(theta_ls=theta_ls, output_folder=output_folder)
         sp_tmo.initialize(theta_ls=theta_ls, output_folder=output_folder)
 
+        scheduler = None
+        if pipeline_subproblems:
+            scheduler = AngleScheduler(len(theta_ls))
+            for sp in [sp_phr, sp_aln, sp_bkp, sp_tmo]:
+                if sp is not None:
+                    sp.scheduler = scheduler
+
         # ================================================================================
         # Enter ADMM iterations.
         # ================================================================================
         for i_epoch in range(i_starting_epoch, n_epochs):
             t0 = time.time()
             t00 = time.time()
+            if scheduler is not None:
+                scheduler.new_epoch(i_epoch)
 
             # ####### DEBUG #######
             # ff = h5py.File('/home/beams/B282788/Data/programs/adorym_dev/demos/adhesin/data_adhesin_360_soft_4d.h5')
@@ -2423,6 +3025,10 @@ def reconstruct_ptychography(
             print_flush('TMO done in {} s. Loss: {}. Rho: {}.'.format(time.time() - t00, sp_tmo.last_iter_part1_loss,
                                                                        sp_tmo.rho),
                         sto_rank, rank, **stdout_options)
+            if scheduler is not None:
+                # Get r(x) of the next epoch while ranks are still in step, so that BKP does not need a collective
+                # exchange between receiving its first angles and working on them.
+                sp_bkp.prefetch_x_data()
 
             t00 = time.time()
             if sp_aln is not None:
@@ -2465,3 +3071,5 @@ def reconstruct_ptychography(
                     sp_aln.save_checkpoint(output_folder)
                 sp_bkp.save_checkpoint(output_folder)
                 sp_tmo.save_checkpoint(output_folder)
+
+        get_variable_store(os.path.join(output_folder, 'tmp')).close()
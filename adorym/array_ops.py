@@ -278,10 +278,47 @@ class Gradient(ObjectFunction):
         super(Gradient, self).__init__(obj.full_size, obj.distribution_mode,
                                  obj.output_folder, obj.dset, obj.object_type)
         self.forward_model = forward_model
+        self.touched_region = None
 
     def create_file_object(self):
         super(ObjectFunction, self).create_file_object('intermediate_grad.h5', use_checkpoint=False)
 
+    def reset_touched_region(self, shape, device=None):
+        """
+        Zero the gradient buffer for sparse accumulation. The buffer is allocated only once; afterwards,
+        only the region touched since the last reset is cleared since everything else is already zero.
+        """
+        if self.touched_region is None or self.arr is None or tuple(self.arr.shape) != tuple(shape):
+            del self.arr
+            self.arr = w.zeros(shape, requires_grad=False, device=device)
+        else:
+            self.arr[get_region_slicer(self.touched_region)] = 0
+        self.touched_region = None
+
+    def accumulate_in_region(self, grad, region):
+        """
+        Add the part of an object-sized gradient that falls in region to the buffer.
+
+        :param grad: Tensor. Object-sized gradient.
+        :param region: Array with shape [2, 2]. See util.get_region_of_windows.
+        """
+        ss = get_region_slicer(region)
+        self.arr[ss] = self.arr[ss] + grad[ss]
+        self.touched_region = merge_regions(self.touched_region, region)
+
+    def allreduce_touched_region(self):
+        """
+        Sum the gradient buffers of all ranks over the union of the regions touched by all ranks.
+        """
+        if n_ranks == 1:
+            return
+        r = np.array([-self.touched_region[0, 0], -self.touched_region[1, 0],
+                      self.touched_region[0, 1], self.touched_region[1, 1]])
+        r = comm.allreduce(r, op=MPI.MAX)
+        self.touched_region = np.array([[-r[0], r[2]], [-r[1], r[3]]])
+        ss = get_region_slicer(self.touched_region)
+        self.arr[ss] = comm.allreduce(self.arr[ss])
+
     def initialize_gradient_file(self, dtype='float32'):
         initialize_hdf5_with_constant(self.dset, rank, n_ranks, dtype=dtype)
 
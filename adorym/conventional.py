@@ -5,109 +5,269 @@ import adorym.wrappers as w
 
 
 def alt_reconstruction_epie(obj_real, obj_imag, probe_real, probe_imag, probe_pos, probe_pos_correction,
-                            prj, device_obj=None, minibatch_size=1, alpha=1., n_epochs=100, **kwargs):
+                            prj, device_obj=None, minibatch_size=1, alpha=1., n_epochs=100, variant='epie',
+                            probe_alpha=None, mpie_eta=0.9, optimize_probe=True, tile_storage_index=None, **kwargs):
     """
-    Reconstruct a 2D object and probe function using ePIE.
+    Reconstruct a 2D object and probe function using ePIE, rPIE or mPIE.
+
+    Positions are grouped into batches whose probe windows do not overlap (see util.get_non_overlapping_batches),
+    so that the modulus constraint is applied to a whole batch at once, and the object updates of a batch are
+    written back with a single scatter.
+
+    :param obj_real: Tensor with shape [y, x, z]. Only the first slice is reconstructed.
+    :param probe_real: Tensor with shape [n_modes, y, x]. Only the first mode is reconstructed.
+    :param minibatch_size: Int. Maximum number of positions in a batch.
+    :param alpha: Float. Object update step size for ePIE, or the regularization weight of rPIE/mPIE.
+    :param variant: String. Choose from 'epie', 'rpie' and 'mpie'.
+    :param probe_alpha: Float. The counterpart of alpha for the probe. If None, it is set to alpha.
+    :param mpie_eta: Float. Momentum of mPIE, which is applied to object and probe once every epoch.
+    :param tile_storage_index: Array of Int or None. Storage index of each tile if the data were re-chunked. See
+        util.read_tiles.
+    :return: Reconstructed obj_real, obj_imag, probe_real and probe_imag, shaped as inputs.
     """
+    assert variant in ['epie', 'rpie', 'mpie']
+    if probe_alpha is None:
+        probe_alpha = alpha
     with w.no_grad():
-        probe_real = probe_real[0]
-        probe_imag = probe_imag[0]
-        probe_pos = probe_pos.astype(int)
-        energy_ev = kwargs['energy_ev']
-        psize_cm = kwargs['psize_cm']
+        p_real = probe_real[0]
+        p_imag = probe_imag[0]
+        probe_pos = np.array(probe_pos).astype(int)
         output_folder = kwargs['output_folder']
         raw_data_type = kwargs['raw_data_type']
         this_obj_size = obj_real.shape
-        if len(probe_real) == 2:
-            probe_size = probe_real.shape
-        else:
-            probe_size = probe_imag.shape
-        obj_stack = w.stack([obj_real, obj_imag], axis=3)
-
-        # Pad if needed
-        obj_stack, pad_arr = pad_object(obj_stack, this_obj_size, probe_pos, probe_size, unknown_type='real_imag')
-
-        i_batch = 0
-        subobj_ls = []
-        probe_real_ls = []
-        probe_imag_ls = []
+        probe_size = p_real.shape
+
+        # Pad if needed. Positions are shifted into the padded frame once, without touching the input array.
+        pad_arr = calculate_pad_len(this_obj_size, probe_pos, probe_size, unknown_type='real_imag')
+        o_real = w.pad(obj_real[:, :, 0] - 1, pad_arr.tolist(), mode='constant') + 1
+        o_imag = w.pad(obj_imag[:, :, 0], pad_arr.tolist(), mode='constant')
+        pos_padded = probe_pos + pad_arr[:, 0]
+
+        shift_probe = len(w.nonzero(probe_pos_correction > 1e-3)) > 0
+        if shift_probe:
+            probe_pos_correction = w.to_numpy(probe_pos_correction)
+        batches = get_non_overlapping_batches(probe_pos, probe_size, max_batch_size=minibatch_size)
+        # Relative indices of pixels in a window, to be broadcast against the corners of a batch.
+        iy = np.arange(probe_size[0])[None, :, None]
+        ix = np.arange(probe_size[1])[None, None, :]
+
+        if variant == 'mpie':
+            o_real_prev, o_imag_prev = o_real * 1, o_imag * 1
+            p_real_prev, p_imag_prev = p_real * 1, p_imag * 1
+            v_o_real, v_o_imag = w.zeros_like(o_real, requires_grad=False), w.zeros_like(o_imag, requires_grad=False)
+            v_p_real, v_p_imag = w.zeros_like(p_real, requires_grad=False), w.zeros_like(p_imag, requires_grad=False)
+
         for i_epoch in range(n_epochs):
-            for j in range(len(probe_pos)):
-                print('Batch {}/{}; Epoch {}/{}.'.format(j, len(probe_pos), i_epoch, n_epochs))
-                pos = probe_pos[j]
-                pos[0] = pos[0] + pad_arr[0, 0]
-                pos[1] = pos[1] + pad_arr[1, 0]
-                subobj = obj_stack[pos[0]:pos[0] + probe_size[0], pos[1]:pos[1] + probe_size[1], :, :]
-                subobj_ls.append(subobj)
-                if len(w.nonzero(probe_pos_correction > 1e-3)) > 0:
-                    this_shift = probe_pos_correction[0, j]
-                    probe_real_shifted, probe_imag_shifted = realign_image_fourier(probe_real, probe_imag,
-                                                                                   this_shift, axes=(0, 1),
-                                                                                   device=device_obj)
+            t0 = time.time()
+            for i_batch in np.random.permutation(len(batches)):
+                # h5py fancy indexing needs sorted indices.
+                ind = np.sort(batches[i_batch])
+                n = len(ind)
+                yy = w.create_constant(pos_padded[ind, 0][:, None, None] + iy, dtype='int64', device=device_obj)
+                xx = w.create_constant(pos_padded[ind, 1][:, None, None] + ix, dtype='int64', device=device_obj)
+                c_real = o_real[yy, xx]
+                c_imag = o_imag[yy, xx]
+                if shift_probe:
+                    pr_ls, pi_ls = [], []
+                    for k in ind:
+                        pr, pi = realign_image_fourier(p_real, p_imag, probe_pos_correction[0, k], axes=(0, 1),
+                                                       device=device_obj)
+                        pr_ls.append(pr)
+                        pi_ls.append(pi)
+                    pr_ls = w.stack(pr_ls)
+                    pi_ls = w.stack(pi_ls)
                 else:
-                    probe_real_shifted = probe_real
-                    probe_imag_shifted = probe_imag
-                probe_real_ls.append(probe_real_shifted)
-                probe_imag_ls.append(probe_imag_shifted)
-                i_batch += 1
-                if i_batch < minibatch_size and i_batch < prj.shape[1]:
-                    continue
+                    pr_ls = p_real
+                    pi_ls = p_imag
+
+                this_prj_batch = w.create_variable(read_tiles(prj, 0, ind, tile_storage_index), requires_grad=False,
+                                                   device=device_obj)
+                if raw_data_type == 'intensity':
+                    this_prj_batch = w.sqrt(this_prj_batch)
+
+                # Batched modulus constraint.
+                ex_real, ex_imag = (pr_ls * c_real - pi_ls * c_imag, pr_ls * c_imag + pi_ls * c_real)
+                dp_real, dp_imag = w.fft2_and_shift(ex_real, ex_imag)
+                mag_replace_factor = this_prj_batch / (w.sqrt(dp_real ** 2 + dp_imag ** 2) + 1e-10)
+                phi_real, phi_imag = w.ishift_and_ifft2(dp_real * mag_replace_factor, dp_imag * mag_replace_factor)
+                d_real = phi_real - ex_real
+                d_imag = phi_imag - ex_imag
+
+                # Object update, scattered back at once since windows in a batch do not overlap.
+                p_abs2 = pr_ls ** 2 + pi_ls ** 2
+                if variant == 'epie':
+                    denom = w.max(p_abs2) / alpha
                 else:
-                    this_prj_batch = prj[0, j * minibatch_size:j * minibatch_size + i_batch, :, :]
-                    this_prj_batch = w.create_variable(this_prj_batch, requires_grad=False, device=device_obj)
-                    if raw_data_type == 'intensity':
-                        this_prj_batch = w.sqrt(this_prj_batch)
-                    subobj_ls = w.stack(subobj_ls)
-                    probe_real_ls = w.stack(probe_real_ls)
-                    probe_imag_ls = w.stack(probe_imag_ls)
-                    c_real, c_imag = subobj_ls[:, :, :, 0, 0], subobj_ls[:, :, :, 0, 1]
-                    ex_real_ls, ex_imag_ls = (probe_real_ls * c_real - probe_imag_ls * c_imag, probe_real_ls * c_imag + probe_imag_ls * c_real)
-                    dp_real_ls, dp_imag_ls = w.fft2_and_shift(ex_real_ls, ex_imag_ls)
-                    mag_replace_factor = this_prj_batch / w.sqrt(dp_real_ls ** 2 + dp_imag_ls ** 2)
-                    dp_real_ls = dp_real_ls * mag_replace_factor
-                    dp_imag_ls = dp_imag_ls * mag_replace_factor
-                    phi_real_ls, phi_imag_ls = w.ishift_and_ifft2(dp_real_ls, dp_imag_ls)
-                    d_real_ls = phi_real_ls - ex_real_ls
-                    d_imag_ls = phi_imag_ls - ex_imag_ls
-
-                    norm = w.max(probe_real_ls ** 2 + probe_imag_ls ** 2)
-                    o_up_real = (probe_real_ls * d_real_ls + probe_imag_ls * d_imag_ls) / norm
-                    o_up_imag = (probe_real_ls * d_imag_ls - probe_imag_ls * d_real_ls) / norm
-                    o_up = w.stack([o_up_real, o_up_imag], axis=-1)
-                    o_up = w.reshape(o_up, [i_batch, probe_size[0], probe_size[1], 1, 2])
-                    subobj_ls = subobj_ls + alpha * o_up
-
-                    norm = w.max(subobj_ls[:, :, :, 0, 0] ** 2 + subobj_ls[:, :, :, 0, 1] ** 2)
-                    p_up_real = (subobj_ls[:, :, :, 0, 0] * d_real_ls + subobj_ls[:, :, :, 0, 1] * d_imag_ls) / norm
-                    p_up_imag = (subobj_ls[:, :, :, 0, 0] * d_imag_ls - subobj_ls[:, :, :, 0, 1] * d_real_ls) / norm
-                    p_up = w.stack([p_up_real, p_up_imag], axis=-1)
-                    p_up = w.reshape(p_up, [i_batch, probe_size[0], probe_size[1], 1, 2])
-                    p_up = w.mean(p_up, axis=0)
-                    probe_real = probe_real + alpha * p_up
-                    probe_imag = probe_imag + alpha * p_up
-
-                    # Put back.
-                    for i, k in enumerate(range(j * minibatch_size, j * minibatch_size + i_batch)):
-                        pos = probe_pos[k]
-                        pos[0] = pos[0] + pad_arr[0, 0]
-                        pos[1] = pos[1] + pad_arr[1, 0]
-                        obj_stack[pos[0]:pos[0] + probe_size[0], pos[1]:pos[1] + probe_size[1], :, :] = subobj_ls[i]
-
-                    i_batch = 0
-                    subobj_ls = []
-                    probe_real_ls = []
-                    probe_imag_ls = []
-
-            fname0 = 'obj_mag_{}_{}'.format(i_epoch, i_batch)
-            fname1 = 'obj_phase_{}_{}'.format(i_epoch, i_batch)
-            obj0, obj1 = w.split_channel(obj_stack)
-            obj0 = w.to_numpy(obj0)
-            obj1 = w.to_numpy(obj1)
+                    denom = (1 - alpha) * p_abs2 + alpha * w.max(p_abs2)
+                o_real[yy, xx] = c_real + (pr_ls * d_real + pi_ls * d_imag) / denom
+                o_imag[yy, xx] = c_imag + (pr_ls * d_imag - pi_ls * d_real) / denom
+
+                # Probe update from the object before this batch's update.
+                if optimize_probe:
+                    num_real = w.sum(c_real * d_real + c_imag * d_imag, axis=0)
+                    num_imag = w.sum(c_real * d_imag - c_imag * d_real, axis=0)
+                    c_abs2 = c_real ** 2 + c_imag ** 2
+                    if variant == 'epie':
+                        denom = w.max(c_abs2) * n / probe_alpha
+                    else:
+                        c_abs2 = w.sum(c_abs2, axis=0)
+                        denom = (1 - probe_alpha) * c_abs2 + probe_alpha * w.max(c_abs2)
+                    p_real = p_real + num_real / denom
+                    p_imag = p_imag + num_imag / denom
+
+            if variant == 'mpie':
+                v_o_real = mpie_eta * v_o_real + (o_real - o_real_prev)
+                v_o_imag = mpie_eta * v_o_imag + (o_imag - o_imag_prev)
+                o_real = o_real + mpie_eta * v_o_real
+                o_imag = o_imag + mpie_eta * v_o_imag
+                o_real_prev, o_imag_prev = o_real * 1, o_imag * 1
+                if optimize_probe:
+                    v_p_real = mpie_eta * v_p_real + (p_real - p_real_prev)
+                    v_p_imag = mpie_eta * v_p_imag + (p_imag - p_imag_prev)
+                    p_real = p_real + mpie_eta * v_p_real
+                    p_imag = p_imag + mpie_eta * v_p_imag
+                    p_real_prev, p_imag_prev = p_real * 1, p_imag * 1
+            print_flush('Epoch {}/{} ({} batches) done in {} s.'.format(i_epoch, n_epochs, len(batches),
+                                                                        time.time() - t0), 0, rank)
+
+            fname0 = 'obj_mag_{}_{}'.format(i_epoch, 0)
+            fname1 = 'obj_phase_{}_{}'.format(i_epoch, 0)
+            obj0 = w.to_numpy(o_real)
+            obj1 = w.to_numpy(o_imag)
             dxchange.write_tiff(np.sqrt(obj0 ** 2 + obj1 ** 2), os.path.join(output_folder, fname0), dtype='float32',
                                 overwrite=True)
             dxchange.write_tiff(np.arctan2(obj1, obj0), os.path.join(output_folder, fname1), dtype='float32',
                                 overwrite=True)
 
+        o_real = o_real[pad_arr[0, 0]:o_real.shape[0] - pad_arr[0, 1], pad_arr[1, 0]:o_real.shape[1] - pad_arr[1, 1]]
+        o_imag = o_imag[pad_arr[0, 0]:o_imag.shape[0] - pad_arr[0, 1], pad_arr[1, 0]:o_imag.shape[1] - pad_arr[1, 1]]
+        obj_real[:, :, 0] = o_real
+        obj_imag[:, :, 0] = o_imag
+        probe_real[0] = p_real
+        probe_imag[0] = p_imag
+    return obj_real, obj_imag, probe_real, probe_imag
+
+
+def alt_reconstruction_dm(obj_real, obj_imag, probe_real, probe_imag, probe_pos, prj, device_obj=None,
+                          n_epochs=100, algorithm='dm', raar_beta=0.75, optimize_probe=True, n_overlap_iter=1,
+                          tile_storage_index=None, **kwargs):
+    """
+    Reconstruct a 2D object and probe function using difference map (DM) or relaxed averaged alternating
+    reflections (RAAR). The exit wave psi of all positions is updated at once as
+
+        psi <- beta * (psi + P_O(2 P_F(psi) - psi)) + (1 - 2 * beta) * P_F(psi),
+
+    where P_F is the modulus projection and P_O the overlap projection. beta = 1 gives DM. Positions are split
+    among ranks; each rank keeps the exit waves of its own positions, and the overlap projection is done by
+    allreducing the object and probe numerators and denominators.
+
+    :param obj_real: Tensor with shape [y, x, z]. Only the first slice is reconstructed.
+    :param probe_real: Tensor with shape [n_modes, y, x]. Only the first mode is reconstructed.
+    :param algorithm: String. Choose from 'dm' and 'raar'.
+    :param raar_beta: Float. Relaxation of RAAR.
+    :param n_overlap_iter: Int. Number of alternating object/probe updates in each overlap projection.
+    :param tile_storage_index: Array of Int or None. Storage index of each tile if the data were re-chunked. See
+        util.read_tiles.
+    :return: Reconstructed obj_real, obj_imag, probe_real and probe_imag, shaped as inputs.
+    """
+    assert algorithm in ['dm', 'raar']
+    beta = 1. if algorithm == 'dm' else raar_beta
+    with w.no_grad():
+        p_real = probe_real[0]
+        p_imag = probe_imag[0]
+        probe_pos = np.array(probe_pos).astype(int)
+        output_folder = kwargs['output_folder']
+        raw_data_type = kwargs['raw_data_type']
+        this_obj_size = obj_real.shape
+        probe_size = p_real.shape
+
+        pad_arr = calculate_pad_len(this_obj_size, probe_pos, probe_size, unknown_type='real_imag')
+        o_real = w.pad(obj_real[:, :, 0] - 1, pad_arr.tolist(), mode='constant') + 1
+        o_imag = w.pad(obj_imag[:, :, 0], pad_arr.tolist(), mode='constant')
+        pos_padded = probe_pos + pad_arr[:, 0]
+
+        # Positions of this rank, grouped so that the windows in each group do not overlap and can be
+        # scatter-added to the object at once.
+        ind_range = get_multiprocess_distribution_index(len(probe_pos), n_ranks)[rank]
+        ind_local = np.arange(*ind_range) if ind_range is not None else np.array([], dtype=int)
+        iy = np.arange(probe_size[0])[None, :, None]
+        ix = np.arange(probe_size[1])[None, None, :]
+        yy = w.create_constant(pos_padded[ind_local, 0][:, None, None] + iy, dtype='int64', device=device_obj)
+        xx = w.create_constant(pos_padded[ind_local, 1][:, None, None] + ix, dtype='int64', device=device_obj)
+        scatter_batches = []
+        for b in get_non_overlapping_batches(probe_pos[ind_local], probe_size):
+            scatter_batches.append((b, yy[b], xx[b]))
+
+        def overlap_add(vals):
+            arr = w.zeros(o_real.shape, requires_grad=False, device=device_obj)
+            for b, this_yy, this_xx in scatter_batches:
+                arr[this_yy, this_xx] = arr[this_yy, this_xx] + vals[b]
+            return comm.allreduce(arr)
+
+        this_prj = w.create_variable(read_tiles(prj, 0, ind_local, tile_storage_index), requires_grad=False,
+                                     device=device_obj)
+        if raw_data_type == 'intensity':
+            this_prj = w.sqrt(this_prj)
+
+        # Initial exit waves.
+        psi_real = p_real * o_real[yy, xx] - p_imag * o_imag[yy, xx]
+        psi_imag = p_real * o_imag[yy, xx] + p_imag * o_real[yy, xx]
+
+        for i_epoch in range(n_epochs):
+            t0 = time.time()
+
+            # Modulus projection of all local exit waves with one batched FFT.
+            dp_real, dp_imag = w.fft2_and_shift(psi_real, psi_imag)
+            dp_mag = w.sqrt(dp_real ** 2 + dp_imag ** 2)
+            err = comm.allreduce(float(w.to_numpy(w.sum((dp_mag - this_prj) ** 2))))
+            mag_replace_factor = this_prj / (dp_mag + 1e-10)
+            f_real, f_imag = w.ishift_and_ifft2(dp_real * mag_replace_factor, dp_imag * mag_replace_factor)
+            z_real = 2 * f_real - psi_real
+            z_imag = 2 * f_imag - psi_imag
+
+            # Overlap projection of z.
+            for i_overlap in range(n_overlap_iter):
+                p_abs2 = p_real ** 2 + p_imag ** 2
+                num_real = overlap_add(p_real * z_real + p_imag * z_imag)
+                num_imag = overlap_add(p_real * z_imag - p_imag * z_real)
+                denom = overlap_add(w.zeros_like(z_real, requires_grad=False) + p_abs2) + 1e-10
+                o_real = num_real / denom
+                o_imag = num_imag / denom
+                c_real = o_real[yy, xx]
+                c_imag = o_imag[yy, xx]
+                if optimize_probe:
+                    num_real = comm.allreduce(w.sum(c_real * z_real + c_imag * z_imag, axis=0))
+                    num_imag = comm.allreduce(w.sum(c_real * z_imag - c_imag * z_real, axis=0))
+                    denom = comm.allreduce(w.sum(c_real ** 2 + c_imag ** 2, axis=0)) + 1e-10
+                    p_real = num_real / denom
+                    p_imag = num_imag / denom
+            po_real = p_real * c_real - p_imag * c_imag
+            po_imag = p_real * c_imag + p_imag * c_real
+
+            psi_real = beta * (psi_real + po_real) + (1 - 2 * beta) * f_real
+            psi_imag = beta * (psi_imag + po_imag) + (1 - 2 * beta) * f_imag
+
+            print_flush('Epoch {}/{}: Fourier error = {}; done in {} s.'.format(i_epoch, n_epochs, err,
+                                                                               time.time() - t0), 0, rank)
+
+            if rank == 0:
+                fname0 = 'obj_mag_{}_{}'.format(i_epoch, 0)
+                fname1 = 'obj_phase_{}_{}'.format(i_epoch, 0)
+                obj0 = w.to_numpy(o_real)
+                obj1 = w.to_numpy(o_imag)
+                dxchange.write_tiff(np.sqrt(obj0 ** 2 + obj1 ** 2), os.path.join(output_folder, fname0),
+                                    dtype='float32', overwrite=True)
+                dxchange.write_tiff(np.arctan2(obj1, obj0), os.path.join(output_folder, fname1), dtype='float32',
+                                    overwrite=True)
+
+        o_real = o_real[pad_arr[0, 0]:o_real.shape[0] - pad_arr[0, 1], pad_arr[1, 0]:o_real.shape[1] - pad_arr[1, 1]]
+        o_imag = o_imag[pad_arr[0, 0]:o_imag.shape[0] - pad_arr[0, 1], pad_arr[1, 0]:o_imag.shape[1] - pad_arr[1, 1]]
+        obj_real[:, :, 0] = o_real
+        obj_imag[:, :, 0] = o_imag
+        probe_real[0] = p_real
+        probe_imag[0] = p_imag
+    return obj_real, obj_imag, probe_real, probe_imag
+
 
 def multidistance_ctf_wrapped(this_prj_batch, free_prop_cm, energy_ev, psize_cm, kappa=50, safe_zone_width=0,
                               prj_affine_ls=None, device=None):
@@ -0,0 +1,221 @@
+"""
+Chunked, parallel conversion of raw data into Adorym's HDF5 format.
+
+Input frames are streamed in blocks. Worker processes read and transform the blocks, and the calling process
+writes them, so memory use is bounded by a few blocks per worker regardless of the size of the data.
+"""
+import os
+import collections
+import concurrent.futures
+
+import numpy as np
+import h5py
+import dxchange
+
+from adorym.misc import print_flush
+
+
+class HDF5FrameSource(object):
+    """
+    Frames of an HDF5 dataset of shape [y, x], [n_frames, y, x] or [n_theta, n_tiles, y, x]. Leading dimensions
+    are flattened into a single frame index. The file is opened lazily in each worker process.
+
+    :param fname: String. Name of the HDF5 file.
+    :param path: String. Path of the dataset in the file.
+    """
+    def __init__(self, fname, path):
+        self.fname = fname
+        self.path = path
+        with h5py.File(fname, 'r') as f:
+            self.shape = f[path].shape
+            self.dtype = f[path].dtype
+        self.frame_shape = tuple(self.shape[-2:])
+        self.n_frames = int(np.prod(self.shape[:-2]))
+        self.dset = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['dset'] = None
+        return state
+
+    def read(self, i0, i1):
+        if self.dset is None:
+            self.dset = h5py.File(self.fname, 'r')[self.path]
+        if len(self.shape) == 2:
+            return self.dset[...][None]
+        if len(self.shape) == 3:
+            return self.dset[i0:i1]
+        n_inner = self.shape[1]
+        block_ls = []
+        i = i0
+        while i < i1:
+            i_outer, i_inner = divmod(i, n_inner)
+            n = min(i1 - i, n_inner - i_inner)
+            block_ls.append(self.dset[i_outer, i_inner:i_inner + n])
+            i += n
+        return np.concatenate(block_ls)
+
+
+class PermutedHDF5FrameSource(HDF5FrameSource):
+    """
+    Frames of an HDF5 dataset of shape [n_theta, n_tiles, y, x], with tiles of each angle taken in a given order.
+
+    :param tile_index: Array of Int. Output tile j of each angle is tile tile_index[j] of the dataset.
+    """
+    def __init__(self, fname, path, tile_index):
+        super(PermutedHDF5FrameSource, self).__init__(fname, path)
+        self.tile_index = np.array(tile_index, dtype=int)
+
+    def read(self, i0, i1):
+        if self.dset is None:
+            self.dset = h5py.File(self.fname, 'r')[self.path]
+        n_inner = self.shape[1]
+        block_ls = []
+        i = i0
+        while i < i1:
+            i_outer, i_inner = divmod(i, n_inner)
+            n = min(i1 - i, n_inner - i_inner)
+            ind = self.tile_index[i_inner:i_inner + n]
+            # HDF5 point selections must be increasing.
+            order = np.argsort(ind)
+            block = self.dset[i_outer, ind[order]]
+            block_ls.append(block[np.argsort(order)])
+            i += n
+        return np.concatenate(block_ls)
+
+
+class TiffFrameSource(object):
+    """
+    Frames stored as one TIFF file each.
+
+    :param flist: List of String. Filenames in frame order.
+    """
+    def __init__(self, flist):
+        self.flist = list(flist)
+        img = np.squeeze(dxchange.read_tiff(self.flist[0]))
+        self.frame_shape = img.shape
+        self.dtype = img.dtype
+        self.n_frames = len(self.flist)
+
+    def read(self, i0, i1):
+        return np.stack([np.squeeze(dxchange.read_tiff(f)) for f in self.flist[i0:i1]])
+
+
+def create_adorym_dataset(f, shape, dtype='float32', compression=None, tiles_per_chunk=1):
+    """
+    Create dataset 'exchange/data' with shape [n_theta, n_tiles, y, x]. By default, the dataset is chunked by single
+    frames, so that a minibatch read of a few tiles of one rotation angle only touches the frames it needs.
+
+    :param f: Writable h5py.File.
+    :param compression: None, 'gzip' or 'lzf'.
+    :param tiles_per_chunk: Int. Number of consecutive tiles of an angle in each chunk. See rechunk_adorym_data.
+    """
+    return f.create_dataset('exchange/data', shape=shape, dtype=dtype,
+                            chunks=(1, min(tiles_per_chunk, shape[1]), *shape[2:]), compression=compression)
+
+
+def get_compact_tile_order(probe_pos):
+    """
+    Order tiles along a Z-order (Morton) curve of their probe positions, so that any run of consecutive tiles in
+    the new order covers a spatially compact group of positions.
+
+    :param probe_pos: Array with shape [n_tiles, 2]. Probe positions in pixel.
+    :return: Array of Int. Original indices of tiles in the new order.
+    """
+    probe_pos = np.array(probe_pos, dtype=float)
+    pos_range = np.ptp(probe_pos, axis=0)
+    pos_range[pos_range == 0] = 1
+    q = ((probe_pos - probe_pos.min(axis=0)) / pos_range * 65535).astype(np.uint64)
+    code = np.zeros(len(probe_pos), dtype=np.uint64)
+    for i_bit in range(16):
+        for i_dim in range(2):
+            bit = (q[:, i_dim] >> np.uint64(i_bit)) & np.uint64(1)
+            code |= bit << np.uint64(2 * i_bit + 1 - i_dim)
+    return np.argsort(code, kind='stable')
+
+
+def write_frames(dset, i_frame, block):
+    """
+    Write a block of frames into dset of shape [n_theta, n_tiles, y, x], starting at flattened frame index
+    i_frame.
+    """
+    n_inner = dset.shape[1]
+    i = 0
+    while i < len(block):
+        i_outer, i_inner = divmod(i_frame + i, n_inner)
+        n = min(len(block) - i, n_inner - i_inner)
+        dset[i_outer, i_inner:i_inner + n] = block[i:i + n]
+        i += n
+
+
+def map_in_workers(func, task_ls, n_workers=None):
+    """
+    Apply func to each tuple of arguments in task_ls in worker processes, and yield the results in order. At most
+    2 * n_workers tasks are in flight at a time. With n_workers = 1, tasks run in the calling process.
+    func and its arguments must be picklable, e.g., module-level functions or functools.partial of them. Processes
+    are started with the default method of the platform; where it is not 'fork', the calling script needs an
+    ``if __name__ == '__main__'`` guard.
+
+    :param n_workers: Int. Number of worker processes. Defaults to the number of CPUs.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if n_workers <= 1:
+        for args in task_ls:
+            yield func(*args)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        future_ls = collections.deque()
+        for args in task_ls:
+            future_ls.append(executor.submit(func, *args))
+            if len(future_ls) >= 2 * n_workers:
+                yield future_ls.popleft().result()
+        while len(future_ls) > 0:
+            yield future_ls.popleft().result()
+
+
+def _convert_block(source, i0, i1, transform, seed):
+    if seed is not None:
+        np.random.seed(seed)
+    block = source.read(i0, i1)
+    info = None
+    if transform is not None:
+        block = transform(block)
+        if isinstance(block, tuple):
+            block, info = block
+    return block, info
+
+
+def convert_frames(source, dset, transform=None, frames_per_block=16, n_workers=None, seed=None,
+                   preview_fname=None, verbose=False):
+    """
+    Stream all frames of source through transform into dset.
+
+    :param source: HDF5FrameSource, TiffFrameSource, or any picklable object with attribute n_frames and method
+        read(i0, i1) returning frames [i0, i1) as an array of shape [i1 - i0, y, x].
+    :param dset: Output dataset with shape [n_theta, n_tiles, y, x], e.g., created by create_adorym_dataset.
+    :param transform: Picklable function mapping a block of input frames [n, y, x] to output frames
+        [n * k, y', x'] (k is a constant number of output frames per input frame), or to a tuple of the output
+        frames and any picklable information, which is collected and returned.
+    :param frames_per_block: Int. Number of input frames per task.
+    :param n_workers: Int. Number of worker processes. See map_in_workers.
+    :param seed: Int. If given, the random seed of block i is set to seed + i, so that results do not depend on
+        n_workers.
+    :param preview_fname: String. If given, the first block of output frames is also saved as a TIFF stack.
+    :param verbose: Bool. Whether to print the progress after each block.
+    :return: List of information returned by transform for each block, or None values.
+    """
+    n_frames = source.n_frames
+    task_ls = []
+    for i_block, i0 in enumerate(range(0, n_frames, frames_per_block)):
+        task_ls.append((source, i0, min(i0 + frames_per_block, n_frames), transform,
+                        None if seed is None else seed + i_block))
+    info_ls = []
+    for (_, i0, i1, _, _), (block, info) in zip(task_ls, map_in_workers(_convert_block, task_ls, n_workers)):
+        write_frames(dset, i0 * (len(block) // (i1 - i0)), block)
+        if preview_fname is not None and i0 == 0:
+            dxchange.write_tiff(np.abs(block), preview_fname, dtype='float32', overwrite=True)
+        info_ls.append(info)
+        if verbose:
+            print_flush('Converted frames {}/{}.'.format(i1, n_frames), 0, 0)
+    return info_ls
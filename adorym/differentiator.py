@@ -9,6 +9,9 @@ class Differentiator(object):
         self.loss_object = None
         self.opt_args_ls = []
         self.loss_args = {}
+        # Counts calls to get_l_h_hessian_and_h_x_jacobian_mvps, so that products cached at a linearization point
+        # can be told apart from those of a later one.
+        self.i_linearization = 0
 
     def create_loss_node(self, loss, opt_args_ls=None):
         """
@@ -37,8 +40,9 @@ class Differentiator(object):
         :param kwargs: Unwrapped dictionary or key word arguments that contain ALL arguments of forward_model.get_loss_function/predict.
         """
         assert isinstance(forward_model, adorym.ForwardModel)
-        self.func_vjp, _ = w.vjp(forward_model.predict, [ind_opt_arg])(*list(kwargs.values()))
-        self.func_jvp = w.jvp(forward_model.predict, [ind_opt_arg])(*list(kwargs.values()))
+        # JVP and VJP share one forward pass, which also gives the predicted data.
+        self.func_jvp, self.func_vjp, this_pred_batch = \
+            w.linearize(forward_model.predict, [ind_opt_arg])(*list(kwargs.values()))
         #if forward_model.loss_function_type == 'lsq':
         #    self.func_hvp = lambda x: x
         #    self.jloss = 2 * forward_model.predict(**kwargs)
@@ -47,11 +51,10 @@ class Differentiator(object):
 
         # Calculate HVP of loss using predicted and measured data.
         obj = kwargs['obj']
-        this_pred_batch = forward_model.predict(**kwargs)
         this_prj_batch = forward_model.get_data(kwargs['this_i_theta'], kwargs['this_ind_batch'], 
                                                theta_downsample=forward_model.common_vars['theta_downsample'],
                                                ds_level=forward_model.common_vars['ds_level'])
-        self.func_hvp, self.jloss = w.hvp(forward_model.loss, [0])(this_pred_batch, this_prj_batch, obj)
+        self.func_hvp, self.jloss = w.hvp(forward_model.loss, 0)(this_pred_batch, this_prj_batch, obj)
 
         # GVP is Gauss-Newton-vector product.
         def f_gvp(g):
@@ -62,4 +65,14 @@ class Differentiator(object):
         self.func_gvp = f_gvp
         self.full_grad = self.func_vjp(self.jloss)[0]
         # gradients = w.get_gradients(self.loss_object, opt_args_ls=[0], **kwargs) # self.full_grad should match gradients
+        self.i_linearization += 1
+
+    def get_jvp_and_hjvp(self, v):
+        """
+        Get J v and H J v, where J is the predict-object Jacobian and H is the loss-predict Hessian. The
+        Gauss-Newton quadratic form u^T G v is then the inner product of J u and H J v in data space, so that no
+        VJP is needed.
+        """
+        jv = self.func_jvp([v])
+        return jv, self.func_hvp(jv)
      
@@ -0,0 +1,136 @@
+import numpy as np
+
+import adorym.wrappers as w
+import adorym.global_settings as global_settings
+from adorym.propagate import get_kernel
+from adorym.misc import *
+
+try:
+    import autograd as ag
+    flag_autograd_avail = True
+except:
+    flag_autograd_avail = False
+
+try:
+    import torch as tc
+    flag_pytorch_avail = True
+except:
+    flag_pytorch_avail = False
+
+
+def get_slab_ranges(length, n_parts):
+    """
+    Divide [0, length) into n_parts contiguous ranges whose sizes differ by at most 1.
+
+    :return: List of [start, end].
+    """
+    bounds = np.linspace(0, length, n_parts + 1).round().astype(int)
+    return [[int(bounds[i]), int(bounds[i + 1])] for i in range(n_parts)]
+
+
+class SlabFFT2D(object):
+    """
+    Slab-decomposed 2D FFT convolution over MPI ranks.
+
+    Each rank holds a stripe of rows of the wavefield, i.e., an array of shape [..., y1 - y0, len_x]. A 2D
+    convolution with a transfer function is done as: 1D FFTs along x on the local rows; an all-to-all transpose,
+    after which each rank holds a stripe of columns [..., len_y, x1 - x0]; 1D FFTs along y; multiplication with
+    the matching columns of the transfer function; and the same steps in reverse. Results are exact (same as
+    FFT convolution of the full field), and no rank ever holds the whole wavefield.
+
+    Only the column stripe of each transfer function is computed and kept.
+
+    :param grid_shape: List of Int. [len_y, len_x] of the full wavefield.
+    :param comm: MPI communicator. Defaults to COMM_WORLD.
+    """
+    def __init__(self, grid_shape, comm=comm):
+        self.grid_shape = tuple(int(x) for x in grid_shape[:2])
+        self.comm = comm
+        self.n_ranks = comm.Get_size()
+        self.rank = comm.Get_rank()
+        self.row_ranges = get_slab_ranges(self.grid_shape[0], self.n_ranks)
+        self.col_ranges = get_slab_ranges(self.grid_shape[1], self.n_ranks)
+        self.row_range = self.row_ranges[self.rank]
+        self.col_range = self.col_ranges[self.rank]
+        self.row_slice = slice(*self.row_range)
+        # Fraction of the full field held by this rank.
+        self.local_fraction = (self.row_range[1] - self.row_range[0]) / self.grid_shape[0]
+        self.kernel_dict = {}
+
+    def get_kernel(self, dist_nm, lmbda_nm, voxel_nm, fresnel_approx=True, sign_convention=1):
+        """
+        Get the local column stripe of the unshifted transfer function, with shape [len_y, x1 - x0].
+        """
+        key = (float(dist_nm), float(lmbda_nm), tuple(np.array(voxel_nm, dtype=float)), fresnel_approx, sign_convention)
+        if key not in self.kernel_dict.keys():
+            self.kernel_dict[key] = get_kernel(dist_nm, lmbda_nm, voxel_nm, self.grid_shape, fresnel_approx=fresnel_approx,
+                                               sign_convention=sign_convention, x_range=self.col_range)
+        return self.kernel_dict[key]
+
+    def rows_to_columns(self, arr):
+        send_ls = [np.ascontiguousarray(arr[..., :, c0:c1]) for c0, c1 in self.col_ranges]
+        return np.concatenate(self.comm.alltoall(send_ls), axis=-2)
+
+    def columns_to_rows(self, arr):
+        send_ls = [np.ascontiguousarray(arr[..., r0:r1, :]) for r0, r1 in self.row_ranges]
+        return np.concatenate(self.comm.alltoall(send_ls), axis=-1)
+
+    def convolve_raw(self, arr, h, reverse=False):
+        """
+        Convolve a complex Numpy array of local rows with transfer function stripe h.
+
+        :param reverse: If False, compute IFFT2(h * FFT2(arr)). If True, compute FFT2(h * IFFT2(arr)).
+        """
+        arr = w._provider_fftn_raw(arr, (-1,), None, reverse)
+        arr = self.rows_to_columns(arr)
+        arr = w._provider_fftn_raw(arr, (-2,), None, reverse)
+        arr = arr * h
+        arr = w._provider_fftn_raw(arr, (-2,), None, not reverse)
+        arr = self.columns_to_rows(arr)
+        arr = w._provider_fftn_raw(arr, (-1,), None, not reverse)
+        return arr
+
+    def convolve(self, arr_real, arr_imag, h):
+        """
+        Differentiable distributed convolution of local rows [..., y1 - y0, len_x] with the transfer function
+        stripe h. This is a collective call.
+        """
+        if global_settings.backend == 'pytorch':
+            return _SlabConvolveTorch.apply(arr_real, arr_imag, h, self)
+        else:
+            arr = _slab_convolve_autograd(arr_real + 1j * arr_imag, h, self, False)
+            return w.real(arr), w.imag(arr)
+
+
+if flag_autograd_avail:
+    @ag.extend.primitive
+    def _slab_convolve_autograd(arr, h, slab_fft, reverse):
+        return slab_fft.convolve_raw(arr, h, reverse=reverse)
+
+    # With Autograd's convention for complex numbers, the VJP of a complex-linear map is its transpose. The
+    # transpose of IFFT2(h * FFT2(.)) is FFT2(h * IFFT2(.)), since the DFT matrix is symmetric.
+    ag.extend.defvjp(_slab_convolve_autograd,
+                     lambda ans, arr, h, slab_fft, reverse:
+                     lambda g: _slab_convolve_autograd(g, h, slab_fft, not reverse))
+
+
+if flag_pytorch_avail:
+    class _SlabConvolveTorch(tc.autograd.Function):
+        """
+        The backward pass applies the adjoint, i.e., the convolution with the conjugate transfer function.
+        Arrays are staged through host memory for MPI.
+        """
+        @staticmethod
+        def forward(ctx, arr_real, arr_imag, h, slab_fft):
+            ctx.h = h
+            ctx.slab_fft = slab_fft
+            res = slab_fft.convolve_raw(arr_real.detach().cpu().numpy() + 1j * arr_imag.detach().cpu().numpy(), h)
+            return (tc.tensor(np.real(res), dtype=arr_real.dtype, device=arr_real.device),
+                    tc.tensor(np.imag(res), dtype=arr_real.dtype, device=arr_real.device))
+
+        @staticmethod
+        def backward(ctx, grad_real, grad_imag):
+            g = grad_real.detach().cpu().numpy() + 1j * grad_imag.detach().cpu().numpy()
+            res = ctx.slab_fft.convolve_raw(g, np.conj(ctx.h))
+            return (tc.tensor(np.real(res), dtype=grad_real.dtype, device=grad_real.device),
+                    tc.tensor(np.imag(res), dtype=grad_real.dtype, device=grad_real.device), None, None)
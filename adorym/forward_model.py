@@ -8,7 +8,8 @@ import time
 import adorym.wrappers as w
 from adorym.regularizers import *
 from adorym.util import *
-from adorym.propagate import multislice_propagate_batch, get_kernel
+from adorym.propagate import multislice_propagate_batch, get_kernel, get_kernel_wrapped_stack, propagate_to_distances
+from adorym.distributed_fft import SlabFFT2D
 
 class ForwardModel(object):
     """
@@ -50,6 +51,32 @@ class ForwardModel(object):
             self.prj = common_vars_dict['prj'] # HDF5 dataset pointer
         self.loss_args = {}
         self.reg_list = []
+        # True if self.prj holds precomputed float32 magnitudes. See precompute_magnitude_data.
+        self.data_is_magnitude = False
+        # Detector masks and weights. Combined once into a valid-pixel index and weight map by get_valid_pixel_map.
+        self.beamstop = None
+        self.bad_pixel_mask = None
+        self.pixel_weights = None
+        self.saturation_threshold = None
+        if common_vars_dict is not None:
+            self.beamstop = common_vars_dict.get('beamstop', None)
+            self.bad_pixel_mask = common_vars_dict.get('bad_pixel_mask', None)
+            self.pixel_weights = common_vars_dict.get('pixel_weights', None)
+            self.saturation_threshold = common_vars_dict.get('saturation_threshold', None)
+        self.valid_pixel_map = None
+        # Mask of unsaturated pixels of the last batch returned by get_data, or None if no pixel is saturated.
+        self.this_saturation_mask = None
+        # Far-field data are cropped to the central 1 / detector_crop_factor of the detector in each dimension, and
+        # the prediction is computed on a grid coarser by the same factor. See set_detector_crop_factor.
+        self.detector_crop_factor = 1
+        # Cropped raw data of each angle at the current crop factor, filled as angles are visited.
+        self.cropped_data_cache = {}
+        # Storage index of each tile if the dataset was re-chunked with tools/rechunk_adorym_data.py.
+        self.tile_storage_index = None
+        if common_vars_dict is not None and common_vars_dict.get('spot_permutation', None) is not None:
+            self.tile_storage_index = np.argsort(common_vars_dict['spot_permutation'])
+        # Batch held by hold_batch_data as (key, data, saturation mask), returned by get_data without reading again.
+        self.held_batch_data = None
 
     def update_loss_args(self, kwargs):
         self.loss_args = kwargs
@@ -70,22 +97,20 @@ class ForwardModel(object):
                 return i
         raise ValueError('{} is not in the argument list.'.format(arg))
 
-    def get_mismatch_loss(self, this_pred_batch, this_prj_batch):
+    def get_mismatch_loss(self, this_pred_batch, this_prj_batch, weight=None, weight_sum=None):
+        """
+        :param this_prj_batch: Measured **magnitude** (see preprocess_data).
+        :param weight: Optional per-pixel weights, broadcastable to this_pred_batch. If given, the loss is the
+            weighted sum divided by weight_sum instead of the mean.
+        """
         if self.loss_function_type == 'lsq':
-            if self.raw_data_type == 'magnitude':
-                loss = w.mean((this_pred_batch - w.abs(this_prj_batch)) ** 2)
-            elif self.raw_data_type == 'intensity':
-                loss = w.mean((this_pred_batch - w.sqrt(w.abs(this_prj_batch))) ** 2)
+            loss = (this_pred_batch - this_prj_batch) ** 2
         elif self.loss_function_type == 'poisson':
-            if self.raw_data_type == 'magnitude':
-                loss = w.mean(this_pred_batch ** 2 * self.poisson_multiplier -
-                              w.abs(this_prj_batch) ** 2 * self.poisson_multiplier * w.log(
-                    this_pred_batch ** 2 * self.poisson_multiplier))
-            elif self.raw_data_type == 'intensity':
-                loss = w.mean(this_pred_batch ** 2 * self.poisson_multiplier -
-                              w.abs(this_prj_batch) * self.poisson_multiplier * w.log(
-                    this_pred_batch ** 2 * self.poisson_multiplier))
-        return loss
+            loss = this_pred_batch ** 2 * self.poisson_multiplier - \
+                   this_prj_batch ** 2 * self.poisson_multiplier * w.log(this_pred_batch ** 2 * self.poisson_multiplier)
+        if weight is None:
+            return w.mean(loss)
+        return w.sum(loss * weight) / weight_sum
 
     def predict(self, *args, **kwargs):
         """
@@ -95,13 +120,176 @@ class ForwardModel(object):
         """
         pass
 
+    def precompute_magnitude_data(self, fname=None, frames_per_block=16):
+        """
+        Convert the measured data into float32 magnitudes once, so that batches need no conversion afterwards.
+        This is a collective call.
+
+        :param fname: String. If given, the magnitudes are written by rank 0 into this HDF5 file (under
+            'exchange/data') and read from there. Otherwise, each rank keeps a copy in RAM.
+        :param frames_per_block: Int. Number of rotation angles converted at a time.
+        """
+        if self.data_is_magnitude:
+            return
+        shape = self.prj.shape
+        if fname is None:
+            dset = np.empty(shape, dtype='float32')
+        elif rank == 0:
+            f = h5py.File(fname, 'w')
+            dset = f.create_dataset('exchange/data', shape=shape, dtype='float32',
+                                    chunks=(1, 1, *shape[2:]))
+        if fname is None or rank == 0:
+            for i in range(0, shape[0], frames_per_block):
+                block = np.abs(self.prj[i:i + frames_per_block])
+                if self.raw_data_type == 'intensity':
+                    block = np.sqrt(block)
+                dset[i:i + frames_per_block] = block
+        if fname is not None:
+            if rank == 0:
+                f.close()
+            comm.Barrier()
+            dset = h5py.File(fname, 'r')['exchange/data']
+        self.prj = dset
+        self.data_is_magnitude = True
+
+    def preprocess_data(self, this_prj_batch):
+        """
+        Turn a batch of raw data read from the dataset into measured magnitude on the device. Pixels at or above
+        saturation_threshold (in the unit of the raw data) are recorded in self.this_saturation_mask.
+        """
+        this_prj_batch = np.abs(this_prj_batch)
+        to_magnitude = self.raw_data_type == 'intensity' and not self.data_is_magnitude
+        self.this_saturation_mask = None
+        if self.saturation_threshold is not None:
+            threshold = self.saturation_threshold
+            if self.raw_data_type == 'intensity' and self.data_is_magnitude:
+                threshold = np.sqrt(threshold)
+            saturated = this_prj_batch >= threshold
+            if np.any(saturated):
+                self.this_saturation_mask = w.create_constant(np.logical_not(saturated), device=self.device)
+        if to_magnitude:
+            this_prj_batch = np.sqrt(this_prj_batch)
+        return w.create_variable(this_prj_batch, requires_grad=False, device=self.device)
+
+    def set_detector_crop_factor(self, factor):
+        """
+        Set the detector crop factor for far-field data. With factor > 1, get_data returns the central
+        1 / factor of each diffraction pattern, and predict bins the object and Fourier-crops the probe by the same
+        factor, which corresponds to real-space pixels coarser by that factor over the same field of view.
+        """
+        factor = int(factor)
+        if factor != self.detector_crop_factor:
+            self.detector_crop_factor = factor
+            self.cropped_data_cache = {}
+
+    def get_cropped_data(self, i_theta, this_ind_batch):
+        """
+        Read the central region of diffraction patterns. All patterns of an angle are cropped and cached the first
+        time the angle is visited, so that later epochs at the same crop factor do not read the dataset again.
+        """
+        if i_theta not in self.cropped_data_cache.keys():
+            shape = self.prj.shape[-2:]
+            slicer = get_central_crop_slicer(shape, [x // self.detector_crop_factor for x in shape])
+            self.cropped_data_cache[i_theta] = self.prj[(i_theta, slice(None)) + slicer]
+        if self.tile_storage_index is not None:
+            this_ind_batch = self.tile_storage_index[this_ind_batch]
+        return self.cropped_data_cache[i_theta][this_ind_batch]
+
+    def read_tiles(self, i_theta, this_ind_batch):
+        """
+        Read tiles of an angle by their original indices. For re-chunked data, the tiles are located through the
+        stored permutation, and a contiguous run of storage indices is read as a slice.
+        """
+        if self.tile_storage_index is None:
+            return self.prj[i_theta, this_ind_batch]
+        return read_tiles(self.prj, i_theta, this_ind_batch, self.tile_storage_index)
+
+    def get_batch_key(self, this_i_theta, this_ind_batch, theta_downsample=None, ds_level=1):
+        return (int(this_i_theta), tuple(np.array(this_ind_batch).reshape(-1)), theta_downsample, ds_level,
+                self.detector_crop_factor)
+
+    def hold_batch_data(self, this_i_theta, this_ind_batch, theta_downsample=None, ds_level=1):
+        """
+        Read a batch once and keep it, so that get_data returns it for the same batch without reading or
+        preprocessing the dataset again, e.g., for the repeated loss evaluations of a line search. The batch is held
+        until release_batch_data is called or another batch is held.
+
+        :return: True if the batch is newly held, or False if it was already held.
+        """
+        key = self.get_batch_key(this_i_theta, this_ind_batch, theta_downsample, ds_level)
+        if self.held_batch_data is not None and self.held_batch_data[0] == key:
+            return False
+        self.held_batch_data = None
+        this_prj_batch = self.get_data(this_i_theta, this_ind_batch, theta_downsample=theta_downsample,
+                                       ds_level=ds_level)
+        self.held_batch_data = (key, this_prj_batch, self.this_saturation_mask)
+        return True
+
+    def release_batch_data(self):
+        self.held_batch_data = None
+
+    def get_held_data(self, this_i_theta, this_ind_batch, theta_downsample=None, ds_level=1):
+        """
+        Return the held batch if it is the requested one, or None otherwise.
+        """
+        if self.held_batch_data is None:
+            return None
+        key, this_prj_batch, saturation_mask = self.held_batch_data
+        if key != self.get_batch_key(this_i_theta, this_ind_batch, theta_downsample, ds_level):
+            return None
+        self.this_saturation_mask = saturation_mask
+        return this_prj_batch
+
     def get_data(self, this_i_theta, this_ind_batch, theta_downsample=None, ds_level=1):
+        this_prj_batch = self.get_held_data(this_i_theta, this_ind_batch, theta_downsample, ds_level)
+        if this_prj_batch is not None:
+            return this_prj_batch
         if theta_downsample is None: theta_downsample = 1
-        this_prj_batch = self.prj[this_i_theta * theta_downsample, this_ind_batch]
-        this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
+        if self.detector_crop_factor > 1:
+            return self.preprocess_data(self.get_cropped_data(this_i_theta * theta_downsample, this_ind_batch))
+        this_prj_batch = self.read_tiles(this_i_theta * theta_downsample, this_ind_batch)
         if ds_level > 1:
             this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
-        return this_prj_batch
+        return self.preprocess_data(this_prj_batch)
+
+    def crop_detector_map(self, arr, shape):
+        """
+        Bring a full-detector mask or weight map to the shape of the predicted images.
+        """
+        if self.detector_crop_factor > 1:
+            arr = arr[get_central_crop_slicer(arr.shape, [x // self.detector_crop_factor for x in arr.shape])]
+        if tuple(arr.shape) != tuple(shape):
+            ds = arr.shape[0] // shape[0]
+            arr = arr[::ds, ::ds]
+        return arr
+
+    def get_valid_pixel_map(self, shape):
+        """
+        Combine beamstop, bad pixel mask and pixel weights into a compact index of valid pixels (flattened) and the
+        weights of these pixels. Built once for each detector shape.
+
+        :return: (index, weights). index is None if all pixels are valid; weights is None if all valid pixels have
+            unit weight.
+        """
+        shape = tuple(shape)
+        if self.valid_pixel_map is not None and self.valid_pixel_map[0] == shape:
+            return self.valid_pixel_map[1:]
+        valid = np.ones(shape, dtype=bool)
+        if self.beamstop is not None:
+            valid = valid & (self.crop_detector_map(w.to_numpy(self.beamstop), shape) >= 1e-5)
+        if self.bad_pixel_mask is not None:
+            valid = valid & np.logical_not(self.crop_detector_map(np.array(self.bad_pixel_mask, dtype=bool), shape))
+        weights = None
+        if self.pixel_weights is not None:
+            weights = self.crop_detector_map(np.array(self.pixel_weights), shape)[valid]
+        ind = None
+        if not np.all(valid):
+            ind = w.create_constant(np.nonzero(valid.reshape(-1))[0], dtype='int64', device=self.device)
+            print_flush('  {} valid pixels remain after applying detector masks.'.format(np.count_nonzero(valid)), 0, rank)
+        if weights is not None:
+            weights = w.create_constant(weights if ind is not None else weights.reshape(shape), device=self.device)
+        self.valid_pixel_map = (shape, ind, weights)
+        return ind, weights
 
     def loss(self, this_pred_batch, this_prj_batch, obj):
         """
@@ -110,16 +298,22 @@ class ForwardModel(object):
         Argument this_pred_batch is assumed to be detected **magnitude** (square root of intensity).
         If this is not the case for your specific ForwardModel class, override this method.
         """
-        beamstop = self.common_vars['beamstop']
-        if beamstop is not None:
-            beamstop[beamstop >= 1e-5] = 1
-            beamstop[beamstop < 1e-5] = 0
-            beamstop = w.cast(beamstop, 'bool')
-            beamstop_mask_stack = w.tile(beamstop, [len(this_pred_batch), 1, 1])
-            this_pred_batch = w.reshape(this_pred_batch[beamstop_mask_stack], [beamstop_mask_stack.shape[0], -1])
-            this_prj_batch = w.reshape(this_prj_batch[beamstop_mask_stack], [beamstop_mask_stack.shape[0], -1])
-            print_flush('  {} valid pixels remain after applying beamstop mask.'.format(this_pred_batch.shape[1]), 0, rank)
-        loss = self.get_mismatch_loss(this_pred_batch, this_prj_batch)
+        ind, weight = self.get_valid_pixel_map(this_pred_batch.shape[1:])
+        saturation_mask = self.this_saturation_mask
+        if saturation_mask is not None and tuple(saturation_mask.shape) != tuple(this_prj_batch.shape):
+            saturation_mask = None
+        if ind is not None:
+            n = this_pred_batch.shape[0]
+            this_pred_batch = w.reshape(this_pred_batch, [n, -1])[:, ind]
+            this_prj_batch = w.reshape(this_prj_batch, [n, -1])[:, ind]
+            if saturation_mask is not None:
+                saturation_mask = w.reshape(saturation_mask, [n, -1])[:, ind]
+        if saturation_mask is not None:
+            weight = saturation_mask if weight is None else saturation_mask * weight
+        weight_sum = None
+        if weight is not None:
+            weight_sum = w.sum(weight) * (np.prod(this_pred_batch.shape) / np.prod(weight.shape))
+        loss = self.get_mismatch_loss(this_pred_batch, this_prj_batch, weight=weight, weight_sum=weight_sum)
         if len(self.reg_list) > 0:
             loss = loss + self.get_regularization_value(obj, device=self.device)
         loss_val = w.to_numpy(loss)
@@ -158,6 +352,40 @@ class PtychographyModel(ForwardModel):
         args = inspect.getfullargspec(self.predict).args
         args.pop(0)
         self.argument_ls = args
+        self.detector_crop_kernel_dict = {}
+
+    def get_detector_crop_kernel(self):
+        """
+        Get the slice propagation kernel on the coarse grid of the current detector crop factor.
+        """
+        f = self.detector_crop_factor
+        if f not in self.detector_crop_kernel_dict.keys():
+            voxel_nm = self.common_vars['voxel_nm'] * np.array([f, f, 1])
+            grid_shape = [x // f for x in self.common_vars['probe_size']]
+            self.detector_crop_kernel_dict[f] = get_kernel(voxel_nm[-1] * self.binning, self.common_vars['lmbda_nm'],
+                                                           voxel_nm, grid_shape,
+                                                           fresnel_approx=self.common_vars['fresnel_approx'],
+                                                           sign_convention=self.sign_convention)
+        return self.detector_crop_kernel_dict[f]
+
+    def coarsen_for_detector_crop(self, subobj_ls, probe_real, probe_imag):
+        """
+        Bin the object batch and Fourier-crop the probe onto the grid whose far field is the central
+        1 / detector_crop_factor of the full diffraction pattern. The probe scaling of the orthonormal crop is
+        compensated in predict by get_detector_crop_magnitude_scale.
+        """
+        f = self.detector_crop_factor
+        subobj_ls = bin_object_batch(subobj_ls, f)
+        probe_real, probe_imag = fourier_crop(probe_real, probe_imag, [x // f for x in probe_real.shape[-2:]])
+        return subobj_ls, probe_real, probe_imag
+
+    def get_detector_crop_magnitude_scale(self):
+        # The Fourier-cropped probe is f times the sampled probe. Summing over f ** 2 fewer pixels, the unnormalized
+        # far-field FFT then gives 1 / f, and the unnormalized inverse FFT f, of the full-grid value.
+        f = self.detector_crop_factor
+        if self.normalize_fft:
+            return 1.
+        return float(f) if self.sign_convention == 1 else 1. / f
 
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
@@ -225,6 +453,13 @@ class PtychographyModel(ForwardModel):
             i_dp += n_dp_batch
 
         this_pos_batch = np.round(this_pos_batch).astype(int)
+
+        # Far-field patterns cropped by detector_crop_factor are predicted on a grid coarser by the same factor.
+        crop_factor = self.detector_crop_factor
+        this_probe_size = [x // crop_factor for x in probe_size]
+        if crop_factor > 1 and not pure_projection:
+            h = self.get_detector_crop_kernel()
+
         if optimize_probe_defocusing:
             h_probe = get_kernel(probe_defocus_mm * 1e6, lmbda_nm, voxel_nm, probe_size, fresnel_approx=fresnel_approx)
             h_probe_real, h_probe_imag = w.real(h_probe), w.imag(h_probe)
@@ -312,6 +547,10 @@ class PtychographyModel(ForwardModel):
                 subobj_ls = obj_rot[pos_ind:pos_ind + len(pos_batch), :, :, :, :]
                 pos_ind += len(pos_batch)
 
+            if crop_factor > 1:
+                subobj_ls, probe_real_ls, probe_imag_ls = self.coarsen_for_detector_crop(subobj_ls, probe_real_ls,
+                                                                                         probe_imag_ls)
+
             gc.collect()
             if n_probe_modes == 1:
                 if len(probe_real_ls.shape) == 3:
@@ -323,8 +562,9 @@ class PtychographyModel(ForwardModel):
                 ex_real, ex_imag = multislice_propagate_batch(
                                 subobj_ls,
                                 this_probe_real_ls, this_probe_imag_ls,
-                                energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=free_prop_cm, binning=self.binning,
-                                obj_batch_shape=[len(pos_batch), *probe_size, this_obj_size[-1]],
+                                energy_ev, psize_cm * ds_level * crop_factor, delta_cm=psize_cm * ds_level, kernel=h,
+                                free_prop_cm=free_prop_cm, binning=self.binning,
+                                obj_batch_shape=[len(pos_batch), *this_probe_size, this_obj_size[-1]],
                                 fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
                                 type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
                                 scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
@@ -341,8 +581,9 @@ class PtychographyModel(ForwardModel):
                     temp_real, temp_imag = multislice_propagate_batch(
                                 subobj_ls,
                                 this_probe_real_ls, this_probe_imag_ls,
-                                energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=free_prop_cm, binning=self.binning,
-                                obj_batch_shape=[len(pos_batch), *probe_size, this_obj_size[-1]],
+                                energy_ev, psize_cm * ds_level * crop_factor, delta_cm=psize_cm * ds_level, kernel=h,
+                                free_prop_cm=free_prop_cm, binning=self.binning,
+                                obj_batch_shape=[len(pos_batch), *this_probe_size, this_obj_size[-1]],
                                 fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
                                 type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
                                 scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
@@ -359,6 +600,8 @@ class PtychographyModel(ForwardModel):
             ex_mag_ls = w.concatenate(ex_mag_ls, 0)
         else:
             ex_mag_ls = ex_mag_ls[0]
+        if crop_factor > 1:
+            ex_mag_ls = ex_mag_ls * self.get_detector_crop_magnitude_scale()
         if rank == 0 and debug and self.i_call % 10 == 0:
             ex_mag_val = w.to_numpy(ex_mag_ls)
             dxchange.write_tiff(ex_mag_val, os.path.join(output_folder, 'intermediate', 'detected_mag'), dtype='float32', overwrite=True)
@@ -382,11 +625,57 @@ class PtychographyModel(ForwardModel):
 
 class SingleBatchFullfieldModel(PtychographyModel):
     # Created to avoid unnecessary stacking and concatenation.
+    # With distributed_fft, all ranks work on the same image: each rank predicts a stripe of rows of the field using
+    # the slab-decomposed FFT, and the mismatch and regularization terms are scaled so that the sum of gradients over
+    # ranks equals the gradient of the full-field loss.
 
     def __init__(self, loss_function_type='lsq', distribution_mode=None, device=None, common_vars_dict=None,
                  raw_data_type='magnitude', simulation_mode=False):
         super(SingleBatchFullfieldModel, self).__init__(loss_function_type, distribution_mode, device, common_vars_dict,
                                                 raw_data_type, simulation_mode=simulation_mode)
+        self.distributed_fft = False
+        if common_vars_dict is not None:
+            self.distributed_fft = common_vars_dict.get('distributed_fft', False)
+        self.slab_fft = None
+
+    def get_slab_fft(self, grid_shape):
+        if self.slab_fft is None or self.slab_fft.grid_shape != tuple(grid_shape[:2]):
+            self.slab_fft = SlabFFT2D(grid_shape)
+        return self.slab_fft
+
+    def get_data(self, this_i_theta, this_ind_batch, theta_downsample=None, ds_level=1):
+        if not self.distributed_fft:
+            return super(SingleBatchFullfieldModel, self).get_data(this_i_theta, this_ind_batch,
+                                                                   theta_downsample=theta_downsample, ds_level=ds_level)
+        this_prj_batch = self.get_held_data(this_i_theta, this_ind_batch, theta_downsample, ds_level)
+        if this_prj_batch is not None:
+            return this_prj_batch
+        # Only read the rows of the local stripe.
+        if theta_downsample is None: theta_downsample = 1
+        r0, r1 = self.slab_fft.row_range
+        this_prj_batch = self.prj[this_i_theta * theta_downsample, this_ind_batch,
+                                  r0 * ds_level:r1 * ds_level:ds_level, ::ds_level]
+        return self.preprocess_data(this_prj_batch)
+
+    def crop_detector_map(self, arr, shape):
+        if not self.distributed_fft:
+            return super(SingleBatchFullfieldModel, self).crop_detector_map(arr, shape)
+        ds = arr.shape[1] // shape[1]
+        r0, r1 = self.slab_fft.row_range
+        return arr[r0 * ds:r1 * ds:ds, ::ds]
+
+    def get_mismatch_loss(self, this_pred_batch, this_prj_batch, weight=None, weight_sum=None):
+        loss = super(SingleBatchFullfieldModel, self).get_mismatch_loss(this_pred_batch, this_prj_batch,
+                                                                        weight=weight, weight_sum=weight_sum)
+        if self.distributed_fft:
+            loss = loss * self.slab_fft.local_fraction
+        return loss
+
+    def get_regularization_value(self, obj, device=None):
+        reg = super(SingleBatchFullfieldModel, self).get_regularization_value(obj, device=device)
+        if self.distributed_fft:
+            reg = reg / self.slab_fft.n_ranks
+        return reg
 
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
@@ -433,6 +722,14 @@ class SingleBatchFullfieldModel(PtychographyModel):
         if self.raw_data_type == 'magnitude':
             flag_pp_sqrt = False
 
+        slab_fft = None
+        if self.distributed_fft:
+            # Rotation is about the y-axis, so the local stripe of rows can be rotated on its own.
+            slab_fft = self.get_slab_fft(probe_size)
+            obj = obj[slab_fft.row_slice]
+            probe_real = probe_real[:, slab_fft.row_slice]
+            probe_imag = probe_imag[:, slab_fft.row_slice]
+
         if not two_d_mode and not self.distribution_mode:
             if not self.rotate_out_of_loop:
                 if precalculate_rotation_coords:
@@ -460,7 +757,7 @@ class SingleBatchFullfieldModel(PtychographyModel):
             fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
             type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
             scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
-            pure_projection_return_sqrt=flag_pp_sqrt, shift_exit_wave=this_prj_offset)
+            pure_projection_return_sqrt=flag_pp_sqrt, shift_exit_wave=this_prj_offset, slab_fft=slab_fft)
         ex_mag_ls = w.norm(ex_real, ex_imag)
 
         if self.simulation_mode:
@@ -551,16 +848,25 @@ class SingleBatchPtychographyModel(PtychographyModel):
             obj_rot = obj_rot[pos_y:pos_y + probe_size[0], pos_x:pos_x + probe_size[1], :, :]
             obj_rot = w.reshape(obj_rot, [1, *obj_rot.shape])
 
+        crop_factor = self.detector_crop_factor
+        if crop_factor > 1:
+            obj_rot, probe_real, probe_imag = self.coarsen_for_detector_crop(obj_rot, probe_real, probe_imag)
+            if not pure_projection:
+                h = self.get_detector_crop_kernel()
+
         ex_real, ex_imag = multislice_propagate_batch(
             obj_rot,
             probe_real, probe_imag,
-            energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=free_prop_cm,
-            obj_batch_shape=[1, *probe_size, this_obj_size[-1]], binning=self.binning,
+            energy_ev, psize_cm * ds_level * crop_factor, delta_cm=psize_cm * ds_level, kernel=h,
+            free_prop_cm=free_prop_cm,
+            obj_batch_shape=[1, *[x // crop_factor for x in probe_size], this_obj_size[-1]], binning=self.binning,
             fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
             type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
             scale_ri_by_k=self.scale_ri_by_k, is_minus_logged=self.is_minus_logged,
             pure_projection_return_sqrt=flag_pp_sqrt, shift_exit_wave=this_prj_offset)
         ex_mag_ls = w.norm(ex_real, ex_imag)
+        if crop_factor > 1:
+            ex_mag_ls = ex_mag_ls * self.get_detector_crop_magnitude_scale()
 
         return ex_mag_ls
 
@@ -577,6 +883,26 @@ class SparseMultisliceModel(ForwardModel):
         args = inspect.getfullargspec(self.predict).args
         args.pop(0)
         self.argument_ls = args
+        # Propagation kernels of all slice gaps. Kept across calls when slice positions are not optimized.
+        self.slice_kernel_cache = None
+
+    def get_slice_kernels(self, u, v, slice_pos_cm_ls, energy_ev, fresnel_approx, optimize_slice_pos, device=None):
+        """
+        Get the Fresnel kernels of all slice gaps as [h_real, h_imag], each with shape [n_slices - 1, len_y, len_x].
+        If slice positions are fixed, the kernels are computed once and kept on the device; otherwise they are
+        computed once per call and shared by all subbatches and probe modes.
+        """
+        if not optimize_slice_pos and self.slice_kernel_cache is not None:
+            return self.slice_kernel_cache
+        if optimize_slice_pos:
+            slice_pos_nm_ls = slice_pos_cm_ls * 1e7
+        else:
+            slice_pos_nm_ls = w.create_constant(w.to_numpy(slice_pos_cm_ls) * 1e7, device=device)
+        h_ls = get_kernel_wrapped_stack(u, v, slice_pos_nm_ls[1:] - slice_pos_nm_ls[:-1], 1240. / energy_ev,
+                                        fresnel_approx=fresnel_approx, sign_convention=self.sign_convention)
+        if not optimize_slice_pos:
+            self.slice_kernel_cache = h_ls
+        return h_ls
 
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
@@ -630,11 +956,17 @@ class SparseMultisliceModel(ForwardModel):
         theta_ls = self.common_vars['theta_ls']
         u = self.common_vars['u']
         v = self.common_vars['v']
+        optimize_slice_pos = self.common_vars['optimize_slice_pos']
 
         if precalculate_rotation_coords:
             coord_ls = read_origin_coords('arrsize_{}_{}_{}_ntheta_{}'.format(*this_obj_size, n_theta),
                                           theta_ls[this_i_theta], reverse=False)
 
+        h_slice_ls = None
+        if len(slice_pos_cm_ls) > 1:
+            h_slice_ls = self.get_slice_kernels(u, v, slice_pos_cm_ls, energy_ev, fresnel_approx, optimize_slice_pos,
+                                                device=device_obj)
+
         # Allocate subbatches.
         probe_pos_batch_ls = []
         i_dp = 0
@@ -733,7 +1065,7 @@ class SparseMultisliceModel(ForwardModel):
                                 obj_batch_shape=[len(pos_batch), *probe_size, this_obj_size[-1]],
                                 fresnel_approx=fresnel_approx, device=device_obj,
                                 type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
-                                scale_ri_by_k=self.scale_ri_by_k, shift_exit_wave=this_prj_offset)
+                                scale_ri_by_k=self.scale_ri_by_k, shift_exit_wave=this_prj_offset, h_ls=h_slice_ls)
                 ex_mag_ls.append(w.norm(ex_real, ex_imag))
             else:
                 for i_mode in range(n_probe_modes):
@@ -750,7 +1082,7 @@ class SparseMultisliceModel(ForwardModel):
                                 obj_batch_shape=[len(pos_batch), *probe_size, this_obj_size[-1]],
                                 fresnel_approx=fresnel_approx, device=device_obj,
                                 type=unknown_type, normalize_fft=self.normalize_fft, sign_convention=self.sign_convention,
-                                scale_ri_by_k=self.scale_ri_by_k, shift_exit_wave=this_prj_offset)
+                                scale_ri_by_k=self.scale_ri_by_k, shift_exit_wave=this_prj_offset, h_ls=h_slice_ls)
                     if i_mode == 0:
                         ex_int = temp_real ** 2 + temp_imag ** 2
                     else:
@@ -794,6 +1126,26 @@ class MultiDistModel(ForwardModel):
         args = inspect.getfullargspec(self.predict).args
         args.pop(0)
         self.argument_ls = args
+        # Free-space kernels of all distances. Kept across calls when distances are not optimized.
+        self.free_prop_kernel_cache = None
+
+    def get_free_prop_kernels(self, free_prop_cm, lmbda_nm, voxel_nm, grid_shape, u_free, v_free, optimize_free_prop,
+                              device=None):
+        """
+        Get the Fresnel kernels of all propagation distances as [h_real, h_imag], each with shape
+        [n_dists, len_y, len_x].
+        """
+        if optimize_free_prop:
+            return get_kernel_wrapped_stack(u_free, v_free, free_prop_cm * 1e7, lmbda_nm,
+                                            sign_convention=self.sign_convention)
+        dist_nm_ls = np.array(w.to_numpy(free_prop_cm), dtype=float).reshape(-1) * 1e7
+        key = (tuple(grid_shape), tuple(dist_nm_ls))
+        if self.free_prop_kernel_cache is None or self.free_prop_kernel_cache[0] != key:
+            h = np.stack([get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=self.sign_convention)
+                          for dist_nm in dist_nm_ls])
+            h_ls = [w.create_constant(np.real(h), device=device), w.create_constant(np.imag(h), device=device)]
+            self.free_prop_kernel_cache = (key, h_ls)
+        return self.free_prop_kernel_cache[1]
 
     def predict(self, obj, probe_real, probe_imag, probe_defocus_mm,
                 probe_pos_offset, this_i_theta, this_pos_batch, prj,
@@ -975,33 +1327,54 @@ class MultiDistModel(ForwardModel):
 
         ex_mag_ls = []
 
-        for i_dist, this_dist in enumerate(free_prop_cm):
+        if self.forward_algorithm == 'fresnel':
+            # The exit wave of each subbatch is computed once, and propagated to all distances with a single
+            # forward FFT and a batched inverse FFT.
+            grid_shape = [subprobe_size[0] + 2 * safe_zone_width, subprobe_size[1] + 2 * safe_zone_width]
             for k, pos_batch in enumerate(probe_pos_batch_ls):
                 for i_mode in range(n_probe_modes):
-                    if self.forward_algorithm == 'fresnel':
-                        temp_real, temp_imag = multislice_propagate_batch(
-                            subobj_ls_ls[k],
-                            subprobe_real_ls_ls[k][:, i_mode, :, :], subprobe_imag_ls_ls[k][i_mode, :, :],
-                            energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=this_dist, binning=self.binning,
-                            obj_batch_shape=[len(pos_batch), subprobe_size[0] + 2 * safe_zone_width, subprobe_size[1] + 2 * safe_zone_width, this_obj_size[-1]],
-                            fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
-                            type=unknown_type, sign_convention=self.sign_convention, optimize_free_prop=optimize_free_prop,
-                            u_free=u_free, v_free=v_free, scale_ri_by_k=self.scale_ri_by_k, kappa=kappa, shift_exit_wave=this_prj_offset)
-                    elif self.forward_algorithm == 'ctf':
-                        temp_real, temp_imag = modulate_and_get_ctf(subobj_ls_ls[k], energy_ev, this_dist, u_free, v_free, kappa=10 ** ctf_lg_kappa[0])
-                    else:
-                        raise ValueError('Invalid value for "forward_algorithm". ')
+                    temp_real, temp_imag = multislice_propagate_batch(
+                        subobj_ls_ls[k],
+                        subprobe_real_ls_ls[k][:, i_mode, :, :], subprobe_imag_ls_ls[k][:, i_mode, :, :],
+                        energy_ev, psize_cm * ds_level, kernel=h, free_prop_cm=None, binning=self.binning,
+                        obj_batch_shape=[len(pos_batch), *grid_shape, this_obj_size[-1]],
+                        fresnel_approx=fresnel_approx, pure_projection=pure_projection, device=device_obj,
+                        type=unknown_type, sign_convention=self.sign_convention,
+                        scale_ri_by_k=self.scale_ri_by_k, kappa=kappa, shift_exit_wave=this_prj_offset)
+                    if k == 0 and i_mode == 0:
+                        h_free_real, h_free_imag = self.get_free_prop_kernels(
+                            free_prop_cm, 1240. / energy_ev, np.array([psize_cm * ds_level] * 3) * 1.e7,
+                            temp_real.shape[-2:], u_free, v_free, optimize_free_prop, device=device_obj)
+                    # Shape of temp_real is [n_dists, len(pos_batch), y, x].
+                    temp_real, temp_imag = propagate_to_distances(temp_real, temp_imag, h_free_real, h_free_imag)
                     if i_mode == 0:
                         ex_int = temp_real ** 2 + temp_imag ** 2
                     else:
                         ex_int = ex_int + temp_real ** 2 + temp_imag ** 2
                 ex_mag_ls.append(w.sqrt(ex_int))
-
-        # Output shape is [minibatch_size, y, x].
-        if len(ex_mag_ls) > 1:
-            ex_mag_ls = w.concatenate(ex_mag_ls, 0)
+            # Reorder to distance-major, i.e., [n_dists * minibatch_size, y, x].
+            if len(ex_mag_ls) > 1:
+                ex_mag_ls = w.concatenate(ex_mag_ls, 1)
+            else:
+                ex_mag_ls = ex_mag_ls[0]
+            ex_mag_ls = w.reshape(ex_mag_ls, [-1, *ex_mag_ls.shape[2:]])
+        elif self.forward_algorithm == 'ctf':
+            for i_dist, this_dist in enumerate(free_prop_cm):
+                for k, pos_batch in enumerate(probe_pos_batch_ls):
+                    for i_mode in range(n_probe_modes):
+                        temp_real, temp_imag = modulate_and_get_ctf(subobj_ls_ls[k], energy_ev, this_dist, u_free, v_free, kappa=10 ** ctf_lg_kappa[0])
+                        if i_mode == 0:
+                            ex_int = temp_real ** 2 + temp_imag ** 2
+                        else:
+                            ex_int = ex_int + temp_real ** 2 + temp_imag ** 2
+                    ex_mag_ls.append(w.sqrt(ex_int))
+            # Output shape is [minibatch_size, y, x].
+            if len(ex_mag_ls) > 1:
+                ex_mag_ls = w.concatenate(ex_mag_ls, 0)
+            else:
+                ex_mag_ls = ex_mag_ls[0]
         else:
-            ex_mag_ls = ex_mag_ls[0]
+            raise ValueError('Invalid value for "forward_algorithm". ')
 
         if safe_zone_width > 0:
             ex_mag_ls = ex_mag_ls[:, safe_zone_width:safe_zone_width + subprobe_size[0],
@@ -1037,18 +1410,16 @@ class MultiDistModel(ForwardModel):
             this_ind_batch_full = this_ind_batch
             for i in range(1, n_dists):
                 this_ind_batch_full = np.concatenate([this_ind_batch_full, this_ind_batch + i * n_blocks])
-            this_prj_batch = prj[this_i_theta * theta_downsample, this_ind_batch_full]
-            this_prj_batch = w.create_variable(abs(this_prj_batch), requires_grad=False, device=self.device)
+            this_prj_batch = self.prj[this_i_theta * theta_downsample, this_ind_batch_full]
             if ds_level > 1:
-                this_prj_batch = this_prj_batch[:, :ds_level, ::ds_level]
+                this_prj_batch = this_prj_batch[:, ::ds_level, ::ds_level]
+            this_prj_batch = self.preprocess_data(this_prj_batch)
 
             if optimize_prj_affine:
-                scaled_prj_ls = []
-                for i in range(n_dists):
-                    this_prj_batch_idist = this_prj_batch[len(this_ind_batch) * i:len(this_ind_batch) * (i + 1)]
-                    this_prj_batch_idist = w.affine_transform(this_prj_batch_idist, prj_affine_ls[i])
-                    scaled_prj_ls.append(this_prj_batch_idist)
-                this_prj_batch = w.concatenate(scaled_prj_ls)
+                # Resample all distances in one call, with each distance's matrix repeated for its tiles.
+                affine_ls = w.reshape(prj_affine_ls, [n_dists, 1, 2, 3])
+                affine_ls = w.reshape(w.tile(affine_ls, [1, len(this_ind_batch), 1, 1]), [-1, 2, 3])
+                this_prj_batch = w.affine_transform(this_prj_batch, affine_ls)
 
             if optimize_probe_pos_offset:
                 this_offset = probe_pos_offset[this_i_theta]
@@ -1,2 +1,5 @@
 backend = 'autograd'
-disable_sameline_output = False
\ No newline at end of file
+disable_sameline_output = False
+# FFT provider of the Autograd backend. Choose from 'numpy', 'scipy', 'pyfftw'. See wrappers.configure_fft.
+fft_provider = 'numpy'
+fft_workers = 1
@@ -6,6 +6,7 @@ import re
 import sys
 import datetime
 import adorym.global_settings as global_settings
+from adorym.pseudo import LOCAL_COMM_ENV_NAME
 
 def check_config_indept_mpi():
     d = {}
@@ -24,6 +25,9 @@ def check_config_indept_mpi():
             d[k] = v
     except:
         pass
+    # Workers started by the local launcher in adorym.pseudo must use its communicator.
+    if os.environ.get(LOCAL_COMM_ENV_NAME) == '1':
+        d['independent_mpi'] = True
     return d
 
 project_config = check_config_indept_mpi()
@@ -251,12 +251,26 @@ class Optimizer(object):
             g = g / n_ranks
         return g
 
+    def apply_gradient_to_region(self, x, gradient, i_batch, region, **kwargs):
+        """
+        Update only the part of x that falls in region, leaving the rest of x and parameter arrays untouched.
+        Used with sparse gradient accumulation in data-parallelism mode.
+
+        :param x: Array or Tensor of the optimized variable (whole object).
+        :param gradient: Array or adorym.Gradient. Object-sized gradient; only the region is read.
+        :param region: Array with shape [2, 2]. See util.get_region_of_windows.
+        """
+        ss = get_region_slicer(region)
+        g = gradient.arr if isinstance(gradient, adorym.Gradient) else gradient
+        x[ss] = self.apply_gradient(x[ss], g[ss], i_batch, params_slicer=ss, **kwargs)
+        return x
+
     def get_array_slicer(self, slicer):
         if slicer == None:
             if len(self.params_list) > 0:
                 if len(self.params_whole_array_dict) > 0:
                     shape = self.params_whole_array_dict[list(self.params_whole_array_dict.keys())[0]].shape
-                    s = [slice(None)] * len(shape)
+                    s = tuple([slice(None)] * len(shape))
                 else:
                     s = None
             else:
@@ -270,6 +284,8 @@ class AdamOptimizer(Optimizer):
     def __init__(self, name, output_folder='.', distribution_mode=None, options_dict=None, forward_model=None):
         super(AdamOptimizer, self).__init__(name, output_folder=output_folder, params_list=['m', 'v'],
                                             distribution_mode=distribution_mode, options_dict=options_dict, forward_model=forward_model)
+        # Step number at which each lateral pixel was last updated. Only used by lazy updates.
+        self.last_update_step = None
         return
 
     def apply_gradient(self, x, gradient, i_batch, step_size=0.001, b1=0.9, b2=0.999, eps=1e-7, distribution_mode=False,
@@ -333,6 +349,27 @@ class AdamOptimizer(Optimizer):
         else:
             return x
 
+    def apply_gradient_to_region(self, x, gradient, i_batch, region, b1=0.9, b2=0.999, **kwargs):
+        """
+        Lazy Adam update restricted to region, in the style of LazyAdam. Moments of pixels that were outside the
+        updated regions for some steps are first decayed as if those steps were taken with zero gradient, so that
+        the bias correction using the global step count applies to them. The movement of x that a dense update
+        makes in those steps is skipped, as it has no closed form, so the iterates differ from a dense update.
+        """
+        ss = get_region_slicer(region)
+        if self.last_update_step is None:
+            self.last_update_step = np.full(self.whole_object_size[:2], -1, dtype='int64')
+        n_skipped = np.clip(i_batch - self.last_update_step[ss] - 1, 0, None)
+        if np.count_nonzero(n_skipped) > 0:
+            m = self.params_whole_array_dict['m']
+            n_skipped = np.reshape(n_skipped, list(n_skipped.shape) + [1] * (len(m.shape) - 2))
+            device = w.get_var_device(m)
+            m[ss] = m[ss] * w.create_constant(b1 ** n_skipped, dtype=w.get_dtype(m), device=device)
+            v = self.params_whole_array_dict['v']
+            v[ss] = v[ss] * w.create_constant(b2 ** n_skipped, dtype=w.get_dtype(v), device=device)
+        self.last_update_step[ss] = i_batch
+        return super(AdamOptimizer, self).apply_gradient_to_region(x, gradient, i_batch, region, b1=b1, b2=b2, **kwargs)
+
     def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=0.001, b1=0.9, b2=0.999, eps=1e-7, **kwargs):
 
         assert isinstance(obj, ObjectFunction)
@@ -366,6 +403,8 @@ class MomentumOptimizer(Optimizer):
         super(MomentumOptimizer, self).__init__(name, output_folder=output_folder, params_list=['v'],
                                           distribution_mode=distribution_mode, options_dict=options_dict,
                                           forward_model=forward_model)
+        # Step number at which each lateral pixel was last updated. Only used by lazy updates.
+        self.last_update_step = None
         return
 
     def apply_gradient(self, x, gradient, i_batch, step_size=0.001, gamma=0.9, use_numpy=False, params_slicer=None,
@@ -405,6 +444,34 @@ class MomentumOptimizer(Optimizer):
             self.params_whole_array_dict['v'][ss] = v
         return x
 
+    def apply_gradient_to_region(self, x, gradient, i_batch, region, gamma=0.9, **kwargs):
+        """
+        Lazy momentum update restricted to region. Pixels that were outside the updated regions for k steps are
+        first moved and decayed as if those steps were taken with zero gradient, i.e., x is moved by
+        (gamma + ... + gamma ** k) * v and v is scaled by gamma ** k, so that the iterates match a dense update.
+        Unlike the lazy update of AdamOptimizer, which skips this movement of x, no approximation is made.
+        """
+        ss = get_region_slicer(region)
+        if self.last_update_step is None:
+            self.last_update_step = np.full(self.whole_object_size[:2], -1, dtype='int64')
+        n_skipped = np.clip(i_batch - self.last_update_step[ss] - 1, 0, None)
+        if np.count_nonzero(n_skipped) > 0:
+            v = self.params_whole_array_dict['v']
+            n_skipped = np.reshape(n_skipped, list(n_skipped.shape) + [1] * (len(v.shape) - 2))
+            decay = gamma ** n_skipped
+            drift = n_skipped if gamma == 1 else gamma * (1 - decay) / (1 - gamma)
+            device = w.get_var_device(v)
+            dx = v[ss] * w.create_constant(drift, dtype=w.get_dtype(v), device=device)
+            if w.get_var_device_type(x) == 'cuda':
+                dx = w.to_gpu(dx, w.get_var_device(x))
+            else:
+                dx = w.to_cpu(dx)
+            x[ss] = x[ss] - dx
+            v[ss] = v[ss] * w.create_constant(decay, dtype=w.get_dtype(v), device=device)
+        self.last_update_step[ss] = i_batch
+        return super(MomentumOptimizer, self).apply_gradient_to_region(x, gradient, i_batch, region, gamma=gamma,
+                                                                       **kwargs)
+
     def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=0.001, gamma=0.9, **kwargs):
 
         assert isinstance(obj, ObjectFunction)
@@ -496,8 +563,17 @@ class CurveballOptimizer(Optimizer):
         self.lmbda = 1
         self.z_chunk = None
         self.dz_chunk = None
+        # J z and H J z at the current linearization point, computed in calculate_dz and reused in
+        # calculate_beta_rho.
+        self.jz_cache = None
         return
 
+    def get_jz_and_hjz(self, differentiator):
+        key = (id(differentiator), differentiator.i_linearization)
+        if self.jz_cache is None or self.jz_cache[0] != key or self.jz_cache[1] is not self.z_chunk:
+            self.jz_cache = (key, self.z_chunk, *differentiator.get_jvp_and_hjvp(self.z_chunk))
+        return self.jz_cache[2:]
+
     def calculate_dz(self, differentiator, use_numpy=False):
         """
         In DO, dz will be synchronized as Gradient class after this step.
@@ -507,13 +583,17 @@ class CurveballOptimizer(Optimizer):
         if self.z_chunk is None:
             self.z_chunk = malias.zeros(differentiator.full_grad.shape)
         print_flush('  Curveball damping factor lambda is {}.'.format(self.lmbda), 0, rank)
-        self.dz_chunk = differentiator.func_gvp(self.z_chunk) + self.lmbda * self.z_chunk + differentiator.full_grad
+        _, hjz = self.get_jz_and_hjz(differentiator)
+        gvp_z = differentiator.func_vjp(hjz)[0]
+        self.dz_chunk = gvp_z + self.lmbda * self.z_chunk + differentiator.full_grad
         return self.dz_chunk
 
     def calculate_beta_rho(self, differentiator, use_numpy=False):
         """
         Parameters are calculated using chunks when working with DO. In DP mode, self.dz_chunk and
         self.z_chunk should match object size.
+        Gauss-Newton quadratic forms are evaluated in data space as inner products of J v and H J v, so only one
+        more JVP (of dz) is needed after calculate_dz.
         """
         malias = np if use_numpy else w
         assert isinstance(differentiator, adorym.Differentiator)
@@ -521,9 +601,11 @@ class CurveballOptimizer(Optimizer):
             self.z_chunk = malias.zeros(differentiator.full_grad.shape)
         if self.dz_chunk is None:
             self.dz_chunk = malias.zeros(differentiator.full_grad.shape)
-        a11 = malias.sum(self.dz_chunk * differentiator.func_gvp(self.dz_chunk))
-        a12 = malias.sum(self.z_chunk * differentiator.func_gvp(self.dz_chunk))
-        a22 = malias.sum(self.z_chunk * differentiator.func_gvp(self.z_chunk))
+        jz, hjz = self.get_jz_and_hjz(differentiator)
+        jdz, hjdz = differentiator.get_jvp_and_hjvp(self.dz_chunk)
+        a11 = malias.sum(jdz * hjdz)
+        a12 = malias.sum(jz * hjdz)
+        a22 = malias.sum(jz * hjz)
         a11 = a11 + malias.sum(self.dz_chunk * self.dz_chunk) * self.lmbda
         a12 = a12 + malias.sum(self.z_chunk * self.dz_chunk) * self.lmbda
         a22 = a22 + malias.sum(self.z_chunk * self.z_chunk) * self.lmbda
@@ -594,6 +676,8 @@ class CGOptimizer(Optimizer):
                                           distribution_mode=distribution_mode, options_dict=options_dict, forward_model=forward_model)
         self.i_line_search_step = 0
         self._diag_precondition_t = None
+        # Loss at the step accepted by the last line search.
+        self.last_loss = None
         return
 
     def _calculate_PR_beta(self, ss, i_batch):
@@ -639,8 +723,16 @@ class CGOptimizer(Optimizer):
             if not isinstance(forward_model, adorym.ForwardModel):
                 raise ValueError('ForwardModel must be supplied either through Gradient object or upon optimizer instantiation.')
         self._descent_dir_t = -g
-        loss_kwargs = forward_model.loss_args
+        # Fixed inputs are collected once; only the optimized variable is replaced in each trial. The measured data
+        # of the batch are also read once and held for all trials.
+        loss_kwargs = dict(forward_model.loss_args)
         loss_fn = forward_model.get_loss_function()
+        data_held_here = False
+        if 'this_i_theta' in loss_kwargs.keys() and 'this_ind_batch' in loss_kwargs.keys():
+            common_vars = forward_model.common_vars if forward_model.common_vars is not None else {}
+            data_held_here = forward_model.hold_batch_data(loss_kwargs['this_i_theta'], loss_kwargs['this_ind_batch'],
+                                                           theta_downsample=common_vars.get('theta_downsample', None),
+                                                           ds_level=common_vars.get('ds_level', 1))
 
         _s_t = self.params_whole_array_dict['s'][ss]
         device_0 = w.get_var_device(_s_t)
@@ -677,8 +769,13 @@ class CGOptimizer(Optimizer):
                                                  descent_dir=s_new,
                                                  gradient=g,
                                                  f0=forward_model.current_loss)
+        if data_held_here:
+            forward_model.release_batch_data()
 
         x = linesearch_out.newx
+        # current_loss holds the loss of the last trial, which may have been rejected.
+        self.last_loss = float(w.to_numpy(linesearch_out.newf))
+        forward_model.current_loss = self.last_loss
 
         if device_type_0 == 'cpu':
             s_new = w.to_cpu(s_new)
@@ -692,6 +789,202 @@ class CGOptimizer(Optimizer):
         self.i_line_search_step += linesearch_out.step_count
         return x
 
+class LBFGSOptimizer(Optimizer):
+    """
+    Limited-memory BFGS optimizer. The search direction is found with the two-loop recursion over the last
+    n_history curvature pairs s_k = x_{k+1} - x_k and y_k = g_{k+1} - g_k. Pairs with non-positive curvature, which
+    may occur with minibatch gradients, are skipped, and the history is cleared whenever the direction found is not
+    a descent direction.
+
+    With distribution_mode=None, the step size is found with BackTrackingLineSearch on the loss provided by the
+    ForwardModel, as in CGOptimizer. In distributed_object and shared_file modes, the loss of a part of the object
+    cannot be evaluated, so the step is not searched: the first step has length step_size along the negative
+    gradient, and later steps are the unit quasi-Newton steps. In these modes, all inner products are summed over
+    the ranks holding parts of the object.
+
+    A separate history is kept for each params_slicer, so that one instance can optimize independent variables
+    stored in slices of the same array (e.g., tiles of different angles in ADMM subproblems).
+
+    :param n_history: Int. Number of curvature pairs kept.
+    :param history_on_disk: Bool. If True, curvature pairs are kept in memory-mapped files in
+                            output_folder/lbfgs_history instead of on the device.
+    """
+    def __init__(self, name, output_folder='.', distribution_mode=None, options_dict=None, forward_model=None,
+                 n_history=10, history_on_disk=False):
+        super(LBFGSOptimizer, self).__init__(name, output_folder=output_folder, params_list=[],
+                                             distribution_mode=distribution_mode, options_dict=options_dict,
+                                             forward_model=forward_model)
+        self.n_history = n_history
+        self.history_on_disk = history_on_disk
+        self.state_dict = {}
+        self.reduce_comm = None
+        self.i_line_search_step = 0
+        return
+
+    def create_distributed_param_arrays(self, whole_object_size, use_numpy=False, dtype='float32'):
+        super(LBFGSOptimizer, self).create_distributed_param_arrays(whole_object_size, use_numpy=use_numpy,
+                                                                    dtype=dtype)
+        # Ranks without a slab do not call apply_gradient, so inner products are reduced among slab holders only.
+        self.reduce_comm = comm.Split(0 if self.slice_catalog[rank] is not None else 1, rank)
+
+    def _get_state(self, key):
+        if key not in self.state_dict.keys():
+            self.state_dict[key] = {'x_prev': None, 'g_prev': None, 'slot_ls': [], 'rho_ls': [], 'gamma': 1.,
+                                    'pair_dict': {}, 'i_key': len(self.state_dict)}
+        return self.state_dict[key]
+
+    def _dot(self, a, b, use_numpy=False):
+        malias = np if use_numpy else w
+        d = float(malias.sum(a * b))
+        if self.reduce_comm is not None:
+            d = self.reduce_comm.allreduce(d)
+        return d
+
+    def _push_pair(self, state, s, y, rho):
+        if len(state['slot_ls']) == self.n_history:
+            slot = state['slot_ls'].pop(0)
+            state['rho_ls'].pop(0)
+        else:
+            slot = len(state['slot_ls'])
+        if self.history_on_disk:
+            if 's' not in state['pair_dict'].keys():
+                path = os.path.join(self.output_folder, 'lbfgs_history')
+                if not os.path.exists(path):
+                    os.makedirs(path, exist_ok=True)
+                for k in ['s', 'y']:
+                    fname = os.path.join(path, '{}_{}_{}_rank_{}.npy'.format(self.name, k, state['i_key'], rank))
+                    state['pair_dict'][k] = np.lib.format.open_memmap(fname, mode='w+', dtype='float32',
+                                                                      shape=(self.n_history, *s.shape))
+            state['pair_dict']['s'][slot] = w.to_numpy(s)
+            state['pair_dict']['y'][slot] = w.to_numpy(y)
+        else:
+            state['pair_dict'][slot] = (s, y)
+        state['slot_ls'].append(slot)
+        state['rho_ls'].append(rho)
+
+    def _get_pair(self, state, i, like, use_numpy=False):
+        slot = state['slot_ls'][i]
+        if not self.history_on_disk:
+            return state['pair_dict'][slot]
+        s = np.array(state['pair_dict']['s'][slot])
+        y = np.array(state['pair_dict']['y'][slot])
+        if not use_numpy:
+            s = w.create_constant(s, device=w.get_var_device(like))
+            y = w.create_constant(y, device=w.get_var_device(like))
+        return s, y
+
+    def _clear_history(self, state):
+        state['slot_ls'] = []
+        state['rho_ls'] = []
+
+    def get_direction(self, g, state, use_numpy=False):
+        """
+        Get the quasi-Newton direction -H g with the two-loop recursion.
+        """
+        n = len(state['slot_ls'])
+        q = g
+        alpha_ls = [0] * n
+        for i in range(n - 1, -1, -1):
+            s, y = self._get_pair(state, i, g, use_numpy=use_numpy)
+            alpha_ls[i] = state['rho_ls'][i] * self._dot(s, q, use_numpy=use_numpy)
+            q = q - alpha_ls[i] * y
+        r = state['gamma'] * q if n > 0 else q
+        for i in range(n):
+            s, y = self._get_pair(state, i, g, use_numpy=use_numpy)
+            beta = state['rho_ls'][i] * self._dot(y, r, use_numpy=use_numpy)
+            r = r + (alpha_ls[i] - beta) * s
+        return -r
+
+    def apply_gradient(self, x, gradient, i_batch=None, step_size=1., use_linesearch=True, max_backtracking_iter=None,
+                       use_numpy=False, params_slicer=None, **kwargs):
+        """
+        Use calculated gradient to update the variable being optimized.
+        :param x: Array or Tensor of the optimized variable.
+        :param gradient: Array or adorym.Gradient. The ForwardModel instance (which is needed for providing loss
+            function for line search) can be supplied through the Gradient instance or upon instantiation.
+        :param step_size: Float. Length of the first step, taken before any curvature pair is collected.
+        :param use_linesearch: Bool. Whether to search the step size. Only effective with distribution_mode=None.
+        """
+        ss = self.get_array_slicer(params_slicer)
+        g = self.convert_gradient(gradient)
+        malias = np if use_numpy else w
+        state = self._get_state(repr(ss))
+
+        if state['x_prev'] is not None:
+            s = x - state['x_prev']
+            y = g - state['g_prev']
+            sy = self._dot(s, y, use_numpy=use_numpy)
+            yy = self._dot(y, y, use_numpy=use_numpy)
+            if sy > 1e-10 * yy and yy > 0:
+                self._push_pair(state, s, y, 1. / sy)
+                state['gamma'] = sy / yy
+        d = self.get_direction(g, state, use_numpy=use_numpy)
+        if self._dot(d, g, use_numpy=use_numpy) >= 0:
+            self._clear_history(state)
+            d = -g
+        is_first_step = len(state['slot_ls']) == 0
+
+        forward_model = None
+        if use_linesearch and self.distribution_mode is None:
+            try:
+                forward_model = gradient.forward_model
+            except:
+                forward_model = self.forward_model
+        if isinstance(forward_model, adorym.ForwardModel):
+            loss_kwargs = forward_model.loss_args
+            loss_fn = forward_model.get_loss_function()
+
+            def _loss_and_update_fn(x, y):
+                update = x + y
+                if self.name == 'probe':
+                    loss_kwargs['probe_real'] = update[:, :, :, 0]
+                    loss_kwargs['probe_imag'] = update[:, :, :, 1]
+                else:
+                    loss_kwargs[self.name] = update
+                loss = loss_fn(**loss_kwargs)
+                return loss, update
+
+            linesearch = BackTrackingLineSearch(maxiter=max_backtracking_iter,
+                                                initial_stepsize=step_size if is_first_step else 1.,
+                                                normalize_alpha=is_first_step)
+            linesearch_out = linesearch.search(_loss_and_update_fn, x0=x, descent_dir=d, gradient=g,
+                                               f0=forward_model.current_loss)
+            x_new = linesearch_out.newx
+            self.i_line_search_step += linesearch_out.step_count
+        else:
+            alpha = step_size / np.sqrt(self._dot(d, d, use_numpy=use_numpy)) if is_first_step else 1.
+            x_new = x + alpha * d
+
+        state['x_prev'] = x
+        state['g_prev'] = g
+        self.i_batch += 1
+        return x_new
+
+    def apply_gradient_to_file(self, obj, gradient, i_batch=None, step_size=1., **kwargs):
+        """
+        Update the object in shared-file mode. Each rank updates its slices, range(rank, n_slices, n_ranks), and
+        keeps the history of these slices. This is a collective call.
+        """
+        assert isinstance(obj, ObjectFunction)
+        assert isinstance(gradient, Gradient)
+        s = obj.dset.shape
+        slice_ls = list(range(rank, s[0], n_ranks))
+        self.reduce_comm = comm
+
+        backend_temp = global_settings.backend
+        global_settings.backend = 'autograd'
+
+        x = np.zeros([len(slice_ls), *s[1:]], dtype='float32')
+        g = np.zeros([len(slice_ls), *s[1:]], dtype='float32')
+        for i, i_slice in enumerate(slice_ls):
+            x[i] = obj.dset[i_slice]
+            g[i] = gradient.dset[i_slice] / n_ranks
+        x = self.apply_gradient(x, g, i_batch, step_size=step_size, use_linesearch=False, use_numpy=True)
+        for i, i_slice in enumerate(slice_ls):
+            obj.dset[i_slice] = x[i]
+        global_settings.backend = backend_temp
+
+
 class ScipyOptimizer(Optimizer):
     """
     API binding to scopy.optimizer.minimize. WORKS FOR DATA-PARALLELISM MODE AND AUTOGRAD ONLY.
@@ -51,21 +51,27 @@ def gen_mesh(max, shape):
     return res
 
 
-def gen_freq_mesh(voxel_nm, shape):
+def gen_freq_mesh(voxel_nm, shape, x_range=None):
+    """
+    :param x_range: Optional [start, end]. If given, only these columns of the mesh are generated.
+    """
     u = np.fft.fftfreq(shape[0])
     v = np.fft.fftfreq(shape[1])
+    if x_range is not None:
+        v = v[x_range[0]:x_range[1]]
     vv, uu = np.meshgrid(v, u)
     vv /= voxel_nm[1]
     uu /= voxel_nm[0]
     return uu, vv
 
-def get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=True, sign_convention=1):
+def get_kernel(dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=True, sign_convention=1, x_range=None):
     """Get unshifted Fresnel propagation kernel for TF algorithm.
 
     :param u, v: Reciprocal space meshgrids.
     :param dist_nm: Propagation distance in nm.
+    :param x_range: Optional [start, end]. If given, only these columns of the kernel are computed.
     """
-    u, v = gen_freq_mesh(voxel_nm, grid_shape[0:2])
+    u, v = gen_freq_mesh(voxel_nm, grid_shape[0:2], x_range=x_range)
     if fresnel_approx:
         # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
         # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
@@ -103,6 +109,45 @@ def get_kernel_wrapped(u, v, dist_nm, lmbda_nm, voxel_nm, grid_shape, fresnel_ap
     return h_real, h_imag
 
 
+def get_kernel_wrapped_stack(u, v, dist_nm_ls, lmbda_nm, fresnel_approx=True, sign_convention=1):
+    """Get unshifted Fresnel propagation kernels for a list of distances in one shot. The frequency-dependent
+    part is evaluated once, and all exponentials are taken in a single broadcast call.
+
+    :param u, v: Reciprocal space meshgrids.
+    :param dist_nm_ls: 1D array or tensor of propagation distances in nm. Can be a tensor requiring gradient.
+    :return: Real and imaginary parts of the kernels, each with shape [n_dists, len_y, len_x].
+    """
+    dist_nm_ls = w.reshape(dist_nm_ls, [-1, 1, 1])
+    if fresnel_approx:
+        # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
+        # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
+        phase = (-sign_convention * PI * lmbda_nm * (u ** 2 + v ** 2)) * dist_nm_ls
+        return w.cos(phase), w.sin(phase)
+    else:
+        quad = 1 - lmbda_nm ** 2 * (u ** 2 + v ** 2)
+        quad_inner = w.clip(quad, 0, None)
+        quad_mask = (quad > 0)
+        phase = (sign_convention * 2 * PI / lmbda_nm * w.sqrt(quad_inner)) * dist_nm_ls
+        return w.cos(phase) * quad_mask, w.sin(phase) * quad_mask
+
+
+def propagate_to_distances(probe_real, probe_imag, h_real_ls, h_imag_ls):
+    """Propagate a batch of wavefields to several distances at once. The wavefields are Fourier transformed only
+    once; the distance dimension is folded into the batch of the inverse transform.
+
+    :param probe_real, probe_imag: Wavefields with shape [..., len_y, len_x].
+    :param h_real_ls, h_imag_ls: Unshifted transfer functions with shape [n_dists, len_y, len_x].
+    :return: Propagated wavefields with shape [n_dists, ..., len_y, len_x].
+    """
+    kernel_shape = [h_real_ls.shape[0]] + [1] * (len(probe_real.shape) - 2) + list(h_real_ls.shape[-2:])
+    h_real_ls = w.reshape(h_real_ls, kernel_shape)
+    h_imag_ls = w.reshape(h_imag_ls, kernel_shape)
+    f_real, f_imag = w.fft2(probe_real, probe_imag)
+    fh_real = f_real * h_real_ls - f_imag * h_imag_ls
+    fh_imag = f_real * h_imag_ls + f_imag * h_real_ls
+    return w.ifft2(fh_real, fh_imag)
+
+
 def get_kernel_ir(dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=1):
 
     """
@@ -134,8 +179,16 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
                                normalize_fft=False, sign_convention=1, optimize_free_prop=False, u_free=None, v_free=None,
                                scale_ri_by_k=True, is_minus_logged=False, pure_projection_return_sqrt=False,
                                kappa=None, repeating_slice=None, return_fft_time=False, shift_exit_wave=None,
-                               return_intermediate_wavefields=False):
-
+                               return_intermediate_wavefields=False, slab_fft=None):
+    """
+    :param slab_fft: Optional adorym.distributed_fft.SlabFFT2D object. If given, grid_batch and the probe hold only
+        the local stripe of rows of the full field, and all propagations are done collectively with the
+        slab-decomposed FFT. Not compatible with far-field propagation, optimize_free_prop or shift_exit_wave.
+    """
+    if slab_fft is not None and (shift_exit_wave is not None or optimize_free_prop or
+                                 (isinstance(free_prop_cm, str) and free_prop_cm == 'inf')):
+        raise ValueError('Slab-decomposed FFT does not support far-field propagation, optimize_free_prop or '
+                         'shift_exit_wave.')
     intermediate_wavefield_real_ls = []
     intermediate_wavefield_imag_ls = []
     minibatch_size = grid_batch.shape[0]
@@ -193,15 +246,18 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
         probe_real, probe_imag = (probe_real * c_real - probe_imag * c_imag, probe_real * c_imag + probe_imag * c_real)
 
     else:
-        if kernel is not None:
-            h = kernel
+        if slab_fft is not None:
+            h = slab_fft.get_kernel(delta_nm * binning, lmbda_nm, voxel_nm, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
         else:
-            # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
-            # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
-            h = get_kernel(delta_nm * binning, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
-        h_real, h_imag = np.real(h), np.imag(h)
-        h_real = w.create_variable(h_real, requires_grad=False, device=device)
-        h_imag = w.create_variable(h_imag, requires_grad=False, device=device)
+            if kernel is not None:
+                h = kernel
+            else:
+                # Use sign_convention = 1 for Goodman convention: exp(ikz); n = 1 - delta + i * beta
+                # Use sign_convention = -1 for opposite convention: exp(-ikz); n = 1 - delta - i * beta
+                h = get_kernel(delta_nm * binning, lmbda_nm, voxel_nm, grid_shape, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
+            h_real, h_imag = np.real(h), np.imag(h)
+            h_real = w.create_variable(h_real, requires_grad=False, device=device)
+            h_imag = w.create_variable(h_imag, requires_grad=False, device=device)
 
         t_tot = 0
         n_steps = int(np.ceil(n_slices / binning))
@@ -251,7 +307,13 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
             # When arriving at the last slice of bin or object, do propagation.
             # ==========================================
             if i_step < n_steps - 1:
-                if this_step == binning:
+                if slab_fft is not None:
+                    if this_step == binning:
+                        probe_real, probe_imag = slab_fft.convolve(probe_real, probe_imag, h)
+                    else:
+                        probe_real, probe_imag = slab_fft.convolve(probe_real, probe_imag,
+                            slab_fft.get_kernel(delta_nm * this_step, lmbda_nm, voxel_nm, sign_convention=sign_convention))
+                elif this_step == binning:
                     probe_real, probe_imag = w.convolve_with_transfer_function(probe_real, probe_imag, h_real, h_imag)
                 else:
                     probe_real, probe_imag = fresnel_propagate(probe_real, probe_imag, delta_nm * this_step, lmbda_nm, voxel_nm, device=device, sign_convention=sign_convention)
@@ -271,7 +333,10 @@ def multislice_propagate_batch(grid_batch, probe_real, probe_imag, energy_ev, ps
         else:
             dist_nm = free_prop_cm * 1e7
             l = np.prod(size_nm)**(1. / 3)
-            if optimize_free_prop:
+            if slab_fft is not None:
+                probe_real, probe_imag = slab_fft.convolve(probe_real, probe_imag,
+                    slab_fft.get_kernel(dist_nm, lmbda_nm, voxel_nm, sign_convention=sign_convention))
+            elif optimize_free_prop:
                     probe_real, probe_imag = fresnel_propagate_wrapped(u_free, v_free, probe_real, probe_imag, dist_nm,
                                                                        lmbda_nm, voxel_nm,
                                                                        device=device, sign_convention=sign_convention)
@@ -479,8 +544,12 @@ def modulate_and_get_ctf(grid_batch, energy_ev, free_prop_cm, u_free=None, v_fre
 def sparse_multislice_propagate_batch(u, v, grid_batch, probe_real, probe_imag, energy_ev, psize_cm,
                                       slice_pos_cm_ls, free_prop_cm=None, obj_batch_shape=None, fresnel_approx=True,
                                       device=None, type='delta_beta', normalize_fft=False, sign_convention=1,
-                                      scale_ri_by_k=True, shift_exit_wave=None):
-
+                                      scale_ri_by_k=True, shift_exit_wave=None, h_ls=None):
+    """
+    :param h_ls: Optional list of [h_real, h_imag] holding the propagation kernels of all slice gaps, each with
+        shape [n_slices - 1, len_y, len_x], as returned by ``get_kernel_wrapped_stack``. If None, the kernels are
+        computed here in one batched call and shared by all gaps.
+    """
     minibatch_size = grid_batch.shape[0]
     grid_shape = grid_batch.shape[1:-1]
     voxel_nm = np.array([psize_cm] * 3) * 1.e7
@@ -493,6 +562,10 @@ def sparse_multislice_propagate_batch(u, v, grid_batch, probe_real, probe_imag,
     n_slices = grid_batch.shape[-2]
     delta_nm = voxel_nm[-1]
 
+    if h_ls is None and n_slices > 1:
+        h_ls = get_kernel_wrapped_stack(u, v, slice_pos_nm_ls[1:] - slice_pos_nm_ls[:-1], lmbda_nm,
+                                        fresnel_approx=fresnel_approx, sign_convention=sign_convention)
+
     for i in range(n_slices):
         # At the start of bin, initialize slice array.
         delta_slice = grid_batch[:, :, :, i, 0]
@@ -512,8 +585,7 @@ def sparse_multislice_propagate_batch(u, v, grid_batch, probe_real, probe_imag,
         if i < n_slices - 1:
             # pr, pi = w.to_numpy(probe_real), w.to_numpy(probe_imag)
             # dxchange.write_tiff(pr ** 2 + pi ** 2, 'debug/probe0', dtype='float32')
-            probe_real, probe_imag = fresnel_propagate_wrapped(u, v, probe_real, probe_imag, slice_pos_nm_ls[i + 1] - slice_pos_nm_ls[i],
-                                                               lmbda_nm, voxel_nm, device=device, sign_convention=sign_convention)
+            probe_real, probe_imag = w.convolve_with_transfer_function(probe_real, probe_imag, h_ls[0][i], h_ls[1][i])
             # pr, pi = w.to_numpy(probe_real), w.to_numpy(probe_imag)
             # dxchange.write_tiff(pr ** 2 + pi ** 2, 'debug/probe1', dtype='float32')
 
@@ -563,6 +635,8 @@ def fresnel_propagate_wrapped(u, v, probe_real, probe_imag, dist_nm, lmbda_nm, v
         grid_shape = probe_real.shape
     if h is None:
         h_real, h_imag = get_kernel_wrapped(u, v, dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention)
+    else:
+        h_real, h_imag = h
     probe_real, probe_imag = w.convolve_with_transfer_function(probe_real, probe_imag, h_real, h_imag,
                                                                override_backend=override_backend)
     return probe_real, probe_imag
@@ -581,6 +655,8 @@ def ctf(u, v, probe_real, probe_imag, dist_nm, lmbda_nm, voxel_nm, h=None,
     probe_real, probe_imag = w.fft2(probe_real, probe_imag, override_backend=override_backend, normalize=True)
     if h is None:
         h_real, h_imag = get_kernel_wrapped(u, v, dist_nm, lmbda_nm, voxel_nm, grid_shape, sign_convention=sign_convention, device=device)
+    else:
+        h_real, h_imag = h
     a1_real, a1_imag = w.complex_mul(probe_real, -probe_imag, h_real, h_imag)
     a2_real, a2_imag = w.complex_mul(probe_real, probe_imag, h_real, -h_imag)
     probe_real, probe_imag = w.convolve_with_impulse_response(a1_real, a1_imag, a2_real, a2_imag, override_backend=override_backend, normalize=True)
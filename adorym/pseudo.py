@@ -1,3 +1,26 @@
+# A pseudo MPI module in case mpi4py cannot be imported or independent_mpi is set. By default, it provides a
+# single-rank communicator. When a script is started with the local launcher, i.e.,
+#
+#     python -m adorym.pseudo -n 4 script.py [args]
+#
+# 4 worker processes are spawned on the local machine, and the communicator implements the collectives used in
+# Adorym over shared memory.
+
+import os
+import sys
+import time
+import zlib
+import uuid
+import struct
+import pickle
+import runpy
+import argparse
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
 # A pseudo Horovod class in case Horovod cannot be imported.
 
 class Hvd(object):
@@ -24,37 +47,371 @@ class Hvd(object):
         return op
 
 
+LOCAL_COMM_ENV_NAME = 'ADORYM_LOCAL_COMM'
+_poll_interval = 1e-5
+
+
+def _get_local_context_from_env():
+    # Rank, size and session are passed to workers through the environment, so that they are known before
+    # Adorym's modules query the communicator at import. The lock is set by _run_worker.
+    try:
+        return {'rank': int(os.environ[LOCAL_COMM_ENV_NAME + '_RANK']),
+                'size': int(os.environ[LOCAL_COMM_ENV_NAME + '_SIZE']),
+                'session': os.environ[LOCAL_COMM_ENV_NAME + '_SESSION'],
+                'lock': None}
+    except KeyError:
+        return None
+
+# None means single-process mode.
+_local_context = _get_local_context_from_env()
+
+
+def _attach(name):
+    # Workers share the resource tracker of the launcher, so attaching does not add a duplicate registration.
+    return shared_memory.SharedMemory(name=name)
+
+
+def _write_segment(name, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=len(data) + 8)
+    # The size is written last, so that a reader polling the segment never sees a partial message.
+    shm.buf[8:8 + len(data)] = data
+    struct.pack_into('q', shm.buf, 0, len(data))
+    return shm
+
+
+def _read_segment(name, unlink=False):
+    try:
+        shm = _attach(name)
+    except ValueError:
+        # Created but not yet sized.
+        raise FileNotFoundError(name)
+    n = struct.unpack_from('q', shm.buf, 0)[0]
+    if n == 0:
+        # Created but not yet written.
+        shm.close()
+        raise FileNotFoundError(name)
+    obj = pickle.loads(bytes(shm.buf[8:8 + n]))
+    shm.close()
+    if unlink:
+        shm.unlink()
+    return obj
+
+
+def _poll_segment(name):
+    while True:
+        try:
+            return _read_segment(name, unlink=True)
+        except FileNotFoundError:
+            time.sleep(_poll_interval)
+
+
+def _put_vector(recvbuf, i, data):
+    # recvbuf is [buffer, counts, (displacements), (datatype)] as in mpi4py.
+    buf, counts = recvbuf[0], recvbuf[1]
+    if len(recvbuf) > 2 and isinstance(recvbuf[2], (list, tuple, np.ndarray)):
+        displs = recvbuf[2]
+    else:
+        displs = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    buf.reshape(-1)[displs[i]:displs[i] + counts[i]] = np.reshape(data, -1)
+
+
+def _max(a, b):
+    if isinstance(a, np.ndarray) or np.isscalar(a):
+        return np.maximum(a, b)
+    return a.maximum(b)
+
+
+def _min(a, b):
+    if isinstance(a, np.ndarray) or np.isscalar(a):
+        return np.minimum(a, b)
+    return a.minimum(b)
+
+
 class Comm():
 
-    def __init__(self):
-        pass
+    def __init__(self, ranks=None, comm_id='w'):
+        """
+        :param ranks: List of Int. World ranks of the members in the order of their ranks in this communicator.
+                      If None, this is the world communicator.
+        :param comm_id: String. Identifier shared by all members, used for naming shared memory segments.
+        """
+        self._ranks = ranks
+        self._comm_id = comm_id
+        self._seq = 0
+        self._p2p_seq = {}
+        self._barrier_shm = None
+
+    def _is_local(self):
+        return _local_context is not None
+
+    def _get_ranks(self):
+        if self._ranks is None:
+            return list(range(_local_context['size']))
+        return self._ranks
+
+    def _get_name(self, *args):
+        return '{}{}_{}'.format(_local_context['session'], self._comm_id, '_'.join([str(a) for a in args]))
 
     def Get_rank(self):
-        return 0
+        if not self._is_local():
+            return 0
+        return self._get_ranks().index(_local_context['rank'])
 
     def Get_size(self):
-        return 1
+        if not self._is_local():
+            return 1
+        return len(self._get_ranks())
+
+    def Get_attr(self, keyval):
+        # Tags are not limited by shared memory, but report the smallest bound the MPI standard allows, so that
+        # a script exceeding it fails here as it would with mpi4py.
+        return {MPI.TAG_UB: 32767}.get(keyval)
 
     def Barrier(self):
-        pass
+        if not self._is_local() or self.Get_size() == 1:
+            return
+        if self._barrier_shm is None:
+            self._barrier_shm = _attach(self._get_name('b'))
+        buf = self._barrier_shm.buf
+        with _local_context['lock']:
+            count, gen = struct.unpack_from('qq', buf, 0)
+            count += 1
+            if count == self.Get_size():
+                struct.pack_into('qq', buf, 0, 0, gen + 1)
+                return
+            struct.pack_into('qq', buf, 0, count, gen)
+        while struct.unpack_from('qq', buf, 0)[1] == gen:
+            time.sleep(_poll_interval)
+
+    def barrier(self):
+        self.Barrier()
+
+    def _allgather(self, a):
+        seq = self._seq
+        self._seq += 1
+        shm = _write_segment(self._get_name(seq, self.Get_rank()), a)
+        self.Barrier()
+        res = [a if i == self.Get_rank() else _read_segment(self._get_name(seq, i)) for i in range(self.Get_size())]
+        self.Barrier()
+        shm.close()
+        shm.unlink()
+        return res
+
+    def allgather(self, a):
+        if not self._is_local():
+            return [a]
+        return self._allgather(a)
 
     def bcast(self, a, root=0):
+        if not self._is_local() or self.Get_size() == 1:
+            return a
+        seq = self._seq
+        self._seq += 1
+        if self.Get_rank() == root:
+            shm = _write_segment(self._get_name(seq, root), a)
+        self.Barrier()
+        if self.Get_rank() != root:
+            a = _read_segment(self._get_name(seq, root))
+        self.Barrier()
+        if self.Get_rank() == root:
+            shm.close()
+            shm.unlink()
         return a
 
     def Bcast(self, a, root=0):
+        res = self.bcast(a, root=root)
+        if self.Get_rank() != root:
+            a[...] = res
         return a
 
     def alltoall(self, a):
-        return a
+        if not self._is_local() or self.Get_size() == 1:
+            return a
+        seq = self._seq
+        self._seq += 1
+        my_rank = self.Get_rank()
+        n = self.Get_size()
+        shm_ls = [_write_segment(self._get_name(seq, my_rank, i), a[i]) for i in range(n) if i != my_rank]
+        self.Barrier()
+        res = [a[i] if i == my_rank else _read_segment(self._get_name(seq, i, my_rank)) for i in range(n)]
+        self.Barrier()
+        for shm in shm_ls:
+            shm.close()
+            shm.unlink()
+        return res
 
-    def allreduce(self, a):
-        return a
+    def allreduce(self, a, op=None):
+        if not self._is_local() or self.Get_size() == 1:
+            return a
+        # Reduce in the order of ranks, so that all ranks get bit-identical results.
+        f = {None: lambda x, y: x + y, MPI.SUM: lambda x, y: x + y, MPI.MAX: _max, MPI.MIN: _min}[op]
+        a_ls = self._allgather(a)
+        res = a_ls[0]
+        for x in a_ls[1:]:
+            res = f(res, x)
+        return res
 
-    def Allreduce(self, a):
-        return a
+    def Allreduce(self, a, b=None, op=None):
+        res = self.allreduce(a, op=op)
+        if b is not None:
+            b[...] = res
+            return b
+        return res
+
+    def send(self, a, dest, tag=0):
+        if not self._is_local():
+            return
+        key = (dest, tag)
+        n = self._p2p_seq.get(key, 0)
+        self._p2p_seq[key] = n + 1
+        # Unlinked by the receiver.
+        shm = _write_segment(self._get_name('p', self.Get_rank(), dest, tag, n), a)
+        shm.close()
+
+    def recv(self, source=0, tag=0):
+        if not self._is_local():
+            return None
+        key = (source, tag)
+        n = self._p2p_seq.get(key, 0)
+        self._p2p_seq[key] = n + 1
+        return _poll_segment(self._get_name('p', source, self.Get_rank(), tag, n))
+
+    def Igatherv(self, sendbuf, recvbuf=None, root=0):
+        """
+        Gather arrays into a buffer on root. recvbuf is [buffer, counts], optionally followed by displacements and
+        a datatype, and is only used on root. Non-root ranks do not wait for root; root receives in Wait.
+        """
+        my_rank = self.Get_rank()
+        if not self._is_local() or self.Get_size() == 1:
+            _put_vector(recvbuf, my_rank, sendbuf)
+            return Request()
+        seq = self._seq
+        self._seq += 1
+        if my_rank != root:
+            # Unlinked by root.
+            _write_segment(self._get_name('g', seq, my_rank), np.ascontiguousarray(sendbuf)).close()
+            return Request()
+
+        def receive():
+            for i in range(self.Get_size()):
+                data = sendbuf if i == root else _poll_segment(self._get_name('g', seq, i))
+                _put_vector(recvbuf, i, data)
+        return Request(receive)
+
+    def Gatherv(self, sendbuf, recvbuf=None, root=0):
+        self.Igatherv(sendbuf, recvbuf, root=root).Wait()
+
+    def Split(self, color=0, key=0):
+        if not self._is_local():
+            return self
+        seq = self._seq
+        info_ls = self._allgather((color, key, _local_context['rank']))
+        members = sorted([(k, r) for (c, k, r) in info_ls if c == color])
+        members = [r for (k, r) in members]
+        comm_id = '{:x}'.format(zlib.crc32('{}_{}_{}'.format(self._comm_id, seq, color).encode()))
+        new_comm = Comm(ranks=members, comm_id=comm_id)
+        if _local_context['rank'] == members[0]:
+            _create_barrier_segment(new_comm._get_name('b')).close()
+        self.Barrier()
+        return new_comm
+
+    def Free(self):
+        if self._barrier_shm is not None:
+            self._barrier_shm.close()
+            self._barrier_shm = None
+
+
+class Request():
+
+    def __init__(self, func=None):
+        self._func = func
+
+    def Wait(self):
+        if self._func is not None:
+            self._func()
+            self._func = None
+
+    def wait(self):
+        self.Wait()
 
 
 class MPI(object):
 
+    SUM = 'sum'
+    MAX = 'max'
+    MIN = 'min'
+    FLOAT = 'float32'
+    TAG_UB = 'tag_ub'
     COMM_WORLD = Comm()
 
+
+def _create_barrier_segment(name):
+    shm = shared_memory.SharedMemory(name=name, create=True, size=16)
+    struct.pack_into('qq', shm.buf, 0, 0, 0)
+    return shm
+
+
+def _run_worker(script, args, lock):
+    _local_context['lock'] = lock
+    sys.argv = [script] + list(args)
+    runpy.run_path(script, run_name='__main__')
+
+
+def launch(script, n_ranks, args=()):
+    """
+    Run a script with n_ranks local worker processes communicating through shared memory.
+
+    :param script: String. Path to the script.
+    :param n_ranks: Int. Number of processes.
+    :param args: List of String. Command line arguments passed to the script.
+    :return: Int. The largest exit code of the workers.
+    """
+    # Make Adorym use this module instead of mpi4py in the workers.
+    os.environ[LOCAL_COMM_ENV_NAME] = '1'
+    ctx = mp.get_context('spawn')
+    session = 'adm' + uuid.uuid4().hex[:8]
+    lock = ctx.Lock()
+    barrier_shm = _create_barrier_segment('{}w_b'.format(session))
+    os.environ[LOCAL_COMM_ENV_NAME + '_SIZE'] = str(n_ranks)
+    os.environ[LOCAL_COMM_ENV_NAME + '_SESSION'] = session
+    # All workers share the cores of this process, so each gets an equal share of threads.
+    n_threads = str(max(1, (os.cpu_count() or 1) // n_ranks))
+    env_thread_ls = [k for k in ['ADORYM_FFT_WORKERS', 'OMP_NUM_THREADS'] if k not in os.environ]
+    for k in env_thread_ls:
+        os.environ[k] = n_threads
+    proc_ls = []
+    for i in range(n_ranks):
+        os.environ[LOCAL_COMM_ENV_NAME + '_RANK'] = str(i)
+        proc_ls.append(ctx.Process(target=_run_worker, args=(script, args, lock)))
+        proc_ls[-1].start()
+    for k in ['_RANK', '_SIZE', '_SESSION']:
+        del os.environ[LOCAL_COMM_ENV_NAME + k]
+    for k in env_thread_ls:
+        del os.environ[k]
+    for p in proc_ls:
+        p.join()
+    barrier_shm.close()
+    barrier_shm.unlink()
+    # Remove barriers of split communicators, and segments left behind by workers that failed in the middle of
+    # a collective.
+    if os.path.isdir('/dev/shm'):
+        for f in os.listdir('/dev/shm'):
+            if f.startswith(session):
+                try:
+                    shm = shared_memory.SharedMemory(name=f)
+                    shm.close()
+                    shm.unlink()
+                except OSError:
+                    pass
+    return max([p.exitcode for p in proc_ls])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run an Adorym script with local worker processes.')
+    parser.add_argument('-n', type=int, default=1, help='Number of processes.')
+    parser.add_argument('script')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    a = parser.parse_args()
+    from adorym.pseudo import launch
+    sys.exit(launch(a.script, a.n, a.args))
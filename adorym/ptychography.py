@@ -49,7 +49,14 @@ def reconstruct_ptychography(
         # Either pre-declare all regularizers and pass them as a list, or specify values of alpha and gamma
         regularizers=None,
         alpha_d=None, alpha_b=None, gamma=1e-6,
+        proximal_tv=False, # If True, the TV term weighted by gamma is applied as a proximal step after object updates instead of being added to the loss. See ProximalTVRegularizer
         minibatch_size=None, multiscale_level=1, n_epoch_final_pass=None,
+        detector_crop_schedule=None,
+        # Far-field (free_prop_cm='inf') ptychography only. Give as a list of (crop_factor, n_epochs), e.g.
+        # [(4, 2), (2, 2)]. For the first 2 epochs, only the central 1/4 of each diffraction pattern (in each
+        # dimension) is fitted with an object and probe sampled 4 times coarser; for the next 2 epochs, the central 1/2;
+        # full patterns afterwards. The object keeps its full size, so nothing is resampled between stages. Cropped
+        # data of each angle are cached in RAM (1 / crop_factor ** 2 of the data size) during a stage.
         initial_guess=None,
         random_guess_means_sigmas=(8.7e-7, 5.1e-8, 1e-7, 1e-8),
         # Give as (mean_delta, mean_beta, sigma_delta, sigma_beta) or (mean_mag, mean_phase, sigma_mag, sigma_phase)
@@ -64,7 +71,7 @@ def reconstruct_ptychography(
         optimize_object=True,
         # Keep True in most cases. Setting to False forbids the object from being updated using gradients, which
         # might be desirable when you just want to refine parameters for other reconstruction algorithms.
-        optimizer='adam', # Provide adorym.Optimizer type, or choose from 'gd' or 'adam' or 'curveball' or 'momentum' or 'cg'
+        optimizer='adam', # Provide adorym.Optimizer type, or choose from 'gd' or 'adam' or 'curveball' or 'momentum' or 'cg' or 'lbfgs'
         learning_rate=1e-5, # Ignored when optimizer is an adorym.Optimizer type
         update_using_external_algorithm=None,
         # Applies to optimizers that use the current batch number for calculation, such as Adam. If 'angle', batch
@@ -96,6 +103,12 @@ def reconstruct_ptychography(
         # Intensity scaling factor in Poisson loss function. If intensity data is normalized, this should be the
         # average number of incident photons per pixel.
         beamstop=None,
+        bad_pixel_mask=None, # 2D boolean array; True marks pixels excluded from the loss.
+        pixel_weights=None, # 2D array of per-pixel weights of the loss.
+        saturation_threshold=None, # Pixels at or above this value (in the unit of the raw data) are excluded from the loss.
+        precompute_magnitude=None,
+        # Convert the data into float32 magnitudes once before reconstruction. Choose from None, 'memory' (a copy in
+        # the RAM of each rank) and 'file' (a copy in the output folder).
         normalize_fft=False, # Use False for simulated data generated without normalization. Normalize for Fraunhofer FFT only
         safe_zone_width=0,
         scale_ri_by_k=True,
@@ -111,6 +124,7 @@ def reconstruct_ptychography(
         # _____________
         # |Performance|_________________________________________________________
         cpu_only=False, core_parallelization=True, gpu_index=0,
+        fft_provider=None, # FFT library of Autograd backend. Choose from None (auto), 'numpy', 'scipy', 'pyfftw'
         n_dp_batch=20,
         distribution_mode=None, # Choose from None (for data parallelism), 'shared_file', 'distributed_object'
         dist_mode_n_batch_per_update=None, # If None, object is updated only after all DPs on an angle are processed.
@@ -123,6 +137,17 @@ def reconstruct_ptychography(
         # of rotation operations if minibatch_size < n_tiles_per_angle, but object can be updated once only after
         # all tiles on an angle are processed. Also this will save the object-sized gradient array in GPU memory
         # or RAM depending on current device setting.
+        sparse_gradient=False,
+        # Applies to simple data parallelism mode only. If True, only the region of the gradient buffer covered by
+        # the probe windows of the current minibatches is accumulated, allreduced and passed to the optimizer, and
+        # the optimizer updates that region lazily. For 3D objects the region is confined along y only. Not used
+        # with regularizers other than ProximalTVRegularizer, rotate_out_of_loop, or optimizers other than Adam, GD
+        # and momentum.
+        distributed_fft=False,
+        # Applies to undivided fullfield data in simple data parallelism mode only. If True, all ranks process the
+        # same rotation angle at a time; each rank holds a stripe of rows of the wavefield, and propagation is done
+        # with an MPI slab-decomposed 2D FFT, which is exact. The object is still replicated on all ranks. Not used
+        # with far-field propagation, optimize_prj_pos_offset or rotate_out_of_loop.
         # _________________________
         # |Other optimizer options|_____________________________________________
         optimize_probe=False, probe_learning_rate=1e-5, optimizer_probe=None,
@@ -139,7 +164,8 @@ def reconstruct_ptychography(
         other_params_update_delay=0,
         # _________________________
         # |Alternative algorithms |_____________________________________________
-        use_epie=False, epie_alpha=0.8,
+        use_epie=False, epie_alpha=0.8, epie_variant='epie', # Choose from 'epie', 'rpie', 'mpie'
+        use_dm=False, dm_algorithm='dm', raar_beta=0.75, # Choose dm_algorithm from 'dm', 'raar'
         # ________________
         # |Other settings|______________________________________________________
         dynamic_rate=True, pupil_function=None, probe_circ_mask=0.9, dynamic_dropping=False, dropping_threshold=8e-5,
@@ -175,6 +201,8 @@ def reconstruct_ptychography(
     rank = comm.Get_rank()
     t_zero = time.time()
     global_settings.backend = backend
+    # Number of threads used by the FFT of Autograd backend.
+    w.configure_fft(core_parallelization, provider=fft_provider, n_ranks=n_ranks)
     device_obj = None if cpu_only else gpu_index
     device_obj = w.get_device(device_obj)
     w.set_device(device_obj)
@@ -249,6 +277,17 @@ def reconstruct_ptychography(
     else:
         probe_pos = np.array(probe_pos).astype(float)
 
+    # Storage order of tiles if the data were re-chunked with tools/rechunk_adorym_data.py. Minibatches are then
+    # formed from consecutive stored tiles.
+    spot_permutation = None
+    if 'metadata/spot_permutation' in f:
+        if not common_probe_pos or len(f['metadata/spot_permutation']) != len(probe_pos):
+            raise ValueError('Tiles in {} are re-chunked, which requires common probe positions matching '
+                             'metadata/spot_permutation.'.format(fname))
+        spot_permutation = f['metadata/spot_permutation'][...]
+        print_flush('Tile storage order read from HDF5.', sto_rank, rank, **stdout_options)
+    tile_storage_index = None if spot_permutation is None else np.argsort(spot_permutation)
+
     # Energy.
     if energy_ev is None:
         energy_ev = float(f['metadata/energy_ev'][...])
@@ -325,7 +364,16 @@ def reconstruct_ptychography(
                       'object mode, all ranks must'
                       'process data from the same rotation angle in each synchronized'
                       'batch.')
-
+    if distributed_fft:
+        if not (common_probe_pos and len(probe_pos) == 1 and np.allclose(probe_pos[0], 0)) or \
+                distribution_mode is not None or rotate_out_of_loop or \
+                optimize_prj_pos_offset or (isinstance(free_prop_cm, str) and free_prop_cm == 'inf') or \
+                forward_model not in ['auto', SingleBatchFullfieldModel]:
+            warnings.warn('distributed_fft is only supported with undivided fullfield data and the current settings '
+                          'do not allow it. It is turned off.')
+            distributed_fft = False
+
+    prj_magnitude = None
     for ds_level in range(multiscale_level - 1, -1, -1):
 
         # ================================================================================
@@ -363,7 +411,11 @@ def reconstruct_ptychography(
         voxel_nm = np.array([psize_cm] * 3) * 1.e7 * ds_level
         lmbda_nm = 1240. / energy_ev
         delta_nm = voxel_nm[-1]
-        h = get_kernel(delta_nm * binning, lmbda_nm, voxel_nm, probe_size, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
+        if distributed_fft:
+            # Each rank only computes its stripe of the kernel in SlabFFT2D.
+            h = None
+        else:
+            h = get_kernel(delta_nm * binning, lmbda_nm, voxel_nm, probe_size, fresnel_approx=fresnel_approx, sign_convention=sign_convention)
 
         # ================================================================================
         # Read or write rotation transformation coordinates.
@@ -411,6 +463,10 @@ def reconstruct_ptychography(
                 optimizer_options_obj = {'step_size': learning_rate}
                 opt = CGOptimizer('obj', output_folder=output_folder, distribution_mode=distribution_mode,
                                   options_dict=optimizer_options_obj)
+            elif optimizer == 'lbfgs':
+                optimizer_options_obj = {'step_size': learning_rate}
+                opt = LBFGSOptimizer('obj', output_folder=output_folder, distribution_mode=distribution_mode,
+                                     options_dict=optimizer_options_obj)
             elif optimizer == 'momentum':
                 optimizer_options_obj = {'step_size': learning_rate}
                 opt = MomentumOptimizer('obj', output_folder=output_folder, distribution_mode=distribution_mode,
@@ -422,7 +478,7 @@ def reconstruct_ptychography(
                 opt = ScipyOptimizer('obj', output_folder=output_folder,
                                      distribution_mode=distribution_mode, options_dict=optimizer_options_obj)
             else:
-                raise ValueError('Invalid optimizer type. Must be "gd" or "adam" or "cg" or "scipy".')
+                raise ValueError('Invalid optimizer type. Must be "gd" or "adam" or "cg" or "lbfgs" or "scipy".')
         opt.create_container([*this_obj_size, 2], use_checkpoint, device_obj, use_numpy=True)
         opt.set_index_in_grad_return(0)
         opt_ls = [opt]
@@ -519,6 +575,31 @@ def reconstruct_ptychography(
             forward_model = forward_model(**forwardmodel_args)
             print_flush('Specified forward model: {}.'.format(type(forward_model).__name__), sto_rank, rank, **stdout_options)
 
+        if detector_crop_schedule is not None:
+            crop_factor_ls = [int(x[0]) for x in detector_crop_schedule]
+            if not (isinstance(free_prop_cm, str) and free_prop_cm == 'inf') or multiscale_level > 1 or \
+                    not isinstance(forward_model, PtychographyModel) or \
+                    isinstance(forward_model, SingleBatchFullfieldModel) or \
+                    any([probe_size[0] % f != 0 or probe_size[1] % f != 0 for f in crop_factor_ls]):
+                warnings.warn('detector_crop_schedule requires far-field ptychography with multiscale_level = 1 and '
+                              'probe sizes divisible by all crop factors. It is turned off.')
+                detector_crop_schedule = None
+
+        if precompute_magnitude is not None:
+            # Done once and shared by all downsampling levels.
+            if prj_magnitude is None:
+                t_mag_0 = time.time()
+                if precompute_magnitude == 'file':
+                    create_directory_multirank(output_folder)
+                    forward_model.precompute_magnitude_data(fname=os.path.join(output_folder, 'data_magnitude.h5'))
+                else:
+                    forward_model.precompute_magnitude_data()
+                prj_magnitude = forward_model.prj
+                print_flush('Magnitude data precomputed in {} s.'.format(time.time() - t_mag_0), sto_rank, rank, **stdout_options)
+            else:
+                forward_model.prj = prj_magnitude
+                forward_model.data_is_magnitude = True
+
         if regularizers is None:
             regularizers = []
             if alpha_d not in [0, None]:
@@ -527,7 +608,16 @@ def reconstruct_ptychography(
                 else:
                     regularizers.append(L1Regularizer(alpha_d, alpha_b, unknown_type=unknown_type))
             if gamma not in [0, None]:
-                regularizers.append(TVRegularizer(gamma, unknown_type=unknown_type))
+                if proximal_tv:
+                    regularizers.append(ProximalTVRegularizer(gamma, unknown_type=unknown_type))
+                else:
+                    regularizers.append(TVRegularizer(gamma, unknown_type=unknown_type))
+        # Proximal regularizers act on the object after updates and are not part of the loss.
+        prox_regularizers = [r for r in regularizers if isinstance(r, ProximalTVRegularizer)]
+        if len(prox_regularizers) > 0 and distribution_mode == 'shared_file':
+            warnings.warn('ProximalTVRegularizer is not supported in shared_file mode and is ignored.')
+            prox_regularizers = []
+        regularizers = [r for r in regularizers if not isinstance(r, ProximalTVRegularizer)]
         forward_model.add_regularizers(regularizers)
         reg_rwl1 = None
         reweighted_l1 = False
@@ -536,6 +626,16 @@ def reconstruct_ptychography(
                 reg_rwl1 = r
                 reweighted_l1 = True
 
+        # Sparse gradient needs the gradient to vanish outside the probe windows, and the optimizer to be
+        # element-wise.
+        if sparse_gradient:
+            if distribution_mode is not None or not optimize_object or rotate_out_of_loop or len(regularizers) > 0 \
+                    or not isinstance(opt, (AdamOptimizer, GDOptimizer, MomentumOptimizer)):
+                warnings.warn('sparse_gradient is not supported with the current settings and is turned off.')
+                sparse_gradient = False
+        if sparse_gradient:
+            sparse_gradient_axes = (0, 1) if two_d_mode else (0,)
+
         # ================================================================================
         # Create gradient class.
         # ================================================================================
@@ -715,11 +815,29 @@ def reconstruct_ptychography(
             print_flush('WARNING: Reconstructing using ePIE!', sto_rank, rank, **stdout_options)
             warnings.warn('use_epie is True. I will reconstruct using ePIE instead of AD!')
             time.sleep(0.5)
-            alt_reconstruction_epie(obj.delta, obj.beta, probe_real, probe_imag, probe_pos,
-                                    optimizable_params['probe_pos_correction'], prj, device_obj=device_obj,
-                                    minibatch_size=minibatch_size, alpha=epie_alpha, n_epochs=n_epochs, energy_ev=energy_ev,
-                                    psize_cm=psize_cm, output_folder=output_folder,
-                                    raw_data_type=raw_data_type)
+            obj_real, obj_imag, probe_real, probe_imag = \
+                alt_reconstruction_epie(*w.split_channel(obj.arr), probe_real, probe_imag, probe_pos,
+                                        optimizable_params['probe_pos_correction'], prj, device_obj=device_obj,
+                                        minibatch_size=minibatch_size, alpha=epie_alpha, n_epochs=n_epochs,
+                                        variant=epie_variant, optimize_probe=optimize_probe, energy_ev=energy_ev,
+                                        psize_cm=psize_cm, output_folder=output_folder,
+                                        raw_data_type=raw_data_type, tile_storage_index=tile_storage_index)
+            obj.arr = w.stack([obj_real, obj_imag], axis=-1)
+            return
+
+        # ================================================================================
+        # Use DM/RAAR?
+        # ================================================================================
+        if use_dm:
+            print_flush('WARNING: Reconstructing using {}!'.format(dm_algorithm.upper()), sto_rank, rank, **stdout_options)
+            warnings.warn('use_dm is True. I will reconstruct using {} instead of AD!'.format(dm_algorithm.upper()))
+            obj_real, obj_imag, probe_real, probe_imag = \
+                alt_reconstruction_dm(*w.split_channel(obj.arr), probe_real, probe_imag, probe_pos, prj,
+                                      device_obj=device_obj, n_epochs=n_epochs, algorithm=dm_algorithm,
+                                      raar_beta=raar_beta, optimize_probe=optimize_probe,
+                                      output_folder=output_folder, raw_data_type=raw_data_type,
+                                      tile_storage_index=tile_storage_index)
+            obj.arr = w.stack([obj_real, obj_imag], axis=-1)
             return
 
         # ================================================================================
@@ -756,7 +874,21 @@ def reconstruct_ptychography(
         while cont:
             t0 = time.time()
 
-            n_tot_per_batch = minibatch_size * n_ranks
+            if detector_crop_schedule is not None:
+                crop_factor = 1
+                i_epoch_stage_end = 0
+                for this_crop_factor, this_n_epochs in detector_crop_schedule:
+                    i_epoch_stage_end += this_n_epochs
+                    if i_epoch < i_epoch_stage_end:
+                        crop_factor = int(this_crop_factor)
+                        break
+                if crop_factor != forward_model.detector_crop_factor:
+                    print_flush('Fitting the central 1/{} of diffraction patterns.'.format(crop_factor),
+                                sto_rank, rank, **stdout_options)
+                forward_model.set_detector_crop_factor(crop_factor)
+
+            # With distributed_fft, all ranks work on the same image.
+            n_tot_per_batch = minibatch_size if distributed_fft else minibatch_size * n_ranks
 
             t00 = time.time()
             print_flush('Allocating jobs over threads...', sto_rank, rank, **stdout_options)
@@ -777,7 +909,7 @@ def reconstruct_ptychography(
             # ================================================================================
             for i, i_theta in enumerate(theta_ind_ls):
                 n_pos = len(probe_pos) if common_probe_pos else n_pos_ls[i_theta]
-                spots_ls = range(n_pos)
+                spots_ls = range(n_pos) if spot_permutation is None else spot_permutation
                 if randomize_probe_pos:
                     spots_ls = np.random.choice(spots_ls, len(spots_ls), replace=False)
                 # ================================================================================
@@ -876,8 +1008,9 @@ def reconstruct_ptychography(
                     ind_list_rand[i_batch] = np.concatenate([ind_list_rand[i_batch], ind_list_rand[0][:n_supp]])
 
                 this_ind_batch_allranks = ind_list_rand[i_batch]
-                this_i_theta = this_ind_batch_allranks[rank * minibatch_size, 0]
-                this_ind_batch = np.sort(this_ind_batch_allranks[rank * minibatch_size:(rank + 1) * minibatch_size, 1])
+                i_rank_in_batch = 0 if distributed_fft else rank
+                this_i_theta = this_ind_batch_allranks[i_rank_in_batch * minibatch_size, 0]
+                this_ind_batch = np.sort(this_ind_batch_allranks[i_rank_in_batch * minibatch_size:(i_rank_in_batch + 1) * minibatch_size, 1])
                 probe_pos_int = probe_pos_int if common_probe_pos else probe_pos_int_ls[this_i_theta]
                 this_pos_batch = probe_pos_int[this_ind_batch]
                 is_last_batch_of_this_theta = i_batch == n_batch - 1 or ind_list_rand[i_batch + 1][0, 0] != this_i_theta
@@ -1004,6 +1137,11 @@ def reconstruct_ptychography(
                 # Update the loss argument dictionary saved in ForwardModel class. Needed for CG but done for all
                 # optimizers for now.
                 forward_model.update_loss_args(grad_func_args)
+                if isinstance(opt, CGOptimizer):
+                    # The batch read for the gradient is held for the line search of CG.
+                    forward_model.hold_batch_data(this_i_theta, this_ind_batch,
+                                                  theta_downsample=forward_model.common_vars['theta_downsample'],
+                                                  ds_level=forward_model.common_vars['ds_level'])
                 if isinstance(opt, CurveballOptimizer):
                     diff.get_l_h_hessian_and_h_x_jacobian_mvps(forward_model, 0, **grad_func_args)
                     grads = [opt.calculate_dz(diff, use_numpy=True)]
@@ -1032,6 +1170,13 @@ def reconstruct_ptychography(
                     comm.Barrier()
                     print_flush('  Gradient syncing done in {} s.'.format(time.time() - t_grad_write_0), 0, rank,
                                 **stdout_options)
+                elif sparse_gradient:
+                    if initialize_gradients:
+                        gradient.reset_touched_region(grads[0].shape, device=device_obj)
+                    this_region = get_region_of_windows(this_pos_batch - np.array([safe_zone_width] * 2),
+                                                        subprobe_size + np.array([safe_zone_width] * 2) * 2,
+                                                        this_obj_size, local_axes=sparse_gradient_axes)
+                    gradient.accumulate_in_region(grads[0], this_region)
                 else:
                     if initialize_gradients:
                         del gradient.arr
@@ -1084,7 +1229,10 @@ def reconstruct_ptychography(
                 # All reduce object gradient buffer.
                 # ================================================================================
                 if distribution_mode is None:
-                    gradient.arr = comm.allreduce(gradient.arr)
+                    if sparse_gradient:
+                        gradient.allreduce_touched_region()
+                    else:
+                        gradient.arr = comm.allreduce(gradient.arr)
 
                 # ================================================================================
                 # Update object function with optimizer if not distribution_mode; otherwise,
@@ -1094,10 +1242,17 @@ def reconstruct_ptychography(
                     if distribution_mode is None and optimize_object:
                         if isinstance(opt, ScipyOptimizer):
                             obj.arr = opt.apply_gradient(obj.arr, forward_model=forward_model, differentiator=diff, **opt.options_dict)
+                        elif sparse_gradient:
+                            obj.arr = opt.apply_gradient_to_region(obj.arr, gradient, i_opt_batch,
+                                                                   gradient.touched_region, **opt.options_dict)
                         else:
                             obj.arr = opt.apply_gradient(obj.arr, gradient, i_opt_batch, **opt.options_dict)
+                        for r in prox_regularizers:
+                            obj.arr = r.apply_proximal(obj.arr, i_opt_batch,
+                                                       region=gradient.touched_region if sparse_gradient else None)
                         if isinstance(opt, CurveballOptimizer) and i_batch % 10 == 0:
                              opt.update_lambda(forward_model, grad_func_args)
+                forward_model.release_batch_data()
                 if distribution_mode is None:
                     w.reattach(obj.arr)
 
@@ -1166,6 +1321,9 @@ def reconstruct_ptychography(
                     elif distribution_mode == 'distributed_object' and obj.arr is not None and optimize_object:
                         obj.arr = opt.apply_gradient(obj.arr, gradient, i_opt_batch, use_numpy=True, **optimizer_options_obj)
                         gradient.initialize_distributed_array_with_zeros(dtype=cache_dtype)
+                        for r in prox_regularizers:
+                            obj.arr = r.apply_proximal(obj.arr, i_opt_batch, distribution_mode=distribution_mode,
+                                                       slice_catalog=obj.slice_catalog)
 
                     comm.Barrier()
                     print_flush('  Object update done in {} s.'.format(time.time() - t_apply_grad_0), sto_rank, rank, **stdout_options)
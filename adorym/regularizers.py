@@ -110,6 +110,98 @@ class TVRegularizer(Regularizer):
         return reg
 
 
+class ProximalTVRegularizer(Regularizer):
+    """Total variation regularizer applied as a proximal step. Instead of being added to the loss, the object is
+    denoised with Chambolle's algorithm (see util.tv_denoise_chambolle) after object updates, so TV is not
+    differentiated through the whole object in each minibatch. Channels (delta and beta, or real and imaginary
+    parts) are denoised separately.
+
+    :param gamma: Weight of TV term in each proximal step.
+    :param n_iter: Int. Number of Chambolle iterations in each proximal step.
+    :param interval: Int or None. The whole object is denoised every interval object updates. If the update is
+        confined to a region (sparse_gradient), that region is denoised after every update in addition. If None,
+        the updated region, or the whole object if the update is not confined, is denoised after every update.
+    """
+    def __init__(self, gamma, unknown_type='delta_beta', n_iter=10, interval=None):
+        super().__init__(unknown_type)
+        self.gamma = gamma
+        self.n_iter = n_iter
+        self.interval = interval
+
+    def get_value(self, obj, device=None, **kwargs):
+        return w.create_variable(0., device=device)
+
+    def exchange_halos(self, first_row, last_row, slice_catalog, tag=10):
+        """
+        Send the first and/or last row of the local slab of a distributed_object array to the neighboring ranks,
+        and receive the rows adjacent to the local slab. Even ranks send first and odd ranks receive first.
+        Tags tag and tag + 1 are used, which must be within the tag upper bound of MPI and below the tags of
+        AngleScheduler.
+
+        :return: (last row of the previous slab, first row of the next slab), each None if not requested or not
+            existing.
+        """
+        check_mpi_tag(tag + 1)
+        has_prev = rank > 0 and slice_catalog[rank - 1] is not None
+        has_next = rank < n_ranks - 1 and slice_catalog[rank + 1] is not None
+        prev_row = None
+        next_row = None
+        if last_row is not None:
+            if rank % 2 == 0:
+                if has_next: comm.send(last_row, dest=rank + 1, tag=tag)
+                if has_prev: prev_row = comm.recv(source=rank - 1, tag=tag)
+            else:
+                if has_prev: prev_row = comm.recv(source=rank - 1, tag=tag)
+                if has_next: comm.send(last_row, dest=rank + 1, tag=tag)
+        if first_row is not None:
+            if rank % 2 == 0:
+                if has_prev: comm.send(first_row, dest=rank - 1, tag=tag + 1)
+                if has_next: next_row = comm.recv(source=rank + 1, tag=tag + 1)
+            else:
+                if has_next: next_row = comm.recv(source=rank + 1, tag=tag + 1)
+                if has_prev: comm.send(first_row, dest=rank - 1, tag=tag + 1)
+        return prev_row, next_row
+
+    def denoise_region(self, arr, region=None, slice_catalog=None):
+        """
+        Denoise both channels of arr in place.
+
+        :param region: Array with shape [2, 2] or None. See util.get_region_of_windows. If None, the whole array
+            is denoised.
+        :param slice_catalog: If arr is the local slab of a distributed_object array, the slice catalog of the
+            object; halos of one voxel are then exchanged with neighboring slabs in each iteration. All ranks
+            holding a slab must call this method together.
+        """
+        ss = get_region_slicer(region) if region is not None else (slice(None),)
+        halo_exchange = None
+        if slice_catalog is not None:
+            halo_exchange = lambda first_row, last_row: self.exchange_halos(first_row, last_row, slice_catalog)
+        for i_channel in range(2):
+            s = ss + (Ellipsis, i_channel)
+            arr[s] = tv_denoise_chambolle(arr[s], self.gamma, n_iter=self.n_iter, halo_exchange=halo_exchange)
+        return arr
+
+    def apply_proximal(self, arr, i_update, region=None, distribution_mode=None, slice_catalog=None):
+        """
+        Apply the proximal step after object update i_update.
+
+        :param arr: Object array (whole object, or local slab in distributed_object mode) with channels in the
+            last dimension.
+        :param region: Array with shape [2, 2] or None. Region of the object changed by the update.
+        """
+        if distribution_mode == 'distributed_object':
+            if self.interval is None or i_update % self.interval == 0:
+                arr = self.denoise_region(arr, slice_catalog=slice_catalog)
+            return arr
+        if self.interval is not None and i_update % self.interval == 0:
+            arr = self.denoise_region(arr)
+        elif region is not None:
+            arr = self.denoise_region(arr, region=region)
+        elif self.interval is None:
+            arr = self.denoise_region(arr)
+        return arr
+
+
 class CorrRegularizer(Regularizer):
     """Pearson correlation regularizer along z axis of object.
 
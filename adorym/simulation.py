@@ -7,6 +7,8 @@ import h5py
 import gc
 import warnings
 import pickle
+import queue
+import threading
 
 from adorym.util import *
 from adorym.misc import *
@@ -35,6 +37,130 @@ except:
 PI = 3.1415927
 
 
+class SimulationDataWriter(object):
+    """
+    Writer of simulated data into exchange/data of an HDF5 file. The dataset is created at the first write, so
+    that its dtype can follow the prediction. If async_write is True, data are written by a background thread,
+    so that the next batch can be simulated in the meantime.
+    """
+
+    def __init__(self, f, shape, dset=None, dtype=None, chunk_batch_size=None, compression=None,
+                 compression_opts=None, n_batch_per_flush=10, async_write=True, queue_size=4):
+        """
+        :param f: h5py.File.
+        :param shape: List of Int. [n_theta, n_pos, size_y, size_x].
+        :param dset: h5py.Dataset. Existing dataset to write into (e.g., when resuming). If None, it is created.
+        :param dtype: String. If None, float32 for real data and complex64 for complex data.
+        :param chunk_batch_size: Int. Number of diffraction patterns in a chunk.
+        :param n_batch_per_flush: Int. Flush the file every n written batches. If None, flush only in close().
+        """
+        self.f = f
+        self.shape = shape
+        self.dset = dset
+        self.dtype = dtype
+        self.chunk_batch_size = chunk_batch_size
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.n_batch_per_flush = n_batch_per_flush
+        self.i_batch = 0
+        self.exception = None
+        self.queue = None
+        if async_write:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def _create_dataset(self, data):
+        dtype = self.dtype
+        if dtype is None:
+            dtype = 'complex64' if np.iscomplexobj(data) else 'float32'
+        chunks = None
+        if self.chunk_batch_size is not None:
+            chunks = (1, int(min(self.chunk_batch_size, self.shape[1])), *self.shape[2:])
+        grp = self.f.require_group('exchange')
+        self.dset = grp.create_dataset('data', shape=self.shape, dtype=dtype, chunks=chunks,
+                                       compression=self.compression, compression_opts=self.compression_opts)
+
+    def _write(self, i_theta, ind, data):
+        if self.dset is None:
+            self._create_dataset(data)
+        # h5py requires increasing indices.
+        ind, i_first = np.unique(ind, return_index=True)
+        data = data[i_first]
+        if not np.iscomplexobj(np.empty(0, dtype=self.dset.dtype)) and np.iscomplexobj(data):
+            data = np.abs(data)
+        self.dset[i_theta, ind] = data.astype(self.dset.dtype)
+        self.i_batch += 1
+        if self.n_batch_per_flush is not None and self.i_batch % self.n_batch_per_flush == 0:
+            self.f.flush()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.exception is None:
+                    self._write(*item)
+            except Exception as e:
+                self.exception = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, i_theta, ind, data):
+        """
+        :param i_theta: Int. Angle index.
+        :param ind: 1D array of Int. Position indices.
+        :param data: Array with shape [len(ind), size_y, size_x].
+        """
+        if self.queue is None:
+            self._write(i_theta, ind, data)
+        else:
+            if self.exception is not None:
+                raise self.exception
+            self.queue.put((i_theta, ind, data))
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+            if self.exception is not None:
+                raise self.exception
+        self.f.flush()
+
+
+def add_noise_to_data(data, raw_data_type='magnitude', noise_type=None, poisson_multiplier=1., gaussian_sigma=0.,
+                      rng=None):
+    """
+    Convert predicted magnitude into the output data type, adding noise to the intensity if requested.
+
+    :param data: Array. Predicted magnitude.
+    :param raw_data_type: String. Type of the output data. Choose from 'magnitude' or 'intensity'.
+    :param noise_type: String. Choose from None, 'poisson', 'gaussian' or 'poisson_gaussian'.
+    :param poisson_multiplier: Float. Number of photons per unit intensity.
+    :param gaussian_sigma: Float. Standard deviation of readout noise in photons.
+    :param rng: numpy.random.Generator.
+    """
+    if noise_type is None and raw_data_type == 'magnitude':
+        return data
+    data = data.astype('float64') ** 2
+    if noise_type is not None:
+        if rng is None:
+            rng = np.random.default_rng()
+        data = data * poisson_multiplier
+        if noise_type in ['poisson', 'poisson_gaussian']:
+            data = rng.poisson(data).astype('float64')
+        if noise_type in ['gaussian', 'poisson_gaussian']:
+            data = data + rng.normal(0, gaussian_sigma, size=data.shape)
+            data = np.clip(data, 0, None)
+        data = data / poisson_multiplier
+    if raw_data_type == 'magnitude':
+        data = np.sqrt(data)
+    return data
+
+
+
 def simulate_ptychography(
         # ______________________________________
         # |Raw data and experimental parameters|________________________________
@@ -102,9 +228,21 @@ def simulate_ptychography(
         save_path='.', output_folder=None, phantom_path='phantom', save_intermediate=False, save_intermediate_level='batch', save_history=False,
         store_checkpoint=True, use_checkpoint=True, force_to_use_checkpoint=False, n_batch_per_checkpoint=10,
         save_stdout=False,
+        output_dtype=None, # Data type of exchange/data. If None, float32 for real and complex64 for complex prediction
+        output_compression=None, # Choose from None, 'gzip', 'lzf'
+        output_compression_opts=None,
+        n_batch_per_flush=10, # Flush the HDF5 file every n batches. If None, only flush at the end
+        # _______
+        # |Noise|_______________________________________________________________
+        noise_type=None, # Choose from None, 'poisson', 'gaussian', 'poisson_gaussian'
+        # Poisson noise is generated on intensity * poisson_multiplier; Gaussian readout noise with standard deviation
+        # gaussian_sigma is added in the same unit (photons).
+        gaussian_sigma=0., random_seed=None,
         # _____________
         # |Performance|_________________________________________________________
         cpu_only=False, core_parallelization=True, gpu_index=0,
+        async_write=True, # Write data in a background thread while the next batch is being simulated
+        writer_queue_size=4,
         n_dp_batch=20,
         distribution_mode=None,  # Choose from None (for data parallelism), 'shared_file', 'distributed_object'
         dist_mode_n_batch_per_update=None,  # If None, object is updated only after all DPs on an angle are processed.
@@ -158,6 +296,8 @@ def simulate_ptychography(
     rank = comm.Get_rank()
     t_zero = time.time()
     global_settings.backend = backend
+    # Number of threads used by the FFT of Autograd backend.
+    w.configure_fft(core_parallelization, n_ranks=n_ranks)
     device_obj = None if cpu_only else gpu_index
     device_obj = w.get_device(device_obj)
     print(device_obj)
@@ -194,12 +334,18 @@ def simulate_ptychography(
 
     try:
         f = h5py.File(os.path.join(save_path, fname), 'a', driver='mpio', comm=comm)
+        parallel_file = True
     except:
         f = h5py.File(os.path.join(save_path, fname), 'a')
-    try:
-        prj = f.create_group('exchange').create_dataset('data', shape=[n_theta, n_pos, *probe_size], dtype=np.complex64)
-    except:
+        parallel_file = False
+    if 'exchange/data' in f:
         prj = f['exchange/data']
+        prj_shape_file = prj.shape
+    else:
+        # Created by the data writer when the first batch is simulated, because whether the data are real or complex
+        # depends on the forward model.
+        prj = None
+        prj_shape_file = [n_theta, n_pos, *probe_size]
 
     # ================================================================================
     # Get metadata.
@@ -207,12 +353,12 @@ def simulate_ptychography(
     if obj_size[-1] == 1:
         two_d_mode = True
     if n_theta is None:
-        n_theta = prj.shape[0]
+        n_theta = prj_shape_file[0]
     if two_d_mode:
         n_theta = 1
     prj_theta_ind = np.arange(n_theta, dtype=int)
     theta_ls = np.linspace(theta_st, theta_end, n_theta, dtype='float32')
-    original_shape = [n_theta, *prj.shape[1:]]
+    original_shape = [n_theta, *prj_shape_file[1:]]
     not_first_level = False
     this_obj_size = obj_size
     ds_level = 1
@@ -226,9 +372,9 @@ def simulate_ptychography(
 
     if subdiv_probe:
         probe_size = obj_size[:2]
-        subprobe_size = prj.shape[-2:]
+        subprobe_size = prj_shape_file[-2:]
     else:
-        probe_size = prj.shape[-2:]
+        probe_size = prj_shape_file[-2:]
         subprobe_size = probe_size
 
     if not common_probe_pos:
@@ -535,6 +681,21 @@ def simulate_ptychography(
     initialize_gradients = True
     shared_file_update_flag = False
 
+    # Ranks only need to be synchronized per batch when they share the object.
+    sync_batches = distribution_mode is not None
+    if parallel_file and n_ranks > 1:
+        # Parallel HDF5 needs collective dataset creation and writes with filters, which can't be done from a
+        # background thread.
+        async_write = False
+        if output_compression is not None:
+            warnings.warn('Compression is not supported with parallel HDF5 here, and is turned off.')
+            output_compression = None
+    writer = SimulationDataWriter(f, original_shape, dset=prj, dtype=output_dtype, chunk_batch_size=minibatch_size,
+                                  compression=output_compression, compression_opts=output_compression_opts,
+                                  n_batch_per_flush=n_batch_per_flush, async_write=async_write,
+                                  queue_size=writer_queue_size)
+    rng = np.random.default_rng(None if random_seed is None else random_seed + rank)
+
     for i_batch in range(n_batch):
 
         # ================================================================================
@@ -557,7 +718,8 @@ def simulate_ptychography(
         probe_pos_int = probe_pos_int if common_probe_pos else probe_pos_int_ls[this_i_theta]
         this_pos_batch = probe_pos_int[this_ind_batch]
         is_last_batch_of_this_theta = i_batch == n_batch - 1 or ind_list_rand[i_batch + 1][0, 0] != this_i_theta
-        comm.Barrier()
+        if sync_batches:
+            comm.Barrier()
         print_flush('  Current rank is processing angle ID {}.'.format(this_i_theta), sto_rank, rank,
                     **stdout_options)
 
@@ -653,23 +815,29 @@ def simulate_ptychography(
                         grad_func_args[arg] = locals()[arg]
                     except:
                         grad_func_args[arg] = None
-        comm.Barrier()
+        if sync_batches:
+            comm.Barrier()
         print_flush('  Entering simulation loop...', sto_rank, rank, **stdout_options)
 
-        this_pred_batch = forward_model.predict(**grad_func_args)
+        # No gradient is needed, so don't record the AD tape.
+        with w.no_grad():
+            this_pred_batch = forward_model.predict(**grad_func_args)
         complex_output = True if isinstance(this_pred_batch, tuple) else False
-        comm.Barrier()
         print_flush('  Batch simulation calculation done in {} s.'.format(time.time() - t_grad_0), sto_rank, rank,
                     **stdout_options)
 
         # ================================================================================
-        # Write data.
+        # Add noise and send data to writer.
         # ================================================================================
         if complex_output:
-            prj[this_i_theta, this_ind_batch] = np.stack(w.to_numpy(this_pred_batch[0])) + 1j * w.to_numpy(np.stack(this_pred_batch[1]))
+            this_pred_batch = w.to_numpy(this_pred_batch[0]) + 1j * w.to_numpy(this_pred_batch[1])
+            if noise_type is not None and i_batch == 0:
+                warnings.warn('Forward model returns complex wavefields, so noise is not added.')
         else:
-            prj[this_i_theta, this_ind_batch] = w.to_numpy(this_pred_batch) + 1j * 0
-        f.flush()
+            this_pred_batch = add_noise_to_data(w.to_numpy(this_pred_batch), raw_data_type=raw_data_type,
+                                                noise_type=noise_type, poisson_multiplier=poisson_multiplier,
+                                                gaussian_sigma=gaussian_sigma, rng=rng)
+        writer.write(this_i_theta, this_ind_batch, this_pred_batch)
 
         # ================================================================================
         # Finishing a batch.
@@ -683,11 +851,15 @@ def simulate_ptychography(
                 w.get_gpu_memory_usage_mb(), w.get_peak_gpu_memory_usage_mb(), w.get_gpu_memory_cache_mb()),
                 sto_rank, rank, **stdout_options)
 
-        t_elapsed = (time.time() - t_zero) / 60
-        t_elapsed = comm.bcast(t_elapsed, root=0)
-        if t_max_min is not None and t_elapsed >= t_max_min:
-            print_flush('Terminating program because maximum time limit is reached.', sto_rank, rank,
-                        **stdout_options)
-            sys.exit()
+        if t_max_min is not None:
+            t_elapsed = (time.time() - t_zero) / 60
+            t_elapsed = comm.bcast(t_elapsed, root=0)
+            if t_elapsed >= t_max_min:
+                print_flush('Terminating program because maximum time limit is reached.', sto_rank, rank,
+                            **stdout_options)
+                writer.close()
+                sys.exit()
+
+    writer.close()
 
 
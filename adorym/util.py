@@ -7,8 +7,13 @@ import warnings
 import datetime
 from math import ceil, floor
 from scipy.ndimage import rotate as sp_rotate
+import scipy.sparse
 import time
 import re
+import collections
+import concurrent.futures
+import tempfile
+import shutil
 
 try:
     import sys
@@ -46,6 +51,21 @@ n_ranks = comm.Get_size()
 rank = comm.Get_rank()
 
 
+def check_mpi_tag(max_tag):
+    """
+    Raise a ValueError if max_tag is above the largest tag the MPI implementation supports. The MPI standard
+    only guarantees tags up to 32767.
+    """
+    try:
+        tag_ub = comm.Get_attr(MPI.TAG_UB)
+    except AttributeError:
+        tag_ub = None
+    if tag_ub is None:
+        tag_ub = 32767
+    if max_tag > tag_ub:
+        raise ValueError('MPI tag {} exceeds the upper bound {} of this MPI implementation.'.format(max_tag, tag_ub))
+
+
 def timeit(fun):
     def func(*args, **kwargs):
         t0 = time.time()
@@ -215,6 +235,9 @@ def initialize_probe(probe_size, probe_type, pupil_function=None, probe_initial=
             probe_guess_kwargs['raw_data_type'] = kwargs['raw_data_type']
         if 'beamstop' in kwargs.keys() and kwargs['beamstop'] is not None:
             probe_guess_kwargs['beamstop'] = [w.to_numpy(i) for i in kwargs['beamstop']]
+        for kw in ['frames_per_block', 'subsample_stride', 'n_threads']:
+            if 'probe_guess_' + kw in kwargs.keys():
+                probe_guess_kwargs[kw] = kwargs['probe_guess_' + kw]
         probe_init = create_probe_initial_guess_ptycho(os.path.join(save_path, fname), sign_convention=sign_convention, **probe_guess_kwargs)
         probe_real = probe_init.real
         probe_imag = probe_init.imag
@@ -270,13 +293,86 @@ def initialize_probe(probe_size, probe_type, pupil_function=None, probe_initial=
     return probe_real, probe_imag
 
 
-def create_probe_initial_guess(data_fname, dist_nm, energy_ev, psize_nm, raw_data_type='intensity'):
+def get_mean_diffraction_magnitude(dset, raw_data_type='intensity', frames_per_block=256, subsample_stride=1,
+                                   n_threads=1, use_mpi=False, dtype=None):
+    """
+    Get the mean magnitude of all frames in a dataset by streaming blocks of frames, without loading the whole
+    dataset into memory.
+
+    Frames are accumulated sequentially in the order of the dataset, so that with a single rank the result is
+    bit-identical to np.mean(np.abs(dat), axis=(0, ..., n - 3)) computed in the same dtype. Worker threads only read
+    and preprocess blocks ahead; they don't change the order of accumulation. With use_mpi, each rank accumulates a
+    contiguous range of blocks and partial sums are allreduced, which is not bit-identical to the serial result.
+
+    :param dset: h5py.Dataset or array with shape [n_frames, y, x] or [n_theta, n_pos, y, x].
+    :param raw_data_type: String. If 'intensity', the square root is taken before averaging.
+    :param frames_per_block: Int. Number of frames read at a time.
+    :param subsample_stride: Int. Only use every n-th frame along the last frame axis.
+    :param n_threads: Int. Number of threads reading blocks ahead.
+    :param use_mpi: Bool. Split blocks among ranks. All ranks must call this function.
+    :param dtype: String. Dtype of accumulation. If None, use the dtype of the data.
+    :return: 2D array of mean magnitude.
+    """
+    shape = dset.shape
+    if len(shape) == 3:
+        shape = [1, *shape]
+    n_outer, n_inner = shape[:2]
+    if dtype is None:
+        dtype = dset.dtype
+    block_ls = []
+    for i in range(n_outer):
+        for st in range(0, n_inner, frames_per_block * subsample_stride):
+            block_ls.append((i, st, min(st + frames_per_block * subsample_stride, n_inner)))
+    n_frames = n_outer * len(range(0, n_inner, subsample_stride))
+    if use_mpi:
+        block_range = get_multiprocess_distribution_index(len(block_ls), n_ranks)[rank]
+        block_ls = block_ls[slice(*block_range)] if block_range is not None else []
+
+    def read_block(block):
+        i, st, end = block
+        if len(dset.shape) == 3:
+            dat = dset[st:end:subsample_stride]
+        else:
+            dat = dset[i, st:end:subsample_stride]
+        dat = np.asarray(dat).astype(dtype, copy=False)
+        if raw_data_type == 'intensity':
+            dat = np.sqrt(dat)
+        return np.abs(dat)
+
+    def accumulate(acc, dat):
+        # Adding the running sum to the first frame and then reducing along axis 0 keeps the sequential order.
+        if acc is not None:
+            dat[0] = acc + dat[0]
+        return np.sum(dat, axis=0)
+
+    acc = None
+    if n_threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            future_ls = collections.deque()
+            for block in block_ls:
+                future_ls.append(executor.submit(read_block, block))
+                if len(future_ls) > 2 * n_threads:
+                    acc = accumulate(acc, future_ls.popleft().result())
+            while len(future_ls) > 0:
+                acc = accumulate(acc, future_ls.popleft().result())
+    else:
+        for block in block_ls:
+            acc = accumulate(acc, read_block(block))
+    if acc is None:
+        acc = np.zeros(shape[2:], dtype=dtype)
+    if use_mpi:
+        acc = comm.allreduce(acc)
+    return np.true_divide(acc, n_frames, out=acc, casting='unsafe')
+
 
+def create_probe_initial_guess(data_fname, dist_nm, energy_ev, psize_nm, raw_data_type='intensity', **kwargs):
+    """
+    :param kwargs: Passed to get_mean_diffraction_magnitude.
+    """
     f = h5py.File(data_fname, 'r')
-    dat = f['exchange/data'][...]
-    if raw_data_type == 'intensity': dat = np.sqrt(dat)
     # NOTE: this is for toy model
-    wavefront = np.mean(np.abs(dat), axis=0)
+    wavefront = get_mean_diffraction_magnitude(f['exchange/data'], raw_data_type=raw_data_type, **kwargs)
+    f.close()
     lmbda_nm = 1.24 / energy_ev
     h = get_kernel(-dist_nm, lmbda_nm, [psize_nm, psize_nm], wavefront.shape)
     wavefront = np.fft.fftshift(np.fft.fft2(wavefront)) * h
@@ -284,13 +380,13 @@ def create_probe_initial_guess(data_fname, dist_nm, energy_ev, psize_nm, raw_dat
     return wavefront
 
 
-def create_probe_initial_guess_ptycho(data_fname, noise=False, raw_data_type='intensity', beamstop=None, sign_convention=1):
-
+def create_probe_initial_guess_ptycho(data_fname, noise=False, raw_data_type='intensity', beamstop=None, sign_convention=1,
+                                      **kwargs):
+    """
+    :param kwargs: Passed to get_mean_diffraction_magnitude.
+    """
     f = h5py.File(data_fname, 'r')
-    dat = f['exchange/data'][...]
-    if raw_data_type == 'intensity':
-        dat = np.sqrt(dat)
-    wavefront = np.mean(np.abs(dat), axis=(0, 1))
+    wavefront = get_mean_diffraction_magnitude(f['exchange/data'], raw_data_type=raw_data_type, **kwargs)
     if beamstop is not None:
         beamstop_mask = beamstop[0]
         xx, yy =  np.meshgrid(range(beamstop_mask.shape[1]), range(beamstop_mask.shape[0]))
@@ -384,6 +480,54 @@ def realign_image_fourier(a_real, a_imag, shift, axes=(0, 1), device=None):
     return w.ifft2(a_real, a_imag, axes=axes)
 
 
+def realign_image_fourier_batch(a_real, a_imag, shift_ls, device=None):
+    """
+    Shift a stack of images by different amounts with one batched FFT.
+
+    :param a_real: Tensor in [n, y, x].
+    :param a_imag: Tensor in [n, y, x].
+    :param shift_ls: Tensor in [n, 2]. Shifts as [dy, dx] of each image.
+    :return: Real and imaginary parts as a list.
+    """
+    f_real, f_imag = w.fft2(a_real, a_imag, axes=(1, 2))
+    s = f_real.shape
+    freq_x, freq_y = np.meshgrid(np.fft.fftfreq(s[2], 1), np.fft.fftfreq(s[1], 1))
+    freq_x = w.create_variable(freq_x[None], requires_grad=False, device=device, dtype=w.get_dtype(f_real))
+    freq_y = w.create_variable(freq_y[None], requires_grad=False, device=device, dtype=w.get_dtype(f_real))
+    shift_ls = w.cast(shift_ls, w.get_dtype(f_real))
+    mult_real, mult_imag = w.exp_complex(0., -2 * PI * (freq_x * shift_ls[:, 1:2, None] + freq_y * shift_ls[:, 0:1, None]))
+    a_real, a_imag = (f_real * mult_real - f_imag * mult_imag, f_real * mult_imag + f_imag * mult_real)
+    return w.ifft2(a_real, a_imag, axes=(1, 2))
+
+
+def get_central_crop_slicer(shape, new_shape):
+    """
+    Slicer of the central region of an (fftshifted) image, such that the zero frequency stays at the center
+    after cropping.
+    """
+    return tuple(slice(s // 2 - n // 2, s // 2 - n // 2 + n) for s, n in zip(shape, new_shape))
+
+
+def fourier_crop(a_real, a_imag, new_shape):
+    """
+    Resample complex images in the last 2 dimensions to a coarser grid of new_shape by cropping their
+    spectra. Field of view is kept, so pixel size grows by shape / new_shape. Transforms are
+    orthonormal, so values are scaled by sqrt(shape / new_shape) in each dimension.
+    """
+    f_real, f_imag = w.fft2_and_shift(a_real, a_imag, axes=(-2, -1), normalize=True)
+    slicer = (Ellipsis,) + get_central_crop_slicer(f_real.shape[-2:], new_shape)
+    return w.ishift_and_ifft2(f_real[slicer], f_imag[slicer], axes=(-2, -1), normalize=True)
+
+
+def bin_object_batch(obj_batch, factor):
+    """
+    Average [n, y, x, ...] arrays over factor x factor blocks in y and x.
+    """
+    s = obj_batch.shape
+    arr = w.reshape(obj_batch, [s[0], s[1] // factor, factor, s[2] // factor, factor, *s[3:]])
+    return w.mean(arr, axis=(2, 4))
+
+
 def create_batches(arr, batch_size):
 
     arr_len = len(arr)
@@ -539,6 +683,69 @@ def apply_rotation(obj, coord_old, interpolation='bilinear', axis=0, device=None
     return obj_rot
 
 
+def apply_rotation_to_region(obj, coord_old, range_1):
+    """
+    Rotate a Numpy array around axis 0 with bilinear interpolation, like apply_rotation, but only compute the
+    output within range_1 along axis 1.
+
+    :param obj: Numpy array in [n_0, n_1, n_2, ...].
+    :param coord_old: The same variable as is passed to apply_rotation, in [n_1 * n_2, 2].
+    :param range_1: [start, end] of the output along axis 1.
+    :return: Numpy array in [n_0, end - start, n_2, ...].
+    """
+    s = obj.shape
+    coord_old = np.reshape(coord_old, [s[1], s[2], 2])[range_1[0]:range_1[1]].astype('float64')
+    # Clip coords, so that edge values are used for out-of-array indices
+    coord_old_1 = np.clip(coord_old[..., 0], 0, s[1] - 1)
+    coord_old_2 = np.clip(coord_old[..., 1], 0, s[2] - 1)
+    coord_old_floor_1 = np.floor(coord_old_1).astype(int)
+    coord_old_floor_2 = np.floor(coord_old_2).astype(int)
+    coord_old_ceil_1 = np.minimum(coord_old_floor_1 + 1, s[1] - 1)
+    coord_old_ceil_2 = np.minimum(coord_old_floor_2 + 1, s[2] - 1)
+    fac_1 = np.reshape(coord_old_1 - coord_old_floor_1, [1, *coord_old_1.shape] + [1] * (len(s) - 3))
+    fac_2 = np.reshape(coord_old_2 - coord_old_floor_2, [1, *coord_old_2.shape] + [1] * (len(s) - 3))
+    obj_rot = obj[:, coord_old_floor_1, coord_old_floor_2] * (1 - fac_1) * (1 - fac_2) + \
+              obj[:, coord_old_ceil_1, coord_old_floor_2] * fac_1 * (1 - fac_2) + \
+              obj[:, coord_old_floor_1, coord_old_ceil_2] * (1 - fac_1) * fac_2 + \
+              obj[:, coord_old_ceil_1, coord_old_ceil_2] * fac_1 * fac_2
+    return obj_rot.astype(obj.dtype)
+
+
+def get_rotation_matrix(coord_ls, shape):
+    """
+    Get the sparse matrix of bilinear rotations around axis 0 to several angles, with the same interpolation as
+    apply_rotation. Its transpose gives the sum of the adjoint rotations over all angles.
+
+    :param coord_ls: List of coord_old of each angle, as is passed to apply_rotation, in [n_1 * n_2, 2].
+    :param shape: [n_1, n_2]. Shape of the rotated plane.
+    :return: scipy.sparse.csr_matrix in [n_angles * n_1 * n_2, n_1 * n_2]. Multiplying it with an array in
+             [n_1 * n_2, m] gives the rotated arrays of all angles, stacked along axis 0.
+    """
+    n = shape[0] * shape[1]
+    row_ls, col_ls, val_ls = [], [], []
+    for i_angle, coord_old in enumerate(coord_ls):
+        coord_old = np.reshape(coord_old, [n, 2]).astype('float64')
+        # Clip coords, so that edge values are used for out-of-array indices
+        coord_old_1 = np.clip(coord_old[:, 0], 0, shape[0] - 1)
+        coord_old_2 = np.clip(coord_old[:, 1], 0, shape[1] - 1)
+        coord_old_floor_1 = np.floor(coord_old_1).astype(int)
+        coord_old_floor_2 = np.floor(coord_old_2).astype(int)
+        coord_old_ceil_1 = np.minimum(coord_old_floor_1 + 1, shape[0] - 1)
+        coord_old_ceil_2 = np.minimum(coord_old_floor_2 + 1, shape[1] - 1)
+        fac_1 = coord_old_1 - coord_old_floor_1
+        fac_2 = coord_old_2 - coord_old_floor_2
+        rows = i_angle * n + np.arange(n)
+        for ind_1, ind_2, fac in [(coord_old_floor_1, coord_old_floor_2, (1 - fac_1) * (1 - fac_2)),
+                                  (coord_old_ceil_1, coord_old_floor_2, fac_1 * (1 - fac_2)),
+                                  (coord_old_floor_1, coord_old_ceil_2, (1 - fac_1) * fac_2),
+                                  (coord_old_ceil_1, coord_old_ceil_2, fac_1 * fac_2)]:
+            row_ls.append(rows)
+            col_ls.append(ind_1 * shape[1] + ind_2)
+            val_ls.append(fac)
+    return scipy.sparse.csr_matrix((np.concatenate(val_ls), (np.concatenate(row_ls), np.concatenate(col_ls))),
+                                   shape=[len(coord_ls) * n, n])
+
+
 def apply_rotation_primitive(obj, coord_old, interpolation='bilinear', axis=0, device=None, override_backend=None):
 
     # PyTorch CPU doesn't support float16 computation.
@@ -1393,6 +1600,98 @@ def calculate_pad_len(this_obj_size, probe_pos, probe_size, unknown_type='delta_
     return pad_arr
 
 
+def get_region_of_windows(probe_pos, probe_size, whole_object_size, local_axes=(0, 1)):
+    """
+    Get the bounding box of the union of probe-sized windows, clipped to the object boundary.
+
+    :param probe_pos: Array with shape [n_pos, 2]. Top-left corners of the windows in pixel.
+    :param probe_size: List of Int. [size_y, size_x] of the windows.
+    :param whole_object_size: List of Int. Size of the object, of which only the first 2 elements are used.
+    :param local_axes: Tuple of Int. Axes along which the box is confined to the windows. Along the other
+                       lateral axes, the box spans the whole object (e.g., the x axis of a 3D object that
+                       is rotated about y in the forward model).
+    :return: Array with shape [2, 2] as [[y_st, y_end], [x_st, x_end]].
+    """
+    probe_pos = np.array(probe_pos).astype(int)
+    region = np.array([[0, whole_object_size[0]], [0, whole_object_size[1]]])
+    for i in local_axes:
+        region[i, 0] = max([0, int(np.min(probe_pos[:, i]))])
+        region[i, 1] = min([whole_object_size[i], int(np.max(probe_pos[:, i])) + probe_size[i]])
+    return region
+
+
+def merge_regions(region_1, region_2):
+    """
+    Get the bounding box of the union of 2 regions given by get_region_of_windows. Either of them can be None.
+    """
+    if region_1 is None:
+        return region_2
+    if region_2 is None:
+        return region_1
+    return np.stack([np.minimum(region_1[:, 0], region_2[:, 0]), np.maximum(region_1[:, 1], region_2[:, 1])], axis=1)
+
+
+def read_tiles(dset, i_theta, ind, tile_storage_index=None):
+    """
+    Read tiles of an angle from a dataset of shape [n_theta, n_tiles, y, x] by their original indices. For data
+    re-chunked with tools/rechunk_adorym_data.py, the tiles are located through tile_storage_index, and a
+    contiguous run of storage indices is read as a slice.
+
+    :param tile_storage_index: Array of Int or None. Storage index of each tile, i.e., the argsort of
+        metadata/spot_permutation.
+    """
+    ind = np.array(ind).astype(int)
+    if tile_storage_index is not None:
+        ind = tile_storage_index[ind]
+    # h5py fancy indexing needs increasing indices.
+    order = np.argsort(ind)
+    ind_sorted = ind[order]
+    if ind_sorted[-1] - ind_sorted[0] == len(ind_sorted) - 1:
+        block = dset[i_theta, ind_sorted[0]:ind_sorted[-1] + 1]
+    else:
+        block = dset[i_theta, ind_sorted]
+    return block[np.argsort(order)]
+
+
+def get_region_slicer(region):
+    return (slice(*region[0]), slice(*region[1]))
+
+
+def get_non_overlapping_batches(probe_pos, probe_size, max_batch_size=None):
+    """
+    Group probe positions into batches in which no 2 windows overlap, so that updates of all positions in a batch
+    can be written to the object at once. Positions are greedily colored in descending order of the number of
+    windows they overlap with; each color is then split into batches no larger than max_batch_size.
+
+    :param probe_pos: Array with shape [n_pos, 2]. Top-left corners of the windows in pixel.
+    :param probe_size: List of Int. [size_y, size_x] of the windows.
+    :param max_batch_size: Int. If None, each color forms one batch.
+    :return: List of 1D int arrays holding indices of probe_pos.
+    """
+    probe_pos = np.array(probe_pos).astype(int)
+    n_pos = len(probe_pos)
+    neighbors = []
+    for i in range(n_pos):
+        d = np.abs(probe_pos - probe_pos[i])
+        nb = np.nonzero((d[:, 0] < probe_size[0]) & (d[:, 1] < probe_size[1]))[0]
+        neighbors.append(nb[nb != i])
+    color = np.full(n_pos, -1, dtype=int)
+    for i in np.argsort([-len(nb) for nb in neighbors], kind='stable'):
+        used = set(color[neighbors[i]].tolist())
+        c = 0
+        while c in used:
+            c += 1
+        color[i] = c
+    batches = []
+    for c in range(color.max() + 1):
+        ind = np.nonzero(color == c)[0]
+        if max_batch_size is None:
+            batches.append(ind)
+        else:
+            batches += create_batches(ind, max_batch_size)
+    return batches
+
+
 def total_variation(arr, axes=()):
     """Calculate total variation of an array.
 
@@ -1427,6 +1726,60 @@ def total_variation_3d(arr, axis_offset=0):
     return res
 
 
+def tv_denoise_chambolle(arr, weight, n_iter=10, halo_exchange=None):
+    """
+    Isotropic total variation denoising with Chambolle's projection algorithm, which finds
+    argmin_u ||u - arr||^2 / 2 + weight * TV(u) with zero-flux boundaries. Only arithmetic and slicing are used, so
+    arr can be an array or a tensor of any backend.
+
+    :param arr: N-D array or tensor.
+    :param weight: Float. Weight of the TV term.
+    :param halo_exchange: None or function. If arr is a slab along axis 0 of an array split among ranks, a function
+        that sends the first and/or last row of the local slab (either can be None) to the neighboring slabs, and
+        returns (last row of the previous slab, first row of the next slab), each None if not requested or at the
+        boundary of the whole array. If None, arr is the whole array.
+    :return: Denoised array.
+    """
+    ndim = len(arr.shape)
+    # Step size that guarantees convergence, since the squared norm of the divergence is at most 4 * ndim.
+    tau = 1. / (4 * ndim)
+    p_ls = [arr * 0 for _ in range(ndim)]
+    for i_iter in range(n_iter + 1):
+        # Divergence with backward differences; the last element of each p is always 0.
+        d = arr * 0
+        for i_dim, p in enumerate(p_ls):
+            s0 = (slice(None),) * i_dim + (0,)
+            s1 = (slice(None),) * i_dim + (slice(1, None),)
+            s2 = (slice(None),) * i_dim + (slice(None, -1),)
+            d[s0] = d[s0] + p[s0]
+            d[s1] = d[s1] + p[s1] - p[s2]
+        if halo_exchange is not None:
+            p_prev, _ = halo_exchange(None, p_ls[0][-1])
+            if p_prev is not None:
+                d[0] = d[0] - p_prev
+        d = d - arr / weight
+        if i_iter == n_iter:
+            break
+        # Gradient with forward differences.
+        d_next = None
+        if halo_exchange is not None:
+            _, d_next = halo_exchange(d[0], None)
+        g_ls = []
+        g_norm = arr * 0
+        for i_dim in range(ndim):
+            s1 = (slice(None),) * i_dim + (slice(1, None),)
+            s2 = (slice(None),) * i_dim + (slice(None, -1),)
+            g = arr * 0
+            g[s2] = d[s1] - d[s2]
+            if i_dim == 0 and d_next is not None:
+                g[-1] = d_next - d[-1]
+            g_ls.append(g)
+            g_norm = g_norm + g ** 2
+        g_norm = g_norm ** 0.5
+        p_ls = [(p + tau * g) / (1 + tau * g_norm) for p, g in zip(p_ls, g_ls)]
+    return -weight * d
+
+
 def image_gradient(arr, axes=()):
     """Calculate the squared magnitude of image gradient in specified axes.
 
@@ -1486,80 +1839,180 @@ def generate_ring(shape, radius, **kwargs):
     return disk1 - disk2
 
 
-def fourier_shell_correlation(obj, ref, step_size=1, save_path='fsc', save_mask=True):
+def _fftn_by_chunks(arr, chunk_size, tmp_fname):
+    """
+    N-dimensional FFT of a 2D or 3D array that may not fit in memory (e.g., an h5py dataset or a memmap). The
+    last axes are transformed slab by slab along axis 0, then axis 0 is transformed slab by slab along axis 1.
+    The result is a complex64 memmap.
+    """
+    out = np.memmap(tmp_fname, dtype='complex64', mode='w+', shape=tuple(arr.shape))
+    for i in range(0, arr.shape[0], chunk_size):
+        out[i:i + chunk_size] = np.fft.fftn(np.asarray(arr[i:i + chunk_size]), axes=tuple(range(1, arr.ndim)))
+    for i in range(0, arr.shape[1], chunk_size):
+        out[:, i:i + chunk_size] = np.fft.fft(out[:, i:i + chunk_size], axis=0)
+    out.flush()
+    return out
 
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
 
-    radius_max = int(min(obj.shape) / 2)
-    f_obj = np.fft.fftshift(np.fft.fftn(obj))
-    f_ref = np.fft.fftshift(np.fft.fftn(ref))
-    f_prod = f_obj * np.conjugate(f_ref)
-    f_obj_2 = np.real(f_obj * np.conjugate(f_obj))
-    f_ref_2 = np.real(f_ref * np.conjugate(f_ref))
-    radius_ls = np.arange(1, radius_max, step_size)
-    fsc_ls = []
-    np.save(os.path.join(save_path, 'radii.npy'), radius_ls)
+def _get_radius_index(shape, slicer_0=slice(None)):
+    """
+    Get the index of the unit-width shell (centered at integer radii) that each frequency belongs to, for
+    unshifted FFT arrays. Only rows slicer_0 along axis 0 are returned.
+    """
+    freq_ls = [np.fft.fftfreq(n) * n for n in shape]
+    freq_ls[0] = freq_ls[0][slicer_0]
+    grids = np.meshgrid(*freq_ls, indexing='ij', sparse=True)
+    r2 = 0
+    for g in grids:
+        r2 = r2 + g ** 2
+    return np.floor(np.sqrt(r2) + 0.5).astype('int64')
+
+
+def fourier_correlation_by_radius(obj, ref, chunk_size=None, tmp_dir=None, f_obj=None, f_ref=None):
+    """
+    Calculate Fourier shell (3D) or ring (2D) correlation between 2 arrays, such as 2 half-dataset
+    reconstructions, or a reconstruction and a reference. All shells are evaluated in one pass by reducing the
+    cross product and the energies of both arrays with bincount over a radius index.
+
+    :param obj: Array, memmap or h5py.Dataset.
+    :param ref: Array, memmap or h5py.Dataset with the same shape as obj.
+    :param chunk_size: Int. If not None, FFTs and reductions are done in slabs of chunk_size along axis 0 (and
+                       axis 1), with FFTs stored in temporary memmaps, so that the arrays need not fit in memory.
+    :param tmp_dir: String. Directory of temporary files. If None, use the system default.
+    :param f_obj: Array. Precomputed (unshifted) FFT of obj. If given, obj is not used.
+    :param f_ref: Array. Precomputed (unshifted) FFT of ref. If given, ref is not used.
+    :return: Arrays of FSC and number of voxels of each shell, indexed by integer radius from 0.
+    """
+    shape = obj.shape if f_obj is None else f_obj.shape
+    radius_max = int(np.ceil(np.sqrt(np.sum((np.array(shape) / 2.) ** 2)))) + 2
+    if chunk_size is None:
+        chunk_size = shape[0]
+    # Directory of temporary FFT files, created when the first one is needed.
+    tmp_dir_created = None
+    try:
+        for i, (a, f_a) in enumerate([(obj, f_obj), (ref, f_ref)]):
+            if f_a is None:
+                if chunk_size < shape[0]:
+                    if tmp_dir_created is None:
+                        tmp_dir_created = tempfile.mkdtemp(dir=tmp_dir)
+                    f_a = _fftn_by_chunks(a, chunk_size, os.path.join(tmp_dir_created, 'fft_{}.dat'.format(i)))
+                else:
+                    f_a = np.fft.fftn(np.asarray(a))
+            if i == 0:
+                f_obj = f_a
+            else:
+                f_ref = f_a
+
+        prod_real = np.zeros(radius_max)
+        prod_imag = np.zeros(radius_max)
+        obj_2 = np.zeros(radius_max)
+        ref_2 = np.zeros(radius_max)
+        n_voxels = np.zeros(radius_max)
+        for i in range(0, shape[0], chunk_size):
+            s = slice(i, min(i + chunk_size, shape[0]))
+            ind = np.broadcast_to(_get_radius_index(shape, s), f_obj[s].shape).ravel()
+            a = np.asarray(f_obj[s]).ravel()
+            b = np.asarray(f_ref[s]).ravel()
+            prod = a * np.conjugate(b)
+            prod_real += np.bincount(ind, weights=prod.real, minlength=radius_max)[:radius_max]
+            prod_imag += np.bincount(ind, weights=prod.imag, minlength=radius_max)[:radius_max]
+            obj_2 += np.bincount(ind, weights=a.real ** 2 + a.imag ** 2, minlength=radius_max)[:radius_max]
+            ref_2 += np.bincount(ind, weights=b.real ** 2 + b.imag ** 2, minlength=radius_max)[:radius_max]
+            n_voxels += np.bincount(ind, minlength=radius_max)[:radius_max]
+    finally:
+        # Memmaps must be released before their files are removed.
+        f_obj = f_ref = f_a = a = b = None
+        if tmp_dir_created is not None:
+            shutil.rmtree(tmp_dir_created, ignore_errors=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fsc = np.sqrt(prod_real ** 2 + prod_imag ** 2) / np.sqrt(obj_2 * ref_2)
+    return fsc, n_voxels
+
+
+def get_half_bit_threshold(n_voxels):
+    """
+    Half-bit information threshold curve for FSC between half-dataset reconstructions.
+
+    :param n_voxels: Array. Number of voxels in each shell, as returned by fourier_correlation_by_radius.
+    """
+    n = np.sqrt(np.clip(n_voxels, 1, None))
+    return (0.2071 + 1.9102 / n) / (1.2071 + 0.9102 / n)
 
-    for rad in radius_ls:
-        print(rad)
-        if os.path.exists(os.path.join(save_path, 'mask_rad_{:04d}.tiff'.format(int(rad)))):
-            mask = dxchange.read_tiff(os.path.join(save_path, 'mask_rad_{:04d}.tiff'.format(int(rad))))
-        else:
-            mask = generate_shell(obj.shape, rad, anti_aliasing=2)
-            if save_mask:
-                dxchange.write_tiff(mask, os.path.join(save_path, 'mask_rad_{:04d}.tiff'.format(int(rad))),
-                                    dtype='float32', overwrite=True)
-        fsc = abs(np.sum(f_prod * mask))
-        fsc /= np.sqrt(np.sum(f_obj_2 * mask) * np.sum(f_ref_2 * mask))
-        fsc_ls.append(fsc)
-        np.save(os.path.join(save_path, 'fsc.npy'), fsc_ls)
-
-    matplotlib.rcParams['pdf.fonttype'] = 'truetype'
-    fontProperties = {'family': 'serif', 'serif': ['Times New Roman'], 'weight': 'normal', 'size': 12}
-    plt.rc('font', **fontProperties)
-    plt.plot(radius_ls.astype(float) / radius_ls[-1], fsc_ls)
-    plt.xlabel('Spatial frequency (1 / Nyquist)')
-    plt.ylabel('FSC')
-    plt.savefig(os.path.join(save_path, 'fsc.pdf'), format='pdf')
-
-
-def fourier_ring_correlation(obj, ref, step_size=1, save_path='frc', save_mask=False):
 
+class FourierCorrelation(object):
+    """
+    Callable FSC/FRC calculator for repeated evaluation, e.g., logging FSC against a fixed reference or between
+    half reconstructions every epoch. The FFT of the reference is cached. If background is True, calls return
+    immediately and the results are appended to the log file by a worker thread.
+    """
+
+    def __init__(self, ref=None, step_size=1, log_fname=None, background=False):
+        """
+        :param ref: Array. Fixed reference. If None, a reference must be supplied in each call.
+        :param log_fname: String. Text file to which each result is appended as a row (prepended with the tag).
+        """
+        self.f_ref = None if ref is None else np.fft.fftn(np.asarray(ref))
+        self.step_size = step_size
+        self.log_fname = log_fname
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if background else None
+
+    def compute(self, obj, ref=None, tag=None):
+        f_ref = self.f_ref if ref is None else None
+        fsc, _ = fourier_correlation_by_radius(obj, ref, f_ref=f_ref)
+        radius_max = int(min(np.shape(obj)) / 2)
+        fsc = fsc[np.arange(1, radius_max, self.step_size)]
+        if self.log_fname is not None:
+            with open(self.log_fname, 'a') as f:
+                f.write(' '.join([str(tag)] + ['{:.6f}'.format(x) for x in fsc]) + '\n')
+        return fsc
+
+    def __call__(self, obj, ref=None, tag=None):
+        """
+        :return: Array of FSC at radii np.arange(1, min(shape) / 2, step_size), or a Future if background is True.
+        """
+        if self.executor is None:
+            return self.compute(obj, ref=ref, tag=tag)
+        obj = np.array(obj)
+        ref = None if ref is None else np.array(ref)
+        return self.executor.submit(self.compute, obj, ref, tag)
+
+
+def fourier_shell_correlation(obj, ref, step_size=1, save_path='fsc', save_mask=True, chunk_size=None,
+                              plot=True, fname_prefix='fsc', ylabel='FSC'):
+    """
+    Calculate and save Fourier shell correlation between obj and ref. See fourier_correlation_by_radius.
+
+    :param save_mask: Bool. If True, the shell index volume is saved as a TIFF.
+    """
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
     radius_max = int(min(obj.shape) / 2)
-    f_obj = np.fft.fftshift(np.fft.fft2(obj))
-    f_ref = np.fft.fftshift(np.fft.fft2(ref))
-    f_prod = f_obj * np.conjugate(f_ref)
-    f_obj_2 = np.real(f_obj * np.conjugate(f_obj))
-    f_ref_2 = np.real(f_ref * np.conjugate(f_ref))
     radius_ls = np.arange(1, radius_max, step_size)
-    fsc_ls = []
     np.save(os.path.join(save_path, 'radii.npy'), radius_ls)
+    fsc_ls, n_voxels = fourier_correlation_by_radius(obj, ref, chunk_size=chunk_size)
+    fsc_ls = fsc_ls[radius_ls]
+    np.save(os.path.join(save_path, '{}.npy'.format(fname_prefix)), fsc_ls)
+    np.save(os.path.join(save_path, 'n_voxels.npy'), n_voxels[radius_ls])
+    if save_mask:
+        dxchange.write_tiff(np.fft.fftshift(_get_radius_index(obj.shape)).astype('float32'),
+                            os.path.join(save_path, 'shell_index'), dtype='float32', overwrite=True)
+
+    if plot:
+        matplotlib.rcParams['pdf.fonttype'] = 'truetype'
+        fontProperties = {'family': 'serif', 'serif': ['Times New Roman'], 'weight': 'normal', 'size': 12}
+        plt.rc('font', **fontProperties)
+        plt.plot(radius_ls.astype(float) / radius_ls[-1], fsc_ls)
+        plt.xlabel('Spatial frequency (1 / Nyquist)')
+        plt.ylabel(ylabel)
+        plt.savefig(os.path.join(save_path, '{}.pdf'.format(fname_prefix)), format='pdf')
+    return fsc_ls
 
-    for rad in radius_ls:
-        print(rad)
-        if os.path.exists(os.path.join(save_path, 'mask_rad_{:04d}.tiff'.format(int(rad)))):
-            mask = dxchange.read_tiff(os.path.join(save_path, 'mask_rad_{:04d}.tiff'.format(int(rad))))
-        else:
-            mask = generate_ring(obj.shape, rad, anti_aliasing=2)
-            if save_mask:
-                dxchange.write_tiff(mask, os.path.join(save_path, 'mask_rad_{:04d}.tiff'.format(int(rad))),
-                                    dtype='float32', overwrite=True)
-        fsc = abs(np.sum(f_prod * mask))
-        fsc /= np.sqrt(np.sum(f_obj_2 * mask) * np.sum(f_ref_2 * mask))
-        fsc_ls.append(fsc)
-        np.save(os.path.join(save_path, 'fsc.npy'), fsc_ls)
-
-    matplotlib.rcParams['pdf.fonttype'] = 'truetype'
-    fontProperties = {'family': 'serif', 'serif': ['Times New Roman'], 'weight': 'normal', 'size': 12}
-    plt.rc('font', **fontProperties)
-    plt.plot(radius_ls.astype(float) / radius_ls[-1], fsc_ls)
-    plt.xlabel('Spatial frequency (1 / Nyquist)')
-    plt.ylabel('FRC')
-    plt.savefig(os.path.join(save_path, 'frc.pdf'), format='pdf')
+
+def fourier_ring_correlation(obj, ref, step_size=1, save_path='frc', save_mask=False, chunk_size=None, plot=True):
+
+    return fourier_shell_correlation(obj, ref, step_size=step_size, save_path=save_path, save_mask=save_mask,
+                                     chunk_size=chunk_size, plot=plot, fname_prefix='frc', ylabel='FRC')
 
 
 def upsample_2x(arr):
@@ -2198,6 +2651,59 @@ def phase_correlation(img, ref, upsample_factor=1):
     return shifts
 
 
+def phase_correlation_batch(img_ls, ref_ls, upsample_factor=1):
+    """
+    Batched version of phase_correlation. All pairs of images are registered with the same batched FFTs and matrix
+    multiplications.
+
+    :param img_ls: Tensor. In shape [n, y, x, 2], where the last dimension holds real and imaginary parts.
+    :param ref_ls: Tensor. In shape [n, y, x, 2], where the last dimension holds real and imaginary parts.
+    :param upsample_factor: Int. Images will be registered to within `1 / upsample_factor` of a pixel.
+    :return: Shifts in shape [n, 2], as [dy, dx] of each img with regards to its ref.
+    """
+    n = img_ls.shape[0]
+    img_shape = img_ls.shape[1:3]
+    f_img_real, f_img_imag = w.fft2(img_ls[..., 0], img_ls[..., 1])
+    f_ref_real, f_ref_imag = w.fft2(ref_ls[..., 0], ref_ls[..., 1])
+    prod_real, prod_imag = w.complex_mul(f_img_real, f_img_imag, f_ref_real, -f_ref_imag)
+    cc_real, cc_imag = w.ifft2(prod_real, prod_imag)
+    cc = w.reshape(cc_real ** 2 + cc_imag ** 2, [n, -1])
+    shifts = w.argmax(cc, axis=1)
+    shifts = w.stack([shifts // img_shape[1], shifts % img_shape[1]], axis=-1)
+    shifts = w.cast(shifts, 'float32')
+
+    if upsample_factor > 1:
+        # Initial shift estimate in upsampled grid
+        shifts = w.round(shifts * upsample_factor) / upsample_factor
+        upsampled_region_size = int(np.ceil(upsample_factor * 1.5))
+        # Center of output array at dftshift + 1
+        dftshift = np.fix(upsampled_region_size / 2.0)
+        # Matrix multiply DFT around the current shift estimate
+        sample_region_offset = dftshift - shifts * upsample_factor
+        # Conjugate of the upsampled cross correlation. Its magnitude is all that matters here.
+        kernel_ls = []
+        for i_dim in range(2):
+            ffreq = w.create_constant(np.fft.fftfreq(img_shape[i_dim], upsample_factor), device=w.get_var_device(prod_real))
+            a = w.create_constant(np.arange(upsampled_region_size), device=w.get_var_device(prod_real))
+            kernel = (a[None, :] - sample_region_offset[:, i_dim:i_dim + 1])[:, :, None] * ffreq
+            kernel_real, kernel_imag = w.exp_complex(0., -2 * np.pi * kernel)
+            kernel_ls.append((w.cast(kernel_real, w.get_dtype(prod_real)), w.cast(kernel_imag, w.get_dtype(prod_real))))
+        (ky_real, ky_imag), (kx_real, kx_imag) = kernel_ls
+        kx_real = w.swap_axes(kx_real, (1, 2))
+        kx_imag = w.swap_axes(kx_imag, (1, 2))
+        d_real = w.matmul(ky_real, prod_real) + w.matmul(ky_imag, prod_imag)
+        d_imag = w.matmul(ky_imag, prod_real) - w.matmul(ky_real, prod_imag)
+        cc_real = w.matmul(d_real, kx_real) - w.matmul(d_imag, kx_imag)
+        cc_imag = w.matmul(d_real, kx_imag) + w.matmul(d_imag, kx_real)
+        # Locate maximum and map back to original pixel grid
+        maxima = w.argmax(w.reshape(cc_real ** 2 + cc_imag ** 2, [n, -1]), axis=1)
+        maxima = w.stack([maxima // upsampled_region_size, maxima % upsampled_region_size], axis=-1)
+        maxima = w.cast(maxima, 'float32') - dftshift
+
+        shifts = shifts + maxima / upsample_factor
+    return shifts
+
+
 def get_process_memory_usage():
     """
     Return CPU memory in MB (Linux).
@@ -16,6 +16,20 @@ try:
 except:
     warnings.warn('Autograd backend is not available.')
     flag_autograd_avail = False
+try:
+    import scipy.fft as sfft
+    flag_scipy_fft_avail = True
+except:
+    flag_scipy_fft_avail = False
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as pyfftw_fft
+    # Keep FFTW plans alive between calls with the same shape and dtype.
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(300)
+    flag_pyfftw_avail = True
+except:
+    flag_pyfftw_avail = False
 try:
     import torch as tc
     import torch.autograd as tag
@@ -320,6 +334,41 @@ def jvp(func, x, backend='autograd'):
         raise NotImplementedError('VJP for Pytorch backend is not implemented yet.')
 
 
+@set_bn
+def linearize(func, x, backend='autograd'):
+    """
+    Returns a constructor that would linearize func at a point with a single forward pass. The function it returns
+    receives the input of func, and returns (func_jvp, func_vjp, value). func_jvp and func_vjp compute the products
+    of the Jacobian and its transpose with their arguments using the same forward pass, and follow the conventions
+    of jvp and vjp: func_jvp receives a list of vectors matching x, and func_vjp returns a tuple.
+    :param func: Function handle.
+    :param x: List. Indices of arguments of func to differentiate against.
+    """
+    if backend == 'autograd':
+        def constructor(*args):
+            func_vjp, value = ag.make_vjp(func, x)(*args)
+            # The VJP is linear in its argument, so its own VJP at any point is the JVP.
+            func_jvp, _ = ag.make_vjp(func_vjp)(anp.zeros_like(value))
+            return func_jvp, func_vjp, value
+        return constructor
+    elif backend == 'pytorch':
+        def constructor(*args):
+            args = list(args)
+            x_ls = []
+            for i in x:
+                args[i] = args[i].detach().requires_grad_()
+                x_ls.append(args[i])
+            value = func(*args)
+            u = tc.zeros_like(value, requires_grad=True)
+            g_ls = tag.grad(value, x_ls, u, create_graph=True)
+            def func_vjp(v):
+                return tag.grad(value, x_ls, v, retain_graph=True)
+            def func_jvp(v_ls):
+                return tag.grad(g_ls, u, list(v_ls), retain_graph=True)[0]
+            return func_jvp, func_vjp, value.detach()
+        return constructor
+
+
 @set_bn
 def hvp(func, x, backend='autograd'):
     """
@@ -333,7 +382,15 @@ def hvp(func, x, backend='autograd'):
     if backend == 'autograd':
         return ag.differential_operators.make_hvp(func, x)
     elif backend == 'pytorch':
-        raise NotImplementedError('VJP for Pytorch backend is not implemented yet.')
+        assert isinstance(x, int)
+        def constructor(*args):
+            args = list(args)
+            args[x] = args[x].detach().requires_grad_()
+            grad = tag.grad(func(*args), args[x], create_graph=True)[0]
+            def func_hvp(v):
+                return tag.grad(grad, args[x], v, retain_graph=True)[0]
+            return func_hvp, grad.detach()
+        return constructor
 
 
 @set_bn
@@ -607,12 +664,103 @@ def round_and_cast(var, dtype='int32', backend='autograd'):
     return cast(round(var), dtype=dtype, override_backend=backend)
 
 
+# Environment variables holding the number of ranks on the node, set by common MPI launchers and by
+# adorym.pseudo.launch.
+LOCAL_SIZE_ENV_NAMES = ['ADORYM_LOCAL_COMM_SIZE', 'OMPI_COMM_WORLD_LOCAL_SIZE', 'MPI_LOCALNRANKS',
+                        'MV2_COMM_WORLD_LOCAL_SIZE', 'PMI_LOCAL_SIZE']
+
+
+def get_n_local_ranks(n_ranks=1):
+    """
+    Number of ranks running on this node, read from the environment of the launcher. If it is not found, all
+    n_ranks ranks are assumed to share the node.
+    """
+    for name in LOCAL_SIZE_ENV_NAMES:
+        try:
+            return max(1, int(os.environ[name]))
+        except (KeyError, ValueError):
+            pass
+    return max(1, n_ranks)
+
+
+def configure_fft(core_parallelization=True, provider=None, n_ranks=1):
+    """
+    Set the FFT provider of the Autograd backend.
+
+    :param core_parallelization: Bool or Int. If True, the cores available to this process are divided among
+                                 the ranks on the node, since core binding of MPI often lets several ranks share
+                                 a core set; the environment variable ADORYM_FFT_WORKERS overrides this. If Int,
+                                 the number of threads. If False, NumPy's single-threaded FFT is used.
+    :param provider: String. Choose from 'numpy', 'scipy' and 'pyfftw'. If None, pyFFTW is used when available,
+                     and SciPy otherwise.
+    :param n_ranks: Int. Total number of ranks, used if the number of ranks on the node is not known.
+    """
+    if core_parallelization is False:
+        global_settings.fft_provider = 'numpy'
+        global_settings.fft_workers = 1
+        return
+    if core_parallelization is True:
+        if 'ADORYM_FFT_WORKERS' in os.environ:
+            n_workers = int(os.environ['ADORYM_FFT_WORKERS'])
+        else:
+            try:
+                n_workers = len(os.sched_getaffinity(0))
+            except AttributeError:
+                n_workers = os.cpu_count()
+            n_workers = n_workers // get_n_local_ranks(n_ranks)
+    else:
+        n_workers = int(core_parallelization)
+    if provider is None:
+        provider = 'pyfftw' if flag_pyfftw_avail else ('scipy' if flag_scipy_fft_avail else 'numpy')
+    if provider == 'pyfftw' and not flag_pyfftw_avail:
+        warnings.warn('pyFFTW is not available. Using SciPy FFT instead.')
+        provider = 'scipy'
+    if provider == 'scipy' and not flag_scipy_fft_avail:
+        warnings.warn('scipy.fft is not available. Using NumPy FFT instead.')
+        provider = 'numpy'
+    global_settings.fft_provider = provider
+    global_settings.fft_workers = max(1, n_workers)
+
+
+def _provider_fftn_raw(var, axes, norm, inverse):
+    func_name = 'ifftn' if inverse else 'fftn'
+    if global_settings.fft_provider == 'scipy':
+        return getattr(sfft, func_name)(var, axes=axes, norm=norm, workers=global_settings.fft_workers)
+    elif global_settings.fft_provider == 'pyfftw':
+        return getattr(pyfftw_fft, func_name)(var, axes=axes, norm=norm, threads=global_settings.fft_workers)
+    else:
+        return getattr(np.fft, func_name)(var, axes=axes, norm=norm)
+
+
+if flag_autograd_avail:
+    @ag.extend.primitive
+    def _provider_fftn(var, axes=None, norm=None, inverse=False):
+        return _provider_fftn_raw(var, axes, norm, inverse)
+
+    # Same as the VJPs of anp.fft.fftn and anp.fft.ifftn: with Autograd's convention for complex numbers, the VJP
+    # of a (inverse) DFT is the same transform.
+    ag.extend.defvjp(_provider_fftn,
+                     lambda ans, var, axes=None, norm=None, inverse=False:
+                     lambda g: _provider_fftn(g, axes=axes, norm=norm, inverse=inverse))
+
+
+def _fftn_autograd(var, axes, norm=None, inverse=False):
+    """
+    FFT of a complex Autograd array along axes using the provider set by configure_fft.
+    """
+    if global_settings.fft_provider == 'numpy':
+        if inverse:
+            return anp.fft.ifftn(var, axes=axes, norm=norm)
+        return anp.fft.fftn(var, axes=axes, norm=norm)
+    return _provider_fftn(var, axes=tuple(axes), norm=norm, inverse=inverse)
+
+
 @set_bn
 def fft(var_real, var_imag, axis=-1, backend='autograd', normalize=False):
     if backend == 'autograd':
         var = var_real + 1j * var_imag
         norm = None if not normalize else 'ortho'
-        var = anp.fft.fft(var, axis=axis, norm=norm)
+        var = _fftn_autograd(var, (axis,), norm=norm)
         return anp.real(var), anp.imag(var)
     elif backend == 'pytorch':
         var = tc.stack([var_real, var_imag], dim=-1)
@@ -627,7 +775,7 @@ def ifft(var_real, var_imag, axis=-1, backend='autograd', normalize=False):
     if backend == 'autograd':
         var = var_real + 1j * var_imag
         norm = None if not normalize else 'ortho'
-        var = anp.fft.ifft(var, axis=axis, norm=norm)
+        var = _fftn_autograd(var, (axis,), norm=norm, inverse=True)
         return anp.real(var), anp.imag(var)
     elif backend == 'pytorch':
         var = tc.stack([var_real, var_imag], dim=-1)
@@ -642,7 +790,7 @@ def fft2(var_real, var_imag, axes=(-2, -1), backend='autograd', normalize=False)
     if backend == 'autograd':
         var = var_real + 1j * var_imag
         norm = None if not normalize else 'ortho'
-        var = anp.fft.fft2(var, axes=axes, norm=norm)
+        var = _fftn_autograd(var, axes, norm=norm)
         return anp.real(var), anp.imag(var)
     elif backend == 'pytorch':
         var = tc.stack([var_real, var_imag], dim=-1)
@@ -657,7 +805,7 @@ def ifft2(var_real, var_imag, axes=(-2, -1), backend='autograd', normalize=False
     if backend == 'autograd':
         var = var_real + 1j * var_imag
         norm = None if not normalize else 'ortho'
-        var = anp.fft.ifft2(var, axes=axes, norm=norm)
+        var = _fftn_autograd(var, axes, norm=norm, inverse=True)
         return anp.real(var), anp.imag(var)
     elif backend == 'pytorch':
         var = tc.stack([var_real, var_imag], dim=-1)
@@ -672,7 +820,7 @@ def fft2_and_shift(var_real, var_imag, axes=(-2, -1), backend='autograd', normal
     if backend == 'autograd':
         var = var_real + 1j * var_imag
         norm = None if not normalize else 'ortho'
-        var = anp.fft.fftshift(anp.fft.fft2(var, axes=axes, norm=norm), axes=axes)
+        var = anp.fft.fftshift(_fftn_autograd(var, axes, norm=norm), axes=axes)
         return anp.real(var), anp.imag(var)
     elif backend == 'pytorch':
         var = tc.stack([var_real, var_imag], dim=-1)
@@ -691,7 +839,7 @@ def ifft2_and_shift(var_real, var_imag, axes=(-2, -1), backend='autograd', norma
     if backend == 'autograd':
         var = var_real + 1j * var_imag
         norm = None if not normalize else 'ortho'
-        var = anp.fft.fftshift(anp.fft.ifft2(var, axes=axes, norm=norm), axes=axes)
+        var = anp.fft.fftshift(_fftn_autograd(var, axes, norm=norm, inverse=True), axes=axes)
         return anp.real(var), anp.imag(var)
     elif backend == 'pytorch':
         var = tc.stack([var_real, var_imag], dim=-1)
@@ -710,7 +858,7 @@ def ishift_and_ifft2(var_real, var_imag, axes=(-2, -1), backend='autograd', norm
     if backend == 'autograd':
         var = var_real + 1j * var_imag
         norm = None if not normalize else 'ortho'
-        var = anp.fft.ifft2(anp.fft.ifftshift(var, axes=axes), axes=axes, norm=norm)
+        var = _fftn_autograd(anp.fft.ifftshift(var, axes=axes), axes, norm=norm, inverse=True)
         return anp.real(var), anp.imag(var)
     elif backend == 'pytorch':
         var_real = ifftshift(var_real, axes=axes)
@@ -1112,7 +1260,8 @@ def matmul(a, b, backend='autograd'):
 def affine_transform(arr, transform, backend='autograd'):
     """
     :param arr: a stack of 2D images in [N, H, W].
-    :param transform: A [2, 3] matrix for affine transform.
+    :param transform: A [2, 3] matrix for affine transform applied to all images, or an [N, 2, 3] stack of
+        matrices, one for each image.
     """
     if backend == 'autograd':
         raise NotImplementedError('Rescaling in Autograd is not yet implemented. Use Pytorch backend instead.')
@@ -1120,7 +1269,9 @@ def affine_transform(arr, transform, backend='autograd'):
         n = arr.shape[0]
         arr_size = arr.shape[1:]
         m = reshape(transform, [-1, 2, 3], override_backend=backend)
-        m = cast(tile(m, [n, 1, 1], override_backend=backend), pytorch_dtype_query_mapping_dict[arr.dtype], override_backend=backend)
+        if m.shape[0] == 1:
+            m = tile(m, [n, 1, 1], override_backend=backend)
+        m = cast(m, pytorch_dtype_query_mapping_dict[arr.dtype], override_backend=backend)
         g = tc.nn.functional.affine_grid(m, [n, 1, *arr_size])
         arr_new = tc.reshape(arr, [n, 1, *arr.shape[1:]])
         arr_new = tc.nn.functional.grid_sample(arr_new, g, padding_mode='border')
@@ -1216,9 +1367,14 @@ def tomography_filter(arr, axis=2, filter_type='hamming', backend='autograd'):
 
 
 @set_bn
-def argmax(arr, backend='autograd'):
+def argmax(arr, axis=None, backend='autograd'):
     func = getattr(engine_dict[backend], func_mapping_dict['argmax'][backend])
-    arr = func(arr)
+    if axis is None:
+        arr = func(arr)
+    elif backend == 'pytorch':
+        arr = func(arr, dim=axis)
+    else:
+        arr = func(arr, axis=axis)
     return arr
 
 
@@ -3,117 +3,102 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import dxchange
-from tqdm import trange
+import functools
 import time
+import adorym
 
-np.random.seed(int(time.time()))
 
-src_fname = 'data_nonoise.h5'
-n_ph_per_px = 1e2 # Number of photons hitting each pixel of that contains the sample.
-n_sample_pixel = 'auto'
-dest_fname = 'data_n{:.1e}'.format(n_ph_per_px)
-raw_data_type = 'intensity'
-is_ptycho = False
-ptycho_grad_size = [325, 325] # Size of the scanned area in pixels.
+def add_noise(block, raw_data_type='intensity', n_ex=None, n_ph=None, per_frame=True):
+    """
+    Add Poisson noise to a block of frames. If n_ex is given, each frame is scaled to n_ex photons in total;
+    otherwise, n_ph photons correspond to unit intensity. Returns the noisy frames and the SNR of each frame
+    (or of the whole block if per_frame is False).
+    """
+    if raw_data_type == 'intensity':
+        prj_o_inten = np.abs(block)
+    else:
+        prj_o_inten = np.abs(block) ** 2
+    if n_ex is not None:
+        # scale intensity to match expected photons per spot
+        multiplier = n_ex / np.sum(prj_o_inten, axis=(-2, -1), keepdims=True)
+    else:
+        multiplier = n_ph
+    prj_o_inten_noisy = np.random.poisson(prj_o_inten * multiplier)
+    prj_o_inten_noisy = prj_o_inten_noisy / multiplier
+    noise = prj_o_inten_noisy - prj_o_inten
+    if per_frame:
+        snr_ls = list(np.var(prj_o_inten, axis=(-2, -1)) / np.var(noise, axis=(-2, -1)))
+    else:
+        snr_ls = [np.var(prj_o_inten) / np.var(noise)]
+    if raw_data_type == 'magnitude':
+        data = np.sqrt(prj_o_inten_noisy)
+    else:
+        data = prj_o_inten_noisy
+    return data, snr_ls
 
 
-o = h5py.File(src_fname, 'r')['exchange/data']
-file_new = h5py.File(dest_fname, 'w')
-grp = file_new.create_group('exchange')
-n = grp.create_dataset('data', dtype=o.dtype, shape=o.shape)
-snr_ls = []
+def main():
+    seed = int(time.time())
 
-if n_sample_pixel == 'auto':
-    n_sample_pixel = o.shape[-2] * o.shape[-1]
+    src_fname = 'data_nonoise.h5'
+    n_ph_per_px = 1e2 # Number of photons hitting each pixel of that contains the sample.
+    n_sample_pixel = 'auto'
+    dest_fname = 'data_n{:.1e}'.format(n_ph_per_px)
+    raw_data_type = 'intensity'
+    is_ptycho = False
+    ptycho_grad_size = [325, 325] # Size of the scanned area in pixels.
+    n_workers = None # Number of worker processes. Defaults to the number of CPUs.
+    compression = None # Choose from None, 'gzip' or 'lzf'.
 
-if is_ptycho:
-    ptycho_grid_size = o.shape[-2:]
+    source = adorym.HDF5FrameSource(src_fname, 'exchange/data')
+    shape = source.shape
+    file_new = h5py.File(dest_fname, 'w')
+    n = adorym.create_adorym_dataset(file_new, shape, dtype=source.dtype, compression=compression)
+    frames_per_block = 16
 
-    # total photons received by sample
-    n_ex = n_ph_per_px * n_sample_pixel
-    n_spots = o.shape[1]
-    # total photons per image
-    print('Far-field ptychography data')
-    n_ex *= (np.prod(ptycho_grid_size) / n_sample_pixel)
-    print('CHECK IF THIS IS THE CORRECT SCAN SIZE AND SAMPLE AREA:')
-    print(ptycho_grid_size, np.prod(ptycho_grid_size), n_sample_pixel)
-    time.sleep(3)
-    # total photons per spot
-    n_ex /= o.shape[1]
-    print(o.shape[1])
+    if n_sample_pixel == 'auto':
+        n_sample_pixel = shape[-2] * shape[-1]
 
-    for i in trange(o.shape[0]):
-        for j in range(o.shape[1]):
-            prj_o = o[i, j]
-            if raw_data_type == 'intensity':
-                prj_o_inten = np.abs(prj_o)
-            else:
-                prj_o_inten = np.abs(prj_o) ** 2
-            spot_integral = np.sum(prj_o_inten)
-            multiplier = n_ex / spot_integral
-            # scale intensity to match expected photons per spot
-            pro_o_inten_scaled = prj_o_inten * multiplier
-            # dc_intensity = prj_o_inten[int(o.shape[-2] / 2), int(o.shape[-1] / 2)]
-            # prj_o_inten_norm = prj_o_inten / dc_intensity
-            # print(n_ph)
-            prj_o_inten_noisy = np.random.poisson(pro_o_inten_scaled)
-            prj_o_inten_noisy = prj_o_inten_noisy / multiplier
-            noise = prj_o_inten_noisy - prj_o_inten
-            snr = np.var(prj_o_inten) / np.var(noise)
-            snr_ls.append(snr)
-            if raw_data_type == 'magnitude':
-                data = np.sqrt(prj_o_inten_noisy)
-            else:
-                data = prj_o_inten_noisy
-            n[i] = data
+    if is_ptycho:
+        ptycho_grid_size = shape[-2:]
 
-elif 'nf_ptycho' in src_fname:
+        # total photons received by sample
+        n_ex = n_ph_per_px * n_sample_pixel
+        n_spots = shape[1]
+        # total photons per image
+        print('Far-field ptychography data')
+        n_ex *= (np.prod(ptycho_grid_size) / n_sample_pixel)
+        print('CHECK IF THIS IS THE CORRECT SCAN SIZE AND SAMPLE AREA:')
+        print(ptycho_grid_size, np.prod(ptycho_grid_size), n_sample_pixel)
+        time.sleep(3)
+        # total photons per spot
+        n_ex /= shape[1]
+        print(shape[1])
+        transform = functools.partial(add_noise, raw_data_type=raw_data_type, n_ex=n_ex)
 
-    print('Near-field ptychography data')
-    time.sleep(3)
-    print(o.shape)
-    n_ph_per_img = n_ph_per_px / o.shape[1]
-    for i in range(o.shape[0]):
-        for j in trange(o.shape[1]):
-            prj_o = o[i, j]
-            if raw_data_type == 'intensity':
-                prj_o_inten = np.abs(prj_o)
-            else:
-                prj_o_inten = np.abs(prj_o) ** 2
-            prj_o_inten_noisy = np.random.poisson(prj_o_inten * n_ph_per_img)
-            # noise = prj_o_inten_noisy - prj_o_inten
-            # print(np.var(noise))
-            prj_o_inten_noisy = prj_o_inten_noisy / n_ph_per_img
-            noise = prj_o_inten_noisy - prj_o_inten
-            snr = np.var(prj_o_inten) / np.var(noise)
-            snr_ls.append(snr)
-            if raw_data_type == 'magnitude':
-                data = np.sqrt(prj_o_inten_noisy)
-            else:
-                data = prj_o_inten_noisy
-            n[i] = data
-else:
-    print('Holography data')
-    time.sleep(3)
-    for i in trange(o.shape[0]):
-        prj_o = o[i]
-        if raw_data_type == 'intensity':
-            prj_o_inten = np.abs(prj_o)
-        else:
-            prj_o_inten = np.abs(prj_o) ** 2
-        prj_o_inten_noisy = np.random.poisson(prj_o_inten * n_ph_per_px)
-        # noise = prj_o_inten_noisy - prj_o_inten
-        # print(np.var(noise))
-        prj_o_inten_noisy = prj_o_inten_noisy / n_ph_per_px
-        noise = prj_o_inten_noisy - prj_o_inten
-        snr = np.var(prj_o_inten) / np.var(noise)
-        snr_ls.append(snr)
-        if raw_data_type == 'magnitude':
-            data = np.sqrt(prj_o_inten_noisy)
-        else:
-            data = prj_o_inten_noisy
-        n[i] = data
+    elif 'nf_ptycho' in src_fname:
 
-print('Average SNR is {}.'.format(np.mean(snr_ls)))
+        print('Near-field ptychography data')
+        time.sleep(3)
+        print(shape)
+        n_ph_per_img = n_ph_per_px / shape[1]
+        transform = functools.partial(add_noise, raw_data_type=raw_data_type, n_ph=n_ph_per_img)
+    else:
+        print('Holography data')
+        time.sleep(3)
+        # SNR is calculated over all images of an angle.
+        frames_per_block = shape[1]
+        transform = functools.partial(add_noise, raw_data_type=raw_data_type, n_ph=n_ph_per_px, per_frame=False)
 
-dxchange.write_tiff(abs(n[0]), os.path.join(os.path.dirname(dest_fname), dest_fname), dtype='float32', overwrite=True)
+    snr_ls = adorym.convert_frames(source, n, transform=transform, frames_per_block=frames_per_block,
+                                   n_workers=n_workers, seed=seed, verbose=True,
+                                   preview_fname=os.path.join(os.path.dirname(dest_fname), dest_fname))
+    snr_ls = np.concatenate(snr_ls)
+
+    print('Average SNR is {}.'.format(np.mean(snr_ls)))
+    file_new.close()
+
+
+# Worker processes import this script, so the conversion must only run in the main process.
+if __name__ == '__main__':
+    main()
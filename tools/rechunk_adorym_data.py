@@ -0,0 +1,64 @@
+"""
+Re-chunk exchange/data of an Adorym HDF5 file for minibatch reads. Tiles of each angle are reordered along a
+Z-order curve of their probe positions and stored in chunks of spots_per_chunk spatially close tiles.
+The order is saved in metadata/spot_permutation (original tile index of each stored tile), which Adorym uses to
+read tiles by their original indices and to form minibatches from consecutive chunks. Probe positions and all other
+metadata are copied unchanged. For the best effect, use a minibatch_size that divides spots_per_chunk.
+"""
+import numpy as np
+import argparse
+import os
+import h5py
+import adorym
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filename', help='Input HDF5 file.')
+    parser.add_argument('--output', default=None, help='Output filename. Defaults to the input name with suffix _rechunked.')
+    parser.add_argument('--spots_per_chunk', default=16, type=int, help='Number of tiles of an angle in each chunk.')
+    parser.add_argument('--compression', default=None, help='Compression of the output data. Choose from gzip or lzf.')
+    parser.add_argument('--n_workers', default=None, type=int, help='Number of worker processes. Defaults to the number of CPUs.')
+    args = parser.parse_args()
+
+    fname = args.filename
+    out_fname = args.output
+    if out_fname is None:
+        out_fname = os.path.splitext(fname)[0] + '_rechunked.h5'
+
+    f = h5py.File(fname, 'r')
+    if 'metadata/probe_pos_px' not in f:
+        print('Tile reordering requires common probe positions in metadata/probe_pos_px.')
+        return
+    probe_pos = f['metadata/probe_pos_px'][...]
+    if f['exchange/data'].shape[1] != len(probe_pos):
+        print('The number of tiles per angle ({}) differs from the number of probe positions ({}), e.g., in multi-distance '
+              'data. Such files cannot be re-chunked.'.format(f['exchange/data'].shape[1], len(probe_pos)))
+        return
+    spot_permutation = adorym.get_compact_tile_order(probe_pos)
+    # If the input is already re-chunked, tiles are located through its permutation.
+    tile_index = spot_permutation
+    if 'metadata/spot_permutation' in f:
+        storage_index = np.argsort(f['metadata/spot_permutation'][...])
+        tile_index = storage_index[spot_permutation]
+
+    source = adorym.PermutedHDF5FrameSource(fname, 'exchange/data', tile_index)
+    f_new = h5py.File(out_fname, 'w')
+    dset = adorym.create_adorym_dataset(f_new, source.shape, dtype=source.dtype, compression=args.compression,
+                                        tiles_per_chunk=args.spots_per_chunk)
+    if 'metadata' in f:
+        f.copy('metadata', f_new)
+    if 'metadata/spot_permutation' in f_new:
+        del f_new['metadata/spot_permutation']
+    f_new.create_dataset('metadata/spot_permutation', data=spot_permutation)
+    f.close()
+
+    adorym.convert_frames(source, dset, frames_per_block=args.spots_per_chunk, n_workers=args.n_workers,
+                          verbose=True)
+    f_new.close()
+    print('Re-chunked data written to {}.'.format(out_fname))
+
+
+# Worker processes import this script, so the conversion must only run in the main process.
+if __name__ == '__main__':
+    main()
@@ -13,26 +13,6 @@ import re
 import sys
 import adorym
 
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('dir', default='.', help='Directory containing raw TIFF files.')
-parser.add_argument('prefix', default='data', help='Prefix to TIFF filenames.')
-
-parser.add_argument('--z_od_ls', default='None', help='Object to detector distance in cm. Separate by comma. '
-                                                    'Must match order of input image indexing.')
-parser.add_argument('--z_sd', default='None', help='Source to detector distance in cm.')
-parser.add_argument('--psize_ls', default=None, help='List of pixel sizes in um. Separate by comma. '
-                                                     'Must match order of input image indexing.')
-parser.add_argument('--crop', default=True, type=bool, help='Whether to crop image to keep output shape the same.')
-args = parser.parse_args()
-
-z_od_ls = args.z_od_ls.split(',')
-z_od_ls = np.array([float(z) for z in z_od_ls])
-z_sd = float(args.z_sd)
-src_dir = args.dir
-prefix = args.prefix
-psize_ls = args.psize_ls.split(',')
-psize_ls = np.array([float(z) for z in psize_ls])
-crop = args.crop
 
 def convert_cone_to_parallel(data, z_sd, z_od_ls, psize=None, crop=True):
     """
@@ -74,24 +54,59 @@ def convert_cone_to_parallel(data, z_sd, z_od_ls, psize=None, crop=True):
             new_data.append(img)
     return new_data, z_eff_ls, mag_ls
 
-flist, n_theta, n_dists, raw_img_shape = adorym.parse_source_folder(src_dir, prefix)
 
-new_folder = os.path.join(os.path.dirname(src_dir), os.path.basename(src_dir) + '_rescaled')
-try:
-    os.makedirs(new_folder)
-except:
-    print('Target folder {} exists.'.format(new_folder))
-
-for i_theta in range(n_theta):
-    print('Processing theta {}/{}...'.format(i_theta, n_theta))
-    data = np.zeros([n_dists] + list(raw_img_shape))
-    for i_dist in range(n_dists):
-        fname = flist[i_theta * n_dists + i_dist]
-        data[i_dist] = dxchange.read_tiff(fname)
+def rescale_theta(i_theta, flist, n_dists, z_sd, z_od_ls, psize_ls, crop, new_folder):
+    print('Processing theta {}...'.format(i_theta))
+    data = adorym.TiffFrameSource(flist[i_theta * n_dists:(i_theta + 1) * n_dists]).read(0, n_dists).astype('float64')
     data, z_eff_ls, mag_ls = convert_cone_to_parallel(data, z_sd, z_od_ls, psize_ls, crop)
     for i_dist, img in enumerate(data):
         fname = flist[i_theta * n_dists + i_dist]
         dxchange.write_tiff(img, os.path.join(new_folder, os.path.join(os.path.basename(fname))), dtype='float32', overwrite=True)
+    return z_eff_ls, mag_ls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dir', default='.', help='Directory containing raw TIFF files.')
+    parser.add_argument('prefix', default='data', help='Prefix to TIFF filenames.')
+
+    parser.add_argument('--z_od_ls', default='None', help='Object to detector distance in cm. Separate by comma. '
+                                                        'Must match order of input image indexing.')
+    parser.add_argument('--z_sd', default='None', help='Source to detector distance in cm.')
+    parser.add_argument('--psize_ls', default=None, help='List of pixel sizes in um. Separate by comma. '
+                                                         'Must match order of input image indexing.')
+    parser.add_argument('--crop', default=True, type=bool, help='Whether to crop image to keep output shape the same.')
+    parser.add_argument('--n_workers', default=None, type=int, help='Number of worker processes. Defaults to the number of CPUs.')
+    args = parser.parse_args()
+
+    z_od_ls = args.z_od_ls.split(',')
+    z_od_ls = np.array([float(z) for z in z_od_ls])
+    z_sd = float(args.z_sd)
+    src_dir = args.dir
+    prefix = args.prefix
+    psize_ls = args.psize_ls.split(',')
+    psize_ls = np.array([float(z) for z in psize_ls])
+    crop = args.crop
+
+    flist, n_theta, n_dists, raw_img_shape = adorym.parse_source_folder(src_dir, prefix)
+
+    new_folder = os.path.join(os.path.dirname(src_dir), os.path.basename(src_dir) + '_rescaled')
+    try:
+        os.makedirs(new_folder)
+    except:
+        print('Target folder {} exists.'.format(new_folder))
+
+    # Angles are independent, so they are processed in worker processes.
+    for z_eff_ls, mag_ls in adorym.map_in_workers(rescale_theta,
+                                                  [(i, flist, n_dists, z_sd, z_od_ls, psize_ls, crop, new_folder)
+                                                   for i in range(n_theta)],
+                                                  n_workers=args.n_workers):
+        pass
+
+    np.savetxt(os.path.join(new_folder, 'z_eff_ls.txt'), z_eff_ls, fmt='%.3f')
+    np.savetxt(os.path.join(new_folder, 'mag_ls.txt'), mag_ls, fmt='%.3f')
+
 
-np.savetxt(os.path.join(new_folder, 'z_eff_ls.txt'), z_eff_ls, fmt='%.3f')
-np.savetxt(os.path.join(new_folder, 'mag_ls.txt'), mag_ls, fmt='%.3f')
\ No newline at end of file
+# Worker processes import this script, so the conversion must only run in the main process.
+if __name__ == '__main__':
+    main()